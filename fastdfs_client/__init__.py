@@ -1,4 +1,6 @@
 from .client import AsyncDfsClient, FastdfsClient
+from .connection import AsyncConnectionPool, RetryPolicy
+from .protols import SocketOptions
 
 __version__ = "1.2.2"
 VERSION = tuple(map(int, __version__.split(".")))
@@ -8,4 +10,7 @@ __all__ = (
     "VERSION",
     "FastdfsClient",
     "AsyncDfsClient",
+    "RetryPolicy",
+    "AsyncConnectionPool",
+    "SocketOptions",
 )
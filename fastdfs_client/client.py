@@ -1,19 +1,61 @@
 import contextlib
+import json
 import os
-import random
 import re
 import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import cached_property
 from pathlib import Path
-from typing import Annotated, Type, TypedDict, cast, get_type_hints
+from typing import (
+    Annotated,
+    AsyncGenerator,
+    AsyncIterable,
+    Callable,
+    Generator,
+    Iterator,
+    Type,
+    TypedDict,
+    TypeVar,
+    cast,
+    get_type_hints,
+)
 
-from .connection import ConnectionPool
-from .exceptions import ConfigError, DataError, ResponseError
-from .protols import STORAGE_SET_METADATA_FLAG_OVERWRITE
-from .storage_client import StorageClient
+from .connection import (
+    AsyncConnectionPool,
+    ConnectionPool,
+    DnsCache,
+    HostSelector,
+    PoolRegistry,
+    RetryPolicy,
+)
+from .exceptions import (
+    ConfigError,
+    ConnectionError,
+    DataError,
+    PoolExhaustedError,
+    ResponseError,
+)
+from .protols import (
+    FDFS_STORAGE_STATUS_ACTIVE,
+    STORAGE_SET_METADATA_FLAG_OVERWRITE,
+    Crc32,
+    SocketOptions,
+    StorageServer,
+)
+from .storage_client import StorageClient, preallocate
 from .tracker_client import TrackerClient
-from .utils import FastdfsConfigParser, fdfs_check_file, logger, split_remote_fileid
+from .utils import (
+    FastdfsConfigParser,
+    appromix,
+    fdfs_check_file,
+    get_file_ext_name,
+    logger,
+    split_remote_fileid,
+)
 
+T = TypeVar("T")
 RE_IP = re.compile(r"(?:[0-9]{1,3}\.){3}[0-9]{1,3}$")
 
 
@@ -21,7 +63,7 @@ def is_IPv4(value: str) -> bool:
     return bool(RE_IP.match(value))
 
 
-class ConfigDict(TypedDict):
+class _RequiredConfig(TypedDict):
     host_tuple: Annotated[
         tuple[str, ...], "IP or domain, e.g: ('192.168.0.2', 'example.com')"
     ]
@@ -30,6 +72,10 @@ class ConfigDict(TypedDict):
     name: str
 
 
+class ConfigDict(_RequiredConfig, total=False):
+    retry: Annotated[RetryPolicy, "How to retry connecting to trackers"]
+
+
 class Config:
     port = 22122
     timeout = 30
@@ -41,13 +87,17 @@ class Config:
         hosts: tuple[str, ...],
         port: int | None = None,
         timeout: int | None = None,
+        retry: RetryPolicy | None = None,
     ) -> ConfigDict:
-        return {
+        conf: ConfigDict = {
             "host_tuple": hosts,
             "port": port or cls.port,
             "timeout": timeout or cls.timeout,
             "name": cls.name,
         }
+        if retry is not None:
+            conf["retry"] = retry
+        return conf
 
 
 def get_tracker_conf(conf_path="client.conf") -> dict:
@@ -81,6 +131,9 @@ TrackersConfType = (
 
 
 class BaseClient:
+    # Seconds to keep the URL prefixes, as tracker domains may point to new IPs
+    url_prefix_ttl = 300.0
+
     def __init__(
         self,
         trackers: TrackersConfType,
@@ -97,30 +150,69 @@ class BaseClient:
         self.timeout = self.trackers["timeout"]
         self.ip_mapping = ip_mapping
         self.ssl = ssl
+        # Built on first use, not to resolve tracker domains in constructor
+        self._url_prefixes: dict[str, str] | None = None
+        self._url_prefixes_expire_at = 0.0
 
     def _check_config(self, trackers) -> None:
         expected = get_type_hints(ConfigDict)
-        if missing := set(expected) - set(trackers):
+        if missing := ConfigDict.__required_keys__ - set(trackers):
             raise ConfigError(f"Invalid trackers: {missing=} (expected: {expected})")
 
     def _build_host(self, storage_ip: str) -> str:
+        """Get URL prefix of storage ip from the precomputed table, no syscall here
+        but for the first call, which builds it.
+        An expired table is still used while it is reloaded in background.
+        """
+        if self._url_prefixes is None:
+            self._reload_url_prefixes()
+        elif time.monotonic() >= self._url_prefixes_expire_at:
+            self._url_prefixes_expire_at = time.monotonic() + self.url_prefix_ttl
+            threading.Thread(
+                target=self._reload_url_prefixes, name="fastdfs-url-prefix", daemon=True
+            ).start()
+        return self._url_prefix(storage_ip)
+
+    def _url_prefix(self, storage_ip: str) -> str:
+        return (self._url_prefixes or {}).get(storage_ip) or f"http://{storage_ip}/"
+
+    def _reload_url_prefixes(self) -> None:
+        self._url_prefixes = self._load_url_prefixes()
+        self._url_prefixes_expire_at = time.monotonic() + self.url_prefix_ttl
+
+    def _load_url_prefixes(self) -> dict[str, str]:
+        domain_ips = {}
+        for domain in self._tracker_domains():
+            try:
+                domain_ips[domain] = self.get_domain_ip(domain)
+            except OSError as e:
+                logger.debug(f"Failed to resolve {domain}: {e}")
+        return self._make_url_prefixes(domain_ips)
+
+    def _tracker_domains(self) -> list[str]:
+        """Tracker domains that are not listed in ip_mapping."""
+        listed_domains = (self.ip_mapping or {}).values()
+        return [
+            host
+            for host in self.trackers["host_tuple"]
+            if not is_IPv4(host) and host not in listed_domains
+        ]
+
+    def _make_url_prefixes(self, domain_ips: dict[str, str]) -> dict[str, str]:
+        """Map storage ip to URL prefix by ip_mapping, then by tracker domains."""
         ip_mapping = self.ip_mapping or {}
-        if storage_ip not in ip_mapping:
-            listed_domains = ip_mapping.values()
-            for ip_or_domain in self.trackers["host_tuple"]:
-                if is_IPv4(ip_or_domain) or ip_or_domain in listed_domains:
-                    continue
-                if self.get_domain_ip(ip_or_domain) == storage_ip:
-                    ip_mapping[storage_ip] = ip_or_domain
-                    break
-        if h := ip_mapping.get(storage_ip):
-            if not h.endswith("/"):
-                h += "/"
-            if not h.startswith("http"):
-                scheme = "https" if self.ssl else "http"
-                h = f"{scheme}://" + h
-            return h
-        return f"http://{storage_ip}/"
+        prefixes = {ip: self._format_prefix(h) for ip, h in ip_mapping.items() if h}
+        for domain, storage_ip in domain_ips.items():
+            prefixes.setdefault(storage_ip, self._format_prefix(domain))
+        return prefixes
+
+    def _format_prefix(self, host: str) -> str:
+        if not host.endswith("/"):
+            host += "/"
+        if not host.startswith("http"):
+            scheme = "https" if self.ssl else "http"
+            host = f"{scheme}://" + host
+        return host
 
     @staticmethod
     def get_domain_ip(domain: str) -> str:
@@ -129,11 +221,43 @@ class BaseClient:
 
 
 class AsyncDfsClient(BaseClient):
+    """
+    Streams to tracker and storage servers are reused by `pool`, pass
+    `AsyncConnectionPool(max_per_host=..., idle_timeout=...)` to tune it.
+    """
+
+    def __init__(
+        self,
+        trackers: TrackersConfType,
+        ip_mapping: Annotated[dict[str, str], "ip: domain"] | None = None,
+        ssl: bool = True,
+        socket_options: SocketOptions | None = None,
+        pool: AsyncConnectionPool | None = None,
+        dns_ttl: float = 300.0,
+    ) -> None:
+        super().__init__(trackers, ip_mapping, ssl)
+        self.socket_options = socket_options
+        if pool is None:
+            pool = AsyncConnectionPool(socket_options=socket_options)
+        self.pool = pool
+        self.dns = DnsCache(dns_ttl)
+
+    async def aclose(self) -> None:
+        """Close the idle streams of pool."""
+        await self.pool.aclose()
+
     @cached_property
     def domain_ip(self) -> dict[str, str]:
         return {v.split("://")[-1]: k for k, v in (self.ip_mapping or {}).items()}
 
+    @cached_property
+    def selector(self) -> HostSelector:
+        return HostSelector()
+
     def random_host(self) -> tuple[str, int]:
+        """Choose a tracker, the healthy and faster one first.
+        Domains are resolved by blocking DNS lookup, use `choose_host` in async code.
+        """
         ip_list: list[str] = []
         for host in self.trackers["host_tuple"]:
             if not is_IPv4(host):
@@ -142,9 +266,87 @@ class AsyncDfsClient(BaseClient):
                 else:
                     host = self.get_domain_ip(host)
             ip_list.append(host)
+        return self._choose_host(ip_list)
+
+    async def choose_host(self) -> tuple[str, int]:
+        """Same as `random_host`, but domains are resolved by the cached async DNS."""
+        ip_list = [await self.resolve(host) for host in self.trackers["host_tuple"]]
+        return self._choose_host(ip_list)
+
+    def _choose_host(self, ip_list: list[str]) -> tuple[str, int]:
+        port = self.trackers["port"]
+        host = ip_list[-1]
         if len(ip_list) > 1:
-            host = random.choice(ip_list)
-        return host, self.trackers["port"]
+            host = self.selector.choose(ip_list, port)
+        return host, port
+
+    async def resolve(self, host: str) -> str:
+        """Get IP of host without blocking the event loop."""
+        if is_IPv4(host):
+            return host
+        if host in self.domain_ip:
+            return self.domain_ip[host]
+        return await self.dns.resolve(host)
+
+    async def _build_host_async(self, storage_ip: str) -> str:
+        """Same as `_build_host`, but domains are resolved by the cached async DNS,
+        which returns an expired answer at once while refreshing it."""
+        if (
+            self._url_prefixes is None
+            or time.monotonic() >= self._url_prefixes_expire_at
+        ):
+            domain_ips = {}
+            for domain in self._tracker_domains():
+                try:
+                    domain_ips[domain] = await self.resolve(domain)
+                except OSError as e:
+                    logger.debug(f"Failed to resolve {domain}: {e}")
+            self._url_prefixes = self._make_url_prefixes(domain_ips)
+            self._url_prefixes_expire_at = time.monotonic() + self.url_prefix_ttl
+        return self._url_prefix(storage_ip)
+
+    async def _query_storage(
+        self, host_info: tuple[str, int], group_name="", filename="", fetch=False
+    ) -> StorageServer:
+        """Query storage server from tracker, record its health and latency."""
+        started_at = time.monotonic()
+        try:
+            store_serv = await TrackerClient.get_storage_server(
+                host_info,
+                group_name,
+                filename,
+                self.socket_options,
+                self.pool,
+                fetch=fetch,
+            )
+        except (OSError, ConnectionError):
+            self.selector.failure(*host_info)
+            raise
+        except BaseException:
+            self.selector.cancel_probe(*host_info)
+            raise
+        self.selector.success(*host_info, time.monotonic() - started_at)
+        return store_serv
+
+    async def _locate(self, file: str, fetch=False) -> tuple[StorageServer, str]:
+        """Query the storage server that keeps the file of remote id or URL,
+        return it with the remote filename"""
+        maybe_url = True
+        try:
+            _, uri = file.split("://")
+        except ValueError:
+            host_info = await self.choose_host()
+        else:
+            ip_addr, file = uri.split("/", 1)
+            maybe_url = False
+            host_info = (await self.resolve(ip_addr), self.trackers["port"])
+        if not (tmp := split_remote_fileid(file, maybe_url=maybe_url)):
+            raise DataError("[-] Error: remote_file_id is invalid.")
+        group_name, remote_filename = tmp
+        store_serv = await self._query_storage(
+            host_info, group_name, remote_filename, fetch=fetch
+        )
+        return store_serv, remote_filename
 
     async def upload(self, content: bytes, suffix=".jpg") -> str:
         """Upload file content, if success return a URL
@@ -163,11 +365,72 @@ class AsyncDfsClient(BaseClient):
         # https://example.com/group1/M00/00/00/eE0vIWZEgMCAFnaMAAABXbxaFk89563.jpeg
         ```
         """
-        store_serv = await TrackerClient.get_storage_server(self.random_host())
+        store_serv = await self._query_storage(await self.choose_host())
         store = StorageClient(store_serv.ip_addr, store_serv.port, self.timeout)  # type:ignore
         res = await store.upload_buffer(store_serv, content, suffix.lstrip("."))
         uri_path = res["Remote file_id"]  # 'group1/M00/00/00/eE..R458.jpg'
-        return self._build_host(res["Storage IP"]) + uri_path
+        return await self._build_host_async(res["Storage IP"]) + uri_path
+
+    async def upload_stream(
+        self, chunks: AsyncIterable[bytes], size: int, suffix=".jpg"
+    ) -> str:
+        """Upload file content from an async iterable of chunks, return a URL
+
+        :param chunks: async iterable of bytes, e.g.: chunks of a request body
+        :param size: total size of the chunks
+        :param suffix: this will add at the end of URL with a dot before it
+
+        Example::
+        ```py
+        import anyio
+        from fastdfs_client import AsyncDfsClient
+
+        async def read_chunks(path):
+            async with await anyio.open_file(path, 'rb') as f:
+                while chunk := await f.read(64 * 1024):
+                    yield chunk
+
+        client = AsyncDfsClient(['example.com'])
+        size = (await anyio.Path('a.mp4').stat()).st_size
+        url = await client.upload_stream(read_chunks('a.mp4'), size, suffix='mp4')
+        ```
+        """
+        store_serv = await self._query_storage(await self.choose_host())
+        store = StorageClient(store_serv.ip_addr, store_serv.port, self.timeout)  # type:ignore
+        res = await store.upload_stream(store_serv, chunks, size, suffix.lstrip("."))
+        return await self._build_host_async(res["Storage IP"]) + res["Remote file_id"]
+
+    async def download_stream(
+        self,
+        file: Annotated[str, "remote_file id or URL, e.g.: group1/M00/00/xxx.jpg"],
+        chunk_size: int = 64 * 1024,
+        offset: int = 0,
+        length: int = 0,
+    ) -> AsyncGenerator[bytes, None]:
+        """Download file content by chunks of at most `chunk_size` bytes
+
+        :param file: remote file id or URL
+        :param offset: start position of the file
+        :param length: bytes to download, 0 means to the end of file
+
+        Example::
+        ```py
+        from fastdfs_client import AsyncDfsClient
+
+        client = AsyncDfsClient(['example.com'])
+        async with await anyio.open_file('a.mp4', 'wb') as f:
+            async for chunk in client.download_stream('group1/M00/00/00/a.mp4'):
+                await f.write(chunk)
+        ```
+        """
+        store_serv, remote_filename = await self._locate(file, fetch=True)
+        store = StorageClient(store_serv.ip_addr, store_serv.port, self.timeout)
+        stream = store.download_stream(
+            store_serv, remote_filename, offset, length, chunk_size
+        )
+        async with contextlib.aclosing(stream):
+            async for chunk in stream:
+                yield chunk
 
     async def delete(
         self, file: Annotated[str, "remote_file id or URL, e.g.: group1/M00/00/xxx.jpg"]
@@ -188,23 +451,7 @@ class AsyncDfsClient(BaseClient):
         # ('Delete file successed.', b'group1/M00/00/1B/eE0vIWaU9kyAVILJAAHM-px7j44359.py', b'120.77.47.33')
         ```
         """
-        maybe_url = True
-        try:
-            _, uri = file.split("://")
-        except ValueError:
-            host_info = self.random_host()
-        else:
-            ip_addr, file = uri.split("/", 1)
-            maybe_url = False
-            if not is_IPv4(ip_addr):
-                ip_addr = self.get_domain_ip(ip_addr)
-            host_info = (ip_addr, self.trackers["port"])
-        if not (tmp := split_remote_fileid(file, maybe_url=maybe_url)):
-            raise DataError("[-] Error: remote_file_id is invalid.(in delete file)")
-        group_name, remote_filename = tmp
-        store_serv = await TrackerClient.get_storage_server(
-            host_info, group_name, remote_filename
-        )
+        store_serv, remote_filename = await self._locate(file)
         store = StorageClient(store_serv.ip_addr, store_serv.port, self.timeout)
         return await store.delete_file(store_serv, remote_filename)
 
@@ -215,27 +462,120 @@ class FastdfsClient(BaseClient):
 
     It's useful upload, download, delete file to or from fdfs server, etc. It's uses
     connection pool to manage connection to server.
+
+    Extra keyword arguments are passed to the tracker pool and every storage pool,
+    e.g.: `FastdfsClient(trackers, max_conn=10, block=True, wait_timeout=5)`,
+    or `FastdfsClient(trackers, retry=RetryPolicy(attempts=5, deadline=10))`,
+    or `FastdfsClient(trackers, socket_options=SocketOptions(keepalive=True))`
+
+    Set `warm_up_size` to open that many tracker connections in advance, and also
+    that many to each active storage server if `warm_up_storage` is True.
+    Pools are reset in a forked child process without touching the sockets of the
+    parent, pass `fork_warm_up=N` to reopen N connections per pool in the child.
+
+    Files are sent and received by chunks of `buffer_size` bytes, which adapts to
+    the socket buffer size(256 KiB ~ 1 MiB) by default.
+
+    Set `verify_crc32` to compute CRC32 of content while uploading or downloading
+    a whole file, and raise DataError if it is not the one on storage server.
+    A parallel download is verified by reading the file once it is assembled.
     """
 
+    # Ranges of a parallel download or upload are at least this large
+    parallel_min_range = 4 * 1024 * 1024
+    # Appended to local filename to record the progress of a resumable transfer
+    journal_suffix = ".fdfs-journal"
+    # Bytes appended by one request in a resumable upload
+    resume_chunk_size = 64 * 1024 * 1024
+
     def __init__(
         self,
         trackers: TrackersConfType,
         poolclass: Type[ConnectionPool] | None = None,
         ip_mapping: dict[str, str] | None = None,
         ssl: bool = True,
+        max_storage_pools: int = 32,
+        warm_up_size: int = 0,
+        warm_up_storage: bool = False,
+        buffer_size: int | None = None,
+        verify_crc32: bool = False,
+        **pool_kwargs,
     ) -> None:
         super().__init__(trackers, ip_mapping, ssl)
         if poolclass is None:
             poolclass = ConnectionPool
-        self.tracker_pool = poolclass(**self.trackers)
+        self.pool_kwargs = pool_kwargs
+        self.buffer_size = buffer_size
+        self.verify_crc32 = verify_crc32
+        self.tracker_pool = poolclass(**{**self.trackers, **pool_kwargs})
+        # Storage pools are reused by all calls, instead of one pool per call
+        self.storage_pools = PoolRegistry(
+            max_storage_pools, poolclass, timeout=self.timeout, **pool_kwargs
+        )
+        if warm_up_size > 0:
+            try:
+                self.warm_up(warm_up_size, warm_up_size if warm_up_storage else 0)
+            except (ConnectionError, ResponseError, DataError) as e:
+                logger.warning(f"[-] Failed to warm up: {e}")
 
     def __del__(self) -> None:
         try:
-            self.pool.destroy()  # type:ignore
-            self.pool = None  # pragma: no cover
+            self.tracker_pool.destroy()
+            self.storage_pools.destroy()
         except Exception as e:
             logger.debug(f"Failed to destroy: {e}")
 
+    def warm_up(self, tracker_conns: int = 1, storage_conns: int = 0) -> int:
+        """
+        Open connections in parallel, so that the first requests need not wait.
+        It can be called at process start, or again in a forked child.
+        arguments:
+        @tracker_conns: int, amount of connections to the trackers
+        @storage_conns: int, amount of connections to each active storage server,
+                        which are found by `list_all_groups` and `list_servers`
+        @return int, amount of connections opened
+        """
+        opened = self.tracker_pool.warm_up(tracker_conns)
+        if storage_conns <= 0:
+            return opened
+        servers = self._active_storages()[: self.storage_pools.max_pools]
+        pools = [self.storage_pools.get(ip_addr, port) for ip_addr, port in servers]
+        if pools:
+            with ThreadPoolExecutor(max_workers=len(pools)) as executor:
+                opened += sum(executor.map(lambda p: p.warm_up(storage_conns), pools))
+        return opened
+
+    def _active_storages(self) -> list[tuple[bytes, int]]:
+        servers = []
+        for group in self.list_all_groups()["Groups"]:
+            for si in self.list_servers(group.group_name)["Servers"]:
+                if si.status == FDFS_STORAGE_STATUS_ACTIVE:
+                    servers.append((si.ip_addr, si.storage_port))
+        return servers
+
+    @contextlib.contextmanager
+    def _open_storage(self, store_serv) -> Generator[StorageClient, None, None]:
+        """Yield a storage client that uses the shared pool of store_serv.
+        The pool will be dropped if the storage server can not be reached, but
+        not if all of its connections are just busy.
+        """
+        ip_addr, port = store_serv.ip_addr, store_serv.port
+        pool = self.storage_pools.get(ip_addr, port)
+        try:
+            yield StorageClient(
+                ip_addr,
+                port,
+                self.timeout,
+                pool=pool,
+                buffer_size=self.buffer_size,
+                verify_crc32=self.verify_crc32,
+            )
+        except PoolExhaustedError:
+            raise
+        except ConnectionError:
+            self.storage_pools.discard(ip_addr, port)
+            raise
+
     def upload_as_url(self, content: bytes, suffix="jpg") -> str:
         """Upload file content, if success return a URL
 
@@ -284,10 +624,10 @@ class FastdfsClient(BaseClient):
         self._check_file(filename)
         tc = TrackerClient(self.tracker_pool)
         store_serv = tc.tracker_query_storage_stor_without_group()
-        store = StorageClient(store_serv.ip_addr, store_serv.port, self.timeout)
-        return store.storage_upload_by_filename(
-            tc, store_serv, str(filename), meta_dict
-        )
+        with self._open_storage(store_serv) as store:
+            return store.storage_upload_by_filename(
+                tc, store_serv, str(filename), meta_dict
+            )
 
     def _check_file(self, filename, info="(uploading)") -> None:
         isfile, errmsg = fdfs_check_file(filename)
@@ -298,8 +638,8 @@ class FastdfsClient(BaseClient):
         self._check_file(filename)
         tc = TrackerClient(self.tracker_pool)
         store_serv = tc.tracker_query_storage_stor_without_group()
-        store = StorageClient(store_serv.ip_addr, store_serv.port, self.timeout)
-        return store.storage_upload_by_file(tc, store_serv, filename, meta_dict)
+        with self._open_storage(store_serv) as store:
+            return store.storage_upload_by_file(tc, store_serv, filename, meta_dict)
 
     def upload_by_buffer(
         self, filebuffer: bytes, file_ext_name=None, meta_dict=None
@@ -328,10 +668,10 @@ class FastdfsClient(BaseClient):
             raise DataError("[-] Error: argument filebuffer can not be null.")
         tc = TrackerClient(self.tracker_pool)
         store_serv = tc.tracker_query_storage_stor_without_group()
-        store = StorageClient(store_serv.ip_addr, store_serv.port, self.timeout)
-        return store.storage_upload_by_buffer(
-            tc, store_serv, filebuffer, file_ext_name, meta_dict
-        )
+        with self._open_storage(store_serv) as store:
+            return store.storage_upload_by_buffer(
+                tc, store_serv, filebuffer, file_ext_name, meta_dict
+            )
 
     def upload_slave_by_filename(
         self, filename, remote_file_id, prefix_name, meta_dict=None
@@ -365,16 +705,21 @@ class FastdfsClient(BaseClient):
         group_name, remote_filename = tmp
         tc = TrackerClient(self.tracker_pool)
         store_serv = tc.tracker_query_storage_stor_with_group(group_name)
-        store = StorageClient(store_serv.ip_addr, store_serv.port, self.timeout)
-        try:
-            ret_dict = store.storage_upload_slave_by_filename(
-                tc, store_serv, filename, prefix_name, remote_filename, meta_dict=None
-            )
-        except Exception as e:
-            logger.exception(e)
-            raise e
-        ret_dict["Status"] = "Upload slave file successed."
-        return ret_dict
+        with self._open_storage(store_serv) as store:
+            try:
+                ret_dict = store.storage_upload_slave_by_filename(
+                    tc,
+                    store_serv,
+                    filename,
+                    prefix_name,
+                    remote_filename,
+                    meta_dict=None,
+                )
+            except Exception as e:
+                logger.exception(e)
+                raise e
+            ret_dict["Status"] = "Upload slave file successed."
+            return ret_dict
 
     def upload_slave_by_file(
         self, filename, remote_file_id, prefix_name, meta_dict=None
@@ -408,16 +753,21 @@ class FastdfsClient(BaseClient):
         group_name, remote_filename = tmp
         tc = TrackerClient(self.tracker_pool)
         store_serv = tc.tracker_query_storage_stor_with_group(group_name)
-        store = StorageClient(store_serv.ip_addr, store_serv.port, self.timeout)
-        try:
-            ret_dict = store.storage_upload_slave_by_file(
-                tc, store_serv, filename, prefix_name, remote_filename, meta_dict=None
-            )
-        except Exception as e:
-            logger.exception(e)
-            raise DataError(str(e)) from e
-        ret_dict["Status"] = "Upload slave file successed."
-        return ret_dict
+        with self._open_storage(store_serv) as store:
+            try:
+                ret_dict = store.storage_upload_slave_by_file(
+                    tc,
+                    store_serv,
+                    filename,
+                    prefix_name,
+                    remote_filename,
+                    meta_dict=None,
+                )
+            except Exception as e:
+                logger.exception(e)
+                raise DataError(str(e)) from e
+            ret_dict["Status"] = "Upload slave file successed."
+            return ret_dict
 
     def upload_slave_by_buffer(
         self, filebuffer, remote_file_id, meta_dict=None, file_ext_name=None
@@ -449,12 +799,14 @@ class FastdfsClient(BaseClient):
         group_name, remote_filename = tmp
         tc = TrackerClient(self.tracker_pool)
         store_serv = tc.tracker_query_storage_update(group_name, remote_filename)
-        store = StorageClient(store_serv.ip_addr, store_serv.port, self.timeout)
-        return store.storage_upload_slave_by_buffer(
-            tc, store_serv, filebuffer, remote_filename, meta_dict, file_ext_name
-        )
+        with self._open_storage(store_serv) as store:
+            return store.storage_upload_slave_by_buffer(
+                tc, store_serv, filebuffer, remote_filename, meta_dict, file_ext_name
+            )
 
-    def upload_appender_by_filename(self, local_filename, meta_dict=None):
+    def upload_appender_by_filename(
+        self, local_filename, meta_dict=None, parallel=1, resume=False
+    ):
         """
         Upload an appender file by filename.
         arguments:
@@ -465,22 +817,180 @@ class FastdfsClient(BaseClient):
             'width'     : '160px',
             'hight'     : '80px'
         }    Notice: it can be null
+        @parallel: int, create an empty appender file and extend it to the file
+            size, then upload ranges of the file concurrently by modify over that
+            many connections, the result has an extra key 'Throughput'
+        @resume: bool, append the file by chunks and record the progress in a
+            journal file next to it, so that a failed upload is continued from
+            the size on storage server by calling again, instead of starting over
         @return dict {
             'Group name'      : group_name,
             'Remote file_id'  : remote_file_id,
             'Status'          : 'Upload successed.',
             'Local file name' : '',
             'Uploaded size'   : upload_size,
+            'Resumed from'    : size on storage server before, only if resume
             'Storage IP'      : storage_ip
         } if success else None
         """
         self._check_file(local_filename, "(uploading appender)")
+        if resume:
+            if parallel > 1:
+                raise DataError("[-] Error: can not resume a parallel upload.")
+            return self._upload_resumable(local_filename, meta_dict)
         tc = TrackerClient(self.tracker_pool)
         store_serv = tc.tracker_query_storage_stor_without_group()
-        store = StorageClient(store_serv.ip_addr, store_serv.port, self.timeout)
-        return store.storage_upload_appender_by_filename(
-            tc, store_serv, local_filename, meta_dict
+        if parallel > 1:
+            return self._upload_parallel(
+                tc, store_serv, local_filename, meta_dict, parallel
+            )
+        with self._open_storage(store_serv) as store:
+            return store.storage_upload_appender_by_filename(
+                tc, store_serv, local_filename, meta_dict
+            )
+
+    def _upload_parallel(
+        self, tc, store_serv, local_filename, meta_dict, parallel
+    ) -> dict:
+        started_at = time.monotonic()
+        file_size = os.stat(local_filename).st_size
+        with self._open_storage(store_serv) as store:
+            ret = store.storage_upload_appender_by_buffer(
+                tc, store_serv, b"", meta_dict, get_file_ext_name(str(local_filename))
+            )
+        appender_filename = ret["Remote file_id"].split("/", 1)[1]
+
+        def upload_range(position: int, size: int) -> int:
+            with self._open_storage(store_serv) as store:
+                store.storage_modify_by_range(
+                    tc, store_serv, local_filename, position, size, appender_filename
+                )
+            return size
+
+        try:
+            with self._open_storage(store_serv) as store:
+                store.storage_truncate_file(
+                    tc, store_serv, file_size, appender_filename
+                )
+            ranges = self._split_ranges(file_size, parallel)
+            with ThreadPoolExecutor(
+                len(ranges), thread_name_prefix="fdfs-upload"
+            ) as pool:
+                futures = [pool.submit(upload_range, *r) for r in ranges if r[1]]
+                try:
+                    uploaded_size = sum(f.result() for f in futures)
+                except BaseException:
+                    for f in futures:
+                        f.cancel()
+                    raise
+        except BaseException:
+            # Do not leave a partial file behind
+            with self._open_storage(store_serv) as store:
+                with contextlib.suppress(ConnectionError, DataError):
+                    store.storage_delete_file(tc, store_serv, appender_filename)
+            raise
+        throughput = uploaded_size / max(time.monotonic() - started_at, 1e-6)
+        ret["Local file name"] = str(local_filename)
+        ret["Uploaded size"] = appromix(uploaded_size)
+        ret["Throughput"] = appromix(throughput) + "/s"
+        logger.info(
+            f"Uploaded {local_filename} by {len(futures)} connections: {throughput=:.0f}"
         )
+        return ret
+
+    def _upload_resumable(self, local_filename, meta_dict) -> dict:
+        stat = os.stat(local_filename)
+        journal_path = Path(f"{local_filename}{self.journal_suffix}")
+        tc = TrackerClient(self.tracker_pool)
+        resumed_from = 0
+        # The appender file is continued only if local file is not changed since then
+        journal = self._read_journal(journal_path)
+        if journal and journal.get("appender") is not True:
+            journal = None  # not an upload, e.g.: downloading to the same name
+        if journal and (journal.get("size"), journal.get("mtime_ns")) == (
+            stat.st_size,
+            stat.st_mtime_ns,
+        ):
+            group_name, appender_filename = journal["remote_file_id"].split("/", 1)
+            store_serv = tc.tracker_query_storage_update(group_name, appender_filename)
+            with self._open_storage(store_serv) as store:
+                try:
+                    info = store.storage_query_file_info(store_serv, appender_filename)
+                except DataError as e:
+                    logger.warning(f"[-] Failed to resume {journal_path}: {e}")
+                    journal = None
+                else:
+                    resumed_from = info["File size"]
+                    if resumed_from > stat.st_size:
+                        # Not an upload of this file, which is of no use
+                        store.storage_delete_file(
+                            tc, store_serv, appender_filename.encode()
+                        )
+                        journal, resumed_from = None, 0
+        elif journal:
+            # Local file is changed, the uploaded part is of no use
+            self._delete_quietly(journal["remote_file_id"])
+            journal = None
+        if not journal:
+            store_serv = tc.tracker_query_storage_stor_without_group()
+            with self._open_storage(store_serv) as store:
+                ret = store.storage_upload_appender_by_buffer(
+                    tc,
+                    store_serv,
+                    b"",
+                    meta_dict,
+                    get_file_ext_name(str(local_filename)),
+                )
+            group_name, appender_filename = ret["Remote file_id"].split("/", 1)
+            journal = {
+                "appender": True,
+                "remote_file_id": ret["Remote file_id"],
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "uploaded": 0,
+            }
+            journal_path.write_text(json.dumps(journal))
+        # Appending is acknowledged by chunks, a failed chunk is dropped by server
+        uploaded_size = resumed_from
+        with self._open_storage(store_serv) as store:
+            while uploaded_size < stat.st_size:
+                size = min(self.resume_chunk_size, stat.st_size - uploaded_size)
+                store.storage_append_by_range(
+                    tc,
+                    store_serv,
+                    local_filename,
+                    uploaded_size,
+                    size,
+                    appender_filename,
+                )
+                uploaded_size += size
+                journal["uploaded"] = uploaded_size
+                journal_path.write_text(json.dumps(journal))
+        journal_path.unlink(missing_ok=True)
+        ret = {
+            "Group name": group_name,
+            "Remote file_id": journal["remote_file_id"],
+            "Status": "Upload successed.",
+            "Local file name": str(local_filename),
+            "Uploaded size": appromix(stat.st_size - resumed_from),
+            "Resumed from": resumed_from,
+            "Storage IP": store_serv.ip_addr,
+        }
+        return ret
+
+    def _delete_quietly(self, remote_file_id) -> None:
+        """Delete a file which is not used any more, ignore errors."""
+        try:
+            self.delete_file(remote_file_id)
+        except (ConnectionError, DataError, ResponseError, TypeError) as e:
+            logger.debug(f"Failed to delete {remote_file_id}: {e}")
+
+    def _split_ranges(self, total_size: int, parallel: int) -> list[tuple[int, int]]:
+        """Split size into at most `parallel` ranges of (position, size), each one
+        is at least `parallel_min_range` bytes, which is not worth a connection."""
+        count = max(min(parallel, total_size // self.parallel_min_range), 1)
+        bounds = [total_size * i // count for i in range(count + 1)]
+        return [(bounds[i], bounds[i + 1] - bounds[i]) for i in range(count)]
 
     def upload_appender_by_file(self, local_filename, meta_dict=None):
         """
@@ -505,10 +1015,10 @@ class FastdfsClient(BaseClient):
         self._check_file(local_filename, "(uploading appender)")
         tc = TrackerClient(self.tracker_pool)
         store_serv = tc.tracker_query_storage_stor_without_group()
-        store = StorageClient(store_serv.ip_addr, store_serv.port, self.timeout)
-        return store.storage_upload_appender_by_file(
-            tc, store_serv, local_filename, meta_dict
-        )
+        with self._open_storage(store_serv) as store:
+            return store.storage_upload_appender_by_file(
+                tc, store_serv, local_filename, meta_dict
+            )
 
     def upload_appender_by_buffer(self, filebuffer, file_ext_name=None, meta_dict=None):
         """
@@ -530,10 +1040,10 @@ class FastdfsClient(BaseClient):
             raise DataError("[-] Error: argument filebuffer can not be null.")
         tc = TrackerClient(self.tracker_pool)
         store_serv = tc.tracker_query_storage_stor_without_group()
-        store = StorageClient(store_serv.ip_addr, store_serv.port, self.timeout)
-        return store.storage_upload_appender_by_buffer(
-            tc, store_serv, filebuffer, meta_dict, file_ext_name
-        )
+        with self._open_storage(store_serv) as store:
+            return store.storage_upload_appender_by_buffer(
+                tc, store_serv, filebuffer, meta_dict, file_ext_name
+            )
 
     def delete_file(self, remote_file_id: str) -> tuple[str, bytes, bytes]:
         """
@@ -548,10 +1058,18 @@ class FastdfsClient(BaseClient):
         group_name, remote_filename = tmp
         tc = TrackerClient(self.tracker_pool)
         store_serv = tc.tracker_query_storage_update(group_name, remote_filename)
-        store = StorageClient(store_serv.ip_addr, store_serv.port, self.timeout)
-        return store.storage_delete_file(tc, store_serv, remote_filename)
+        with self._open_storage(store_serv) as store:
+            return store.storage_delete_file(tc, store_serv, remote_filename)
 
-    def download_to_file(self, local_filename, remote_file_id, offset=0, down_bytes=0):
+    def download_to_file(
+        self,
+        local_filename,
+        remote_file_id,
+        offset=0,
+        down_bytes=0,
+        parallel=1,
+        resume=False,
+    ):
         """
         Download a file from Storage server.
         arguments:
@@ -559,10 +1077,15 @@ class FastdfsClient(BaseClient):
         @remote_file_id: string, file_id of file that is on storage server
         @offset: long
         @downbytes: long
+        @parallel: int, split the file into that many ranges and download them
+            concurrently, spread across the storage servers that keep the file
+        @resume: bool, continue a download that failed halfway, which is recorded
+            in a journal file next to local file, instead of starting over
         @return dict {
             'Remote file_id'  : remote_file_id,
             'Content'         : local_filename,
             'Download size'   : downloaded_size,
+            'Resumed from'    : size of local file before, only if resume
             'Storage IP'      : storage_ip
         }
         """
@@ -574,14 +1097,210 @@ class FastdfsClient(BaseClient):
         if offset:
             with contextlib.suppress(TypeError, ValueError):
                 file_offset = int(offset)
-        if not down_bytes:
-            download_bytes = int(down_bytes)
+        download_bytes = int(down_bytes or 0)
+        if resume:
+            if parallel > 1:
+                raise DataError("[-] Error: can not resume a parallel download.")
+            return self._download_resumable(
+                local_filename, group_name, remote_filename, file_offset, download_bytes
+            )
+        if parallel > 1 and hasattr(os, "pwrite"):
+            return self._download_parallel(
+                local_filename,
+                group_name,
+                remote_filename,
+                file_offset,
+                download_bytes,
+                parallel,
+            )
         tc = TrackerClient(self.tracker_pool)
         store_serv = tc.tracker_query_storage_fetch(group_name, remote_filename)
-        store = StorageClient(store_serv.ip_addr, store_serv.port, self.timeout)
-        return store.storage_download_to_file(
-            tc, store_serv, local_filename, file_offset, download_bytes, remote_filename
+        with self._open_storage(store_serv) as store:
+            return store.storage_download_to_file(
+                tc,
+                store_serv,
+                local_filename,
+                file_offset,
+                download_bytes,
+                remote_filename,
+            )
+
+    def _download_resumable(
+        self, local_filename, group_name, remote_filename, offset, down_bytes
+    ) -> dict:
+        tc = TrackerClient(self.tracker_pool)
+        store_serv = tc.tracker_query_storage_fetch(group_name, remote_filename)
+        journal_path = Path(f"{local_filename}{self.journal_suffix}")
+        with self._open_storage(store_serv) as store:
+            info = store.storage_query_file_info(store_serv, remote_filename)
+            end = info["File size"]
+            if down_bytes:
+                end = min(offset + down_bytes, end)
+            total_size = max(end - offset, 0)
+            # The partial file is continued only if it is of the same range of the
+            # same remote file, which is not changed since then
+            journal = {
+                "remote_file_id": f"{group_name}/{remote_filename}",
+                "offset": offset,
+                "size": total_size,
+                "create_timestamp": info["Create timestamp"],
+                "crc32": info["CRC32"],
+            }
+            fd = os.open(local_filename, os.O_WRONLY | os.O_CREAT, 0o666)
+            try:
+                resumed_from = os.fstat(fd).st_size
+                if (
+                    resumed_from > total_size
+                    or self._read_journal(journal_path) != journal
+                ):
+                    resumed_from = 0
+                    os.ftruncate(fd, 0)
+                    journal_path.write_text(json.dumps(journal))
+                if resumed_from < total_size:
+                    store.storage_download_range(
+                        store_serv,
+                        remote_filename,
+                        fd,
+                        resumed_from,
+                        offset + resumed_from,
+                        total_size - resumed_from,
+                    )
+                if (file_size := os.fstat(fd).st_size) != total_size:
+                    msg = f"[-] Error: expect {total_size} bytes, got {file_size}"
+                    raise DataError(msg)
+            finally:
+                os.close(fd)
+        journal_path.unlink(missing_ok=True)
+        return {
+            "Remote file_id": store_serv.group_name + b"/" + remote_filename.encode(),
+            "Content": local_filename,
+            "Download size": appromix(total_size - resumed_from),
+            "Resumed from": resumed_from,
+            "Storage IP": store_serv.ip_addr,
+        }
+
+    @staticmethod
+    def _read_journal(path: Path) -> dict | None:
+        try:
+            return json.loads(path.read_bytes())
+        except (OSError, ValueError):
+            return None
+
+    def _download_parallel(
+        self, local_filename, group_name, remote_filename, offset, down_bytes, parallel
+    ) -> dict:
+        tc = TrackerClient(self.tracker_pool)
+        replicas = tc.tracker_query_storage_fetch_all(group_name, remote_filename)
+        info = self._on_replicas(
+            replicas,
+            0,
+            lambda store, serv: store.storage_query_file_info(serv, remote_filename),
         )
+        end = info["File size"]
+        if down_bytes:
+            end = min(offset + down_bytes, end)
+        total_size = max(end - offset, 0)
+        ranges = self._split_ranges(total_size, parallel)
+
+        def download_range(index: int, position: int, size: int) -> int:
+            return self._on_replicas(
+                replicas,
+                index,
+                lambda store, serv: store.storage_download_range(
+                    serv, remote_filename, fd, position, offset + position, size
+                ),
+            )
+
+        fd = os.open(local_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            try:
+                preallocate(fd, total_size)
+                with ThreadPoolExecutor(
+                    len(ranges), thread_name_prefix="fdfs-download"
+                ) as pool:
+                    futures = [
+                        pool.submit(download_range, i, *r)
+                        for i, r in enumerate(ranges)
+                        if r[1]
+                    ]
+                    try:
+                        total_recv_size = sum(f.result() for f in futures)
+                    except BaseException:
+                        for f in futures:
+                            f.cancel()
+                        raise
+            finally:
+                os.close(fd)
+            # Ranges are written out of order, the file is checked when assembled
+            if self.verify_crc32 and total_size == info["File size"]:
+                self._verify_file_crc32(local_filename, remote_filename, info)
+        except BaseException:
+            # Not to leave a file of full size, which looks like downloaded
+            with contextlib.suppress(OSError):
+                os.unlink(local_filename)
+            raise
+        return {
+            "Remote file_id": replicas[0].group_name + b"/" + remote_filename.encode(),
+            "Content": local_filename,
+            "Download size": appromix(total_recv_size),
+            "Storage IP": replicas[0].ip_addr,
+        }
+
+    @staticmethod
+    def _verify_file_crc32(local_filename, remote_filename, info: dict) -> None:
+        """Raise DataError if CRC32 of local file is not the one of file info."""
+        checksum = Crc32()
+        with open(local_filename, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                checksum.update(chunk)
+        # It may be sign extended to 8 bytes by server
+        if (crc32 := info["CRC32"] & 0xFFFFFFFF) != checksum.value:
+            msg = "[-] Error: CRC32 of %r is %08X, but %08X on server." % (
+                remote_filename,
+                checksum.value,
+                crc32,
+            )
+            raise DataError(msg)
+
+    def _on_replicas(
+        self,
+        replicas: list[StorageServer],
+        index: int,
+        func: Callable[[StorageClient, StorageServer], T],
+    ) -> T:
+        """Call func with the `index`th replica(round robin), or the next ones
+        if it can not be reached, so that calls are spread across replicas."""
+        error = ConnectionError("[-] Error: no storage replicas are available.")
+        for i in range(len(replicas)):
+            store_serv = replicas[(index + i) % len(replicas)]
+            try:
+                with self._open_storage(store_serv) as store:
+                    return func(store, store_serv)
+            except ConnectionError as e:
+                logger.warning(f"[-] Failed to use {store_serv.ip_addr!r}: {e}")
+                error = e
+        raise error
+
+    def query_file_info(self, remote_file_id) -> dict:
+        """
+        Query file size, create timestamp and CRC32 of file from storage server.
+        arguments:
+        @remote_file_id: string, file_id of file that is on storage server
+        @return dict {
+            'File size'        : int,
+            'Create timestamp' : int,
+            'CRC32'            : int,
+            'Source IP'        : bytes
+        }
+        """
+        tmp = split_remote_fileid(remote_file_id)
+        if not tmp:
+            raise DataError("[-] Error: remote_file_id is invalid.(in query file info)")
+        group_name, remote_filename = tmp
+        tc = TrackerClient(self.tracker_pool)
+        store_serv = tc.tracker_query_storage_fetch(group_name, remote_filename)
+        with self._open_storage(store_serv) as store:
+            return store.storage_query_file_info(store_serv, remote_filename)
 
     def download_to_buffer(self, remote_file_id, offset=0, down_bytes=0):
         """
@@ -605,16 +1324,53 @@ class FastdfsClient(BaseClient):
         if offset:
             with contextlib.suppress(TypeError, ValueError):
                 file_offset = int(offset)
-        if not down_bytes:
-            download_bytes = int(down_bytes)
+        download_bytes = int(down_bytes or 0)
         tc = TrackerClient(self.tracker_pool)
         store_serv = tc.tracker_query_storage_fetch(group_name, remote_filename)
-        store = StorageClient(store_serv.ip_addr, store_serv.port, self.timeout)
         file_buffer = None
-        return store.storage_download_to_buffer(
-            tc, store_serv, file_buffer, file_offset, download_bytes, remote_filename
+        with self._open_storage(store_serv) as store:
+            return store.storage_download_to_buffer(
+                tc,
+                store_serv,
+                file_buffer,
+                file_offset,
+                download_bytes,
+                remote_filename,
+            )
+
+    def iter_download(
+        self, remote_file_id, chunk_size=None, offset=0, length=0
+    ) -> Iterator[bytes]:
+        """
+        Download a file from Storage server by chunks, the memory usage is
+        constant regardless of file size, e.g.: to proxy it to HTTP clients.
+        The connection returns to pool when the iterator is fully consumed,
+        and is closed if the iterator is abandoned.
+        arguments:
+        @remote_file_id: string, file_id of file that is on storage server
+        @chunk_size: int, max size of chunk, adapt to socket buffer if None
+        @offset: int
+        @length: int, bytes to download, 0 means to the end of file
+        @return iterator of bytes
+        """
+        tmp = split_remote_fileid(remote_file_id)
+        if not tmp:
+            raise DataError("[-] Error: remote_file_id is invalid.(in download file)")
+        group_name, remote_filename = tmp
+        return self._iter_download(
+            group_name, remote_filename, chunk_size, offset, length
         )
 
+    def _iter_download(
+        self, group_name, remote_filename, chunk_size, offset, length
+    ) -> Generator[bytes, None, None]:
+        tc = TrackerClient(self.tracker_pool)
+        store_serv = tc.tracker_query_storage_fetch(group_name, remote_filename)
+        with self._open_storage(store_serv) as store:
+            yield from store.storage_iter_download(
+                store_serv, remote_filename, offset, length, chunk_size
+            )
+
     def list_one_group(self, group_name):
         """
         List one group information.
@@ -662,8 +1418,8 @@ class FastdfsClient(BaseClient):
         group_name, remote_filename = tmp
         tc = TrackerClient(self.tracker_pool)
         store_serv = tc.tracker_query_storage_update(group_name, remote_filename)
-        store = StorageClient(store_serv.ip_addr, store_serv.port, self.timeout)
-        return store.storage_get_metadata(tc, store_serv, remote_filename)
+        with self._open_storage(store_serv) as store:
+            return store.storage_get_metadata(tc, store_serv, remote_filename)
 
     def set_meta_data(
         self, remote_file_id, meta_dict, op_flag=STORAGE_SET_METADATA_FLAG_OVERWRITE
@@ -686,10 +1442,10 @@ class FastdfsClient(BaseClient):
         tc = TrackerClient(self.tracker_pool)
         try:
             store_serv = tc.tracker_query_storage_update(group_name, remote_filename)
-            store = StorageClient(store_serv.ip_addr, store_serv.port, self.timeout)
-            status = store.storage_set_metadata(
-                tc, store_serv, remote_filename, meta_dict
-            )
+            with self._open_storage(store_serv) as store:
+                status = store.storage_set_metadata(
+                    tc, store_serv, remote_filename, meta_dict
+                )
         except (ConnectionError, ResponseError, DataError):
             raise
         if status == 2:
@@ -711,10 +1467,10 @@ class FastdfsClient(BaseClient):
         group_name, appended_filename = tmp
         tc = TrackerClient(self.tracker_pool)
         store_serv = tc.tracker_query_storage_update(group_name, appended_filename)
-        store = StorageClient(store_serv.ip_addr, store_serv.port, self.timeout)
-        return store.storage_append_by_filename(
-            tc, store_serv, local_filename, appended_filename
-        )
+        with self._open_storage(store_serv) as store:
+            return store.storage_append_by_filename(
+                tc, store_serv, local_filename, appended_filename
+            )
 
     def append_by_file(self, local_filename, remote_fileid):
         self._check_file(local_filename, "(append)")
@@ -724,10 +1480,10 @@ class FastdfsClient(BaseClient):
         group_name, appended_filename = tmp
         tc = TrackerClient(self.tracker_pool)
         store_serv = tc.tracker_query_storage_update(group_name, appended_filename)
-        store = StorageClient(store_serv.ip_addr, store_serv.port, self.timeout)
-        return store.storage_append_by_file(
-            tc, store_serv, local_filename, appended_filename
-        )
+        with self._open_storage(store_serv) as store:
+            return store.storage_append_by_file(
+                tc, store_serv, local_filename, appended_filename
+            )
 
     def append_by_buffer(self, file_buffer, remote_fileid):
         if not file_buffer:
@@ -738,10 +1494,10 @@ class FastdfsClient(BaseClient):
         group_name, appended_filename = tmp
         tc = TrackerClient(self.tracker_pool)
         store_serv = tc.tracker_query_storage_update(group_name, appended_filename)
-        store = StorageClient(store_serv.ip_addr, store_serv.port, self.timeout)
-        return store.storage_append_by_buffer(
-            tc, store_serv, file_buffer, appended_filename
-        )
+        with self._open_storage(store_serv) as store:
+            return store.storage_append_by_buffer(
+                tc, store_serv, file_buffer, appended_filename
+            )
 
     def truncate_file(self, truncated_filesize, appender_fileid):
         """
@@ -761,10 +1517,10 @@ class FastdfsClient(BaseClient):
         group_name, appender_filename = tmp
         tc = TrackerClient(self.tracker_pool)
         store_serv = tc.tracker_query_storage_update(group_name, appender_filename)
-        store = StorageClient(store_serv.ip_addr, store_serv.port, self.timeout)
-        return store.storage_truncate_file(
-            tc, store_serv, trunc_filesize, appender_filename
-        )
+        with self._open_storage(store_serv) as store:
+            return store.storage_truncate_file(
+                tc, store_serv, trunc_filesize, appender_filename
+            )
 
     def modify_by_filename(self, filename, appender_fileid, offset=0):
         """
@@ -790,10 +1546,10 @@ class FastdfsClient(BaseClient):
                 file_offset = int(offset)
         tc = TrackerClient(self.tracker_pool)
         store_serv = tc.tracker_query_storage_update(group_name, appender_filename)
-        store = StorageClient(store_serv.ip_addr, store_serv.port, self.timeout)
-        return store.storage_modify_by_filename(
-            tc, store_serv, filename, file_offset, filesize, appender_filename
-        )
+        with self._open_storage(store_serv) as store:
+            return store.storage_modify_by_filename(
+                tc, store_serv, filename, file_offset, filesize, appender_filename
+            )
 
     def modify_by_file(self, filename, appender_fileid, offset=0):
         """
@@ -819,10 +1575,10 @@ class FastdfsClient(BaseClient):
                 file_offset = int(offset)
         tc = TrackerClient(self.tracker_pool)
         store_serv = tc.tracker_query_storage_update(group_name, appender_filename)
-        store = StorageClient(store_serv.ip_addr, store_serv.port, self.timeout)
-        return store.storage_modify_by_file(
-            tc, store_serv, filename, file_offset, filesize, appender_filename
-        )
+        with self._open_storage(store_serv) as store:
+            return store.storage_modify_by_file(
+                tc, store_serv, filename, file_offset, filesize, appender_filename
+            )
 
     def modify_by_buffer(self, filebuffer, appender_fileid, offset=0):
         """
@@ -849,14 +1605,19 @@ class FastdfsClient(BaseClient):
                 file_offset = int(offset)
         tc = TrackerClient(self.tracker_pool)
         store_serv = tc.tracker_query_storage_update(group_name, appender_filename)
-        store = StorageClient(store_serv.ip_addr, store_serv.port, self.timeout)
-        return store.storage_modify_by_buffer(
-            tc, store_serv, filebuffer, file_offset, filesize, appender_filename
-        )
+        with self._open_storage(store_serv) as store:
+            return store.storage_modify_by_buffer(
+                tc, store_serv, filebuffer, file_offset, filesize, appender_filename
+            )
 
-    @property
+    @cached_property
     def async_client(self) -> "AsyncDfsClient":
-        return AsyncDfsClient(self.trackers, self.ip_mapping, self.ssl)
+        return AsyncDfsClient(
+            self.trackers,
+            self.ip_mapping,
+            self.ssl,
+            self.pool_kwargs.get("socket_options"),
+        )
 
     async def upload(self, content: bytes, suffix=".jpg") -> str:
         return await self.async_client.upload(content, suffix)
@@ -1,25 +1,151 @@
+import contextlib
 import operator
 import os
 import random
 import socket
-from contextlib import contextmanager
+import struct
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
 from itertools import chain
-from typing import Callable, Generator
+from typing import AsyncGenerator, Callable, Generator, cast
 
-from .exceptions import ConnectionError, ResponseError
+import anyio
+import anyio.lowlevel
+from anyio.abc import SocketAttribute, SocketStream
+
+from .exceptions import ConnectionError, PoolExhaustedError, ResponseError
+from .protols import (
+    FDFS_PROTO_CMD_ACTIVE_TEST,
+    Crc32,
+    SocketOptions,
+    TrackerHeader,
+    connect_tcp,
+    recv_into_exactly,
+)
 from .utils import logger
 
 
+@dataclass
+class HostHealth:
+    failures: int = 0  # consecutive failures
+    open_until: float = 0.0  # time.monotonic() that circuit keeps open until
+    probing: bool = False  # whether a half-open probe is in progress
+    latency: float | None = None  # EWMA of connect/response seconds
+
+
+class HostSelector:
+    """Choose host to connect, the healthy ones first(circuit breaker).
+
+    After `max_failures` consecutive failures, the circuit of a host is opened,
+    and it will not be chosen in `cooldown` seconds. Then one connection is
+    allowed to probe it(half-open), the circuit is closed again if success.
+
+    Among the healthy hosts, the faster one of two random choices is taken,
+    by the exponentially weighted moving average(`alpha`) of latency.
+    """
+
+    def __init__(self, max_failures=1, cooldown=10.0, alpha=0.3) -> None:
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self._hosts: dict[tuple[str, int], HostHealth] = {}
+
+    def health(self, host: str, port: int) -> HostHealth:
+        with self._lock:
+            return self._hosts.setdefault((host, port), HostHealth())
+
+    def choose(self, hosts, port: int) -> str:
+        now = time.monotonic()
+        healthy, half_open = [], []
+        with self._lock:
+            for host in hosts:
+                st = self._hosts.setdefault((host, port), HostHealth())
+                if st.failures < self.max_failures:
+                    healthy.append(host)
+                elif st.open_until <= now and not st.probing:
+                    half_open.append(host)
+            if half_open:
+                host = random.choice(half_open)
+                self._hosts[(host, port)].probing = True
+                return host
+            if len(healthy) > 2:
+                healthy = random.sample(healthy, 2)
+            if healthy:
+                # Host never measured comes first, so that it gets a latency
+                return min(healthy, key=lambda h: self._hosts[(h, port)].latency or 0.0)
+            # All hosts are down, try the one which will be recovered soonest
+            return min(hosts, key=lambda h: self._hosts[(h, port)].open_until)
+
+    def success(self, host: str, port: int, latency: float | None = None) -> None:
+        with self._lock:
+            st = self._hosts.setdefault((host, port), HostHealth())
+            st.failures, st.open_until, st.probing = 0, 0.0, False
+            self._observe(st, latency)
+
+    def observe(self, host: str, port: int, latency: float) -> None:
+        """Record a response latency(seconds) of the host."""
+        with self._lock:
+            self._observe(self._hosts.setdefault((host, port), HostHealth()), latency)
+
+    def _observe(self, st: HostHealth, latency: float | None) -> None:
+        if latency is None:
+            return
+        if st.latency is None:
+            st.latency = latency
+        else:
+            st.latency += self.alpha * (latency - st.latency)
+
+    def cancel_probe(self, host: str, port: int) -> None:
+        """Allow another probe of the host, as this one ends without a result."""
+        with self._lock:
+            if (st := self._hosts.get((host, port))) is not None:
+                st.probing = False
+
+    def failure(self, host: str, port: int) -> None:
+        with self._lock:
+            st = self._hosts.setdefault((host, port), HostHealth())
+            st.failures += 1
+            st.probing = False
+            if st.failures >= self.max_failures:
+                st.open_until = time.monotonic() + self.cooldown
+                logger.warning(f"[-] {host}:{port} is unhealthy, skip it for a while")
+
+
 class Connection:
     """Manage TCP comunication to and from Fastdfs Server."""
 
-    def __init__(self, host_tuple, port, timeout, **kwargs) -> None:
+    def __init__(
+        self,
+        host_tuple,
+        port,
+        timeout,
+        selector: HostSelector | None = None,
+        socket_options: SocketOptions | None = None,
+        **kwargs,
+    ) -> None:
         self.host_tuple = host_tuple
         self.remote_port = port
         self.timeout = timeout
+        self.selector = selector
+        self.socket_options = socket_options or SocketOptions()
         self.pid = os.getpid()
-        self.remote_addr = None
-        self._sock = None
+        self.remote_addr: str | None = None
+        self._sock: socket.socket | None = None
+        self.created_at = self.last_used = 0.0  # time.monotonic()
+
+    @classmethod
+    def from_socket(cls, sock: socket.socket, timeout=None) -> "Connection":
+        """Wrap a connected socket, e.g.: one end of `socket.socketpair()`."""
+        conn = cls(("",), 0, timeout)
+        conn._sock = sock
+        conn.created_at = conn.last_used = time.monotonic()
+        return conn
 
     def __del__(self):
         try:
@@ -27,27 +153,54 @@ class Connection:
         except Exception as e:
             logger.debug(f"disconnect error: {e}")
 
-    def connect(self):
-        """Connect to fdfs server."""
+    def connect(self, timeout: float | None = None):
+        """Connect to fdfs server, `timeout` is for connecting only(if given)."""
         if self._sock:
             return
+        started_at = time.monotonic()
         try:
-            self._sock = self._connect()
+            self._sock = self._connect(timeout)
         except socket.error as e:
+            if self.selector is not None and self.remote_addr is not None:
+                self.selector.failure(self.remote_addr, self.remote_port)
             raise ConnectionError(self._errormessage(e)) from e
+        except BaseException:
+            if self.selector is not None and self.remote_addr is not None:
+                self.selector.cancel_probe(self.remote_addr, self.remote_port)
+            raise
+        self.created_at = self.last_used = time.monotonic()
+        if self.selector is not None:
+            self.selector.success(
+                cast(str, self.remote_addr),
+                self.remote_port,
+                self.created_at - started_at,
+            )
         # print '[+] Create a connection success.'
         # print '\tLocal address is %s:%s.' % self._sock.getsockname()
         # print '\tRemote address is %s:%s' % (self.remote_addr, self.remote_port)
 
-    def _connect(self):
-        """Create TCP socket. The host is random one of host_tuple."""
-        self.remote_addr = random.choice(self.host_tuple)
+    def _connect(self, timeout: float | None = None):
+        """Create TCP socket. The host is one of host_tuple, healthy one first."""
+        if self.selector is None:
+            self.remote_addr = random.choice(self.host_tuple)
+        else:
+            self.remote_addr = self.selector.choose(self.host_tuple, self.remote_port)
         # print '[+] Connecting... remote: %s:%s' % (self.remote_addr, self.remote_port)
         # sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # sock.settimeout(self.timeout)
+        connect_timeout = self.timeout
+        if timeout is not None and (not self.timeout or timeout < self.timeout):
+            connect_timeout = timeout
         sock = socket.create_connection(
-            (self.remote_addr, self.remote_port), self.timeout
+            (self.remote_addr, self.remote_port), connect_timeout
         )
+        try:
+            self.socket_options.apply(sock)
+        except BaseException:
+            sock.close()
+            raise
+        if connect_timeout != self.timeout:
+            sock.settimeout(self.timeout)
         return sock
 
     def disconnect(self) -> None:
@@ -60,9 +213,46 @@ class Connection:
             raise ConnectionError(self._errormessage(e)) from e
         self._sock = None
 
+    def detach(self) -> None:
+        """Drop the socket inherited from the parent process after fork.
+        Only the file descriptor of this process is closed, without shutdown,
+        so the connection of the parent process keeps working.
+        """
+        sock, self._sock = self._sock, None
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError as e:
+                logger.debug(f"detach error: {e}")
+
     def get_sock(self):
         return self._sock
 
+    def observe_latency(self, seconds: float) -> None:
+        """Record the response latency to choose faster host next time."""
+        if self.selector is not None and self.remote_addr is not None:
+            self.selector.observe(self.remote_addr, self.remote_port, seconds)
+
+    def active_test(self, timeout: float | None = None) -> bool:
+        """Check whether the server is still there by FDFS_PROTO_CMD_ACTIVE_TEST,
+        `timeout` is used for this round trip only.
+        """
+        if self._sock is None:
+            return False
+        th = TrackerHeader(cmd=FDFS_PROTO_CMD_ACTIVE_TEST)
+        try:
+            if timeout is not None:
+                self._sock.settimeout(timeout)
+            th.send_header(self)
+            th.recv_header(self)
+        except (ConnectionError, struct.error) as e:
+            logger.debug(f"Active test failed: {e}")
+            return False
+        finally:
+            if timeout is not None and self._sock is not None:
+                self._sock.settimeout(self.timeout)
+        return th.status == 0
+
     def _errormessage(self, exception) -> str:
         # args for socket.error can either be (errno, "message")
         # or just "message" '''
@@ -81,113 +271,724 @@ class Connection:
             )
 
 
+@dataclass
+class PoolStats:
+    """Counters of a connection pool, e.g.: connects per request, wait time."""
+
+    requests: int = 0  # times of get_connection
+    connects: int = 0  # TCP connections opened
+    expired: int = 0  # connections closed for idle_timeout or max_lifetime
+    pings: int = 0  # active tests before reuse
+    dead: int = 0  # connections failed the active test or broken while using
+    waits: int = 0  # times of waiting for a free connection
+    wait_timeouts: int = 0  # times of no free connection until wait_timeout
+    wait_time: float = 0.0  # seconds of waiting in total
+    max_wait: float = 0.0  # seconds of the longest waiting
+
+    @property
+    def connects_per_request(self) -> float:
+        return self.connects / self.requests if self.requests else 0.0
+
+    @property
+    def avg_wait(self) -> float:
+        return self.wait_time / self.waits if self.waits else 0.0
+
+
+@dataclass
+class RetryPolicy:
+    """How to retry connecting: exponential backoff with full jitter.
+
+    The n-th retry sleeps a random time in [0, min(max_delay, base_delay * 2**n)],
+    and no more attempt is made after `deadline` seconds(None means no limit).
+    """
+
+    attempts: int = 10
+    base_delay: float = 0.05
+    max_delay: float = 1.0
+    deadline: float | None = None
+
+    def backoff(self, retries: int) -> float:
+        """Seconds to sleep before the `retries`-th retry(starts from 0)."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**retries))
+
+
 class ConnectionPool:
-    """Generic Connection Pool"""
+    """Generic Connection Pool
+
+    It is safe to be shared by threads. When `max_conn` connections are in use,
+    get_connection raises ConnectionError immediately by default, or waits at
+    most `wait_timeout` seconds(None means forever) for a free one if `block`.
+
+    Connections idle longer than `idle_timeout` seconds or opened longer than
+    `max_lifetime` seconds are not reused. They are also closed in background
+    every `reap_interval` seconds, which defaults to half of the smaller limit,
+    and 0 means no background reaping.
+
+    If `ping_idle` is set, a connection idle longer than `ping_idle` seconds
+    (0 means always) is checked by FDFS_PROTO_CMD_ACTIVE_TEST before reused,
+    waiting at most `ping_timeout` seconds. Dead one is replaced silently.
+
+    New connections go to the healthy hosts by `selector`, which can be shared.
+    Failed connecting is retried by `retry`, see RetryPolicy for details.
+    """
 
     def __init__(
-        self, name="", conn_class=Connection, max_conn=None, **conn_kwargs
+        self,
+        name="",
+        conn_class=Connection,
+        max_conn=None,
+        block=False,
+        wait_timeout: float | None = None,
+        idle_timeout: float | None = None,
+        max_lifetime: float | None = None,
+        reap_interval: float | None = None,
+        ping_idle: float | None = None,
+        ping_timeout: float | None = None,
+        selector: HostSelector | None = None,
+        retry: RetryPolicy | None = None,
+        fork_warm_up: int = 0,
+        **conn_kwargs,
     ) -> None:
         self.pool_name = name
         self.pid = os.getpid()
         self.conn_class = conn_class
         self.max_conn = max_conn or 2**31
+        self.block = block
+        self.wait_timeout = wait_timeout
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        if reap_interval is None:
+            limits = [i for i in (idle_timeout, max_lifetime) if i]
+            reap_interval = min(limits) / 2 if limits else 0
+        self.reap_interval = reap_interval
+        self.ping_idle = ping_idle
+        self.ping_timeout = ping_timeout
+        self.selector = selector or HostSelector()
+        self.retry = retry or RetryPolicy()
+        self.fork_warm_up = fork_warm_up
         self.conn_kwargs = conn_kwargs
+        self.stats = PoolStats()
         self._init()
+        if reap_interval:
+            _reaper.register(self)
+        _fork_aware_pools.add(self)
 
     def _init(self) -> None:
+        self._cond = threading.Condition()
         self._conns_created = 0
         self._conns_available: list[Connection] = []
         self._conns_inuse: set[Connection] = set()
 
     def _check_pid(self) -> None:
+        # Fallback of _after_fork_in_child, e.g.: the pool is unpickled in child
         if self.pid != os.getpid():
-            self.destroy()
-            self._init()
+            self._reset_after_fork()
+
+    def _reset_after_fork(self) -> None:
+        """Forget the connections of the parent process, and warm up a new
+        pool in background if `fork_warm_up` is set.
+        The lock may be held by a thread that does not exist in the child process,
+        so the state is dropped without acquiring it.
+        """
+        inherited = list(chain(self._conns_inuse, self._conns_available))
+        self.pid = os.getpid()
+        self.stats = PoolStats()
+        self._init()
+        for conn in inherited:
+            conn.detach()
+        if self.reap_interval:
+            _reaper.register(self)
+        if self.fork_warm_up > 0:
+            threading.Thread(
+                target=self.warm_up,
+                args=(self.fork_warm_up,),
+                name="fastdfs-pool-warm-up",
+                daemon=True,
+            ).start()
+
+    def _connect(self) -> Connection:
+        retry = self.retry
+        deadline = None
+        if retry.deadline is not None:
+            deadline = time.monotonic() + retry.deadline
+        error: ConnectionError | None = None
+        num_try = 0
+        while num_try < max(retry.attempts, 1):
+            if num_try:
+                delay = retry.backoff(num_try - 1)
+                if deadline is not None:
+                    delay = min(delay, deadline - time.monotonic())
+                if delay > 0:
+                    logger.debug(f"Retry to connect after {delay:.3f} seconds")
+                    time.sleep(delay)
+            timeout = None
+            if deadline is not None and (timeout := deadline - time.monotonic()) <= 0:
+                break
+            num_try += 1
+            conn_instance = self.conn_class(selector=self.selector, **self.conn_kwargs)
+            try:
+                conn_instance.connect(timeout)
+            except ConnectionError as e:
+                logger.debug(e)
+                error = e
+                continue
+            with self._cond:
+                self.stats.connects += 1
+            return conn_instance
+        logger.warning(f"[-] {self.pool_name}: failed to connect with {num_try} times")
+        raise ConnectionError(f"Failed to connect with {num_try} times") from error
+
+    def _new_conn(self) -> Connection:
+        """Connect with a slot that has been taken, give it back if failed."""
+        try:
+            return self._connect()
+        except BaseException:
+            with self._cond:
+                self._conns_created -= 1
+                self._cond.notify()
+            raise
 
     def make_conn(self) -> Connection:
         """Create a new connection."""
-        if self._conns_created >= self.max_conn:
-            raise ConnectionError("[-] Error: Too many connections.")
-        num_try = 10
-        for _ in range(num_try):
-            try:
-                conn_instance = self.conn_class(**self.conn_kwargs)
-                conn_instance.connect()
+        with self._cond:
+            if self._conns_created >= self.max_conn:
+                raise PoolExhaustedError("[-] Error: Too many connections.")
+            self._conns_created += 1
+        return self._new_conn()
+
+    def is_expired(self, conn: Connection, now: float | None = None) -> bool:
+        """Whether the connection is idle or opened too long to be reused."""
+        if now is None:
+            now = time.monotonic()
+        if self.idle_timeout is not None and now - conn.last_used > self.idle_timeout:
+            return True
+        return (
+            self.max_lifetime is not None and now - conn.created_at > self.max_lifetime
+        )
+
+    def warm_up(self, size: int) -> int:
+        """Open connections in parallel until `size` ones are available.
+        Return the amount of connections opened.
+        """
+        self._check_pid()
+        with self._cond:
+            size = min(
+                size - len(self._conns_available), self.max_conn - self._conns_created
+            )
+            if size <= 0:
+                return 0
+            self._conns_created += size
+        opened: list[Connection] = []
+        with ThreadPoolExecutor(max_workers=size) as executor:
+            for future in [executor.submit(self._new_conn) for _ in range(size)]:
+                try:
+                    opened.append(future.result())
+                except ConnectionError as e:
+                    logger.warning(f"[-] Failed to warm up {self.pool_name}: {e}")
+        with self._cond:
+            self._conns_available.extend(opened)
+            self._cond.notify_all()
+        return len(opened)
+
+    def _take(self, expired: list[Connection]) -> Connection | None:
+        """Pop an available connection, or take a slot for a new one(None).
+        Must be called with self._cond acquired, connections not to be reused
+        are moved to `expired`.
+        """
+        started_at = None
+        conn: Connection | None = None
+        while True:
+            while self._conns_available:
+                conn = self._conns_available.pop()
+                if not self.is_expired(conn):
+                    break
+                expired.append(conn)
+                self._conns_created -= 1
+                self.stats.expired += 1
+                conn = None
+            if conn is not None:
+                break
+            if self._conns_created < self.max_conn:
                 self._conns_created += 1
                 break
-            except ConnectionError as e:
-                logger.debug(e)
-        else:
-            raise ConnectionError(f"Failed to connect with {num_try} times")
-        return conn_instance
+            if not self.block:
+                raise PoolExhaustedError("[-] Error: Too many connections.")
+            if started_at is None:
+                started_at = time.monotonic()
+                self.stats.waits += 1
+            remaining = None
+            if self.wait_timeout is not None:
+                remaining = self.wait_timeout - (time.monotonic() - started_at)
+                if remaining <= 0:
+                    self._record_wait(started_at)
+                    self.stats.wait_timeouts += 1
+                    raise PoolExhaustedError(
+                        f"[-] Error: No free connection in {self.pool_name} "
+                        f"after waiting {self.wait_timeout} seconds."
+                    )
+            self._cond.wait(remaining)
+        if started_at is not None:
+            self._record_wait(started_at)
+        return conn
+
+    def _record_wait(self, started_at: float) -> None:
+        waited = time.monotonic() - started_at
+        self.stats.wait_time += waited
+        self.stats.max_wait = max(self.stats.max_wait, waited)
+
+    def _need_ping(self, conn: Connection) -> bool:
+        if self.ping_idle is None:
+            return False
+        return time.monotonic() - conn.last_used >= self.ping_idle
 
     def get_connection(self) -> Connection:
         """Get a connection from pool."""
         self._check_pid()
-        try:
-            conn = self._conns_available.pop()
-            # print '[+] Get a connection from pool %s.' % self.pool_name
-            # print '\tLocal address is %s:%s.' % conn._sock.getsockname()
-            # print '\tRemote address is %s:%s' % (conn.remote_addr, conn.remote_port)
-        except IndexError:
-            conn = self.make_conn()
-        self._conns_inuse.add(conn)
+        with self._cond:
+            self.stats.requests += 1
+        while True:
+            expired: list[Connection] = []
+            try:
+                with self._cond:
+                    conn = self._take(expired)
+                    if conn is not None:
+                        self._conns_inuse.add(conn)
+            finally:
+                self._close(expired)
+            if conn is None:
+                break
+            if not self._need_ping(conn):
+                return conn
+            with self._cond:
+                self.stats.pings += 1
+            if conn.active_test(self.ping_timeout):
+                return conn
+            self.discard(conn)
+        conn = self._new_conn()
+        with self._cond:
+            self._conns_inuse.add(conn)
         return conn
 
     @contextmanager
     def open_connection(self) -> Generator[Connection, None, None]:
+        """Borrow a connection, which goes back to the pool only if the block
+        exits without error, as a failed request may leave it half read."""
         conn = self.get_connection()
         try:
             yield conn
-        finally:
-            self.release(conn)
+        except BaseException:
+            self.discard(conn)
+            raise
+        self.release(conn)
+
+    def discard(self, conn) -> None:
+        """Remove a broken connection from pool and close it."""
+        with self._cond:
+            self.stats.dead += 1
+        self.remove(conn)
+        self._close([conn])
 
     def remove(self, conn) -> None:
         """Remove connection from pool."""
-        if conn in self._conns_inuse:
-            self._conns_inuse.remove(conn)
-            self._conns_created -= 1
-        if conn in self._conns_available:
-            self._conns_available.remove(conn)
-            self._conns_created -= 1
+        with self._cond:
+            if conn in self._conns_inuse:
+                self._conns_inuse.remove(conn)
+                self._conns_created -= 1
+            if conn in self._conns_available:
+                self._conns_available.remove(conn)
+                self._conns_created -= 1
+            self._cond.notify()
 
     def destroy(self) -> None:
         """Disconnect all connections in the pool."""
-        all_conns = chain(self._conns_inuse, self._conns_available)
+        with self._cond:
+            all_conns = list(chain(self._conns_inuse, self._conns_available))
         for conn in all_conns:
             conn.disconnect()
             # print '[-] Destroy connection pool %s.' % self.pool_name
 
+    @staticmethod
+    def _close(conns: list[Connection]) -> None:
+        for conn in conns:
+            try:
+                conn.disconnect()
+            except ConnectionError as e:
+                logger.debug(e)
+
+    def clear_idle(self) -> int:
+        """Disconnect the connections that are not in use, return the amount."""
+        with self._cond:
+            idle_conns = self._conns_available[:]
+            self._conns_available.clear()
+            self._conns_created -= len(idle_conns)
+            self._cond.notify_all()
+        self._close(idle_conns)
+        return len(idle_conns)
+
+    def reap(self) -> int:
+        """Disconnect the idle connections that are expired, return the amount."""
+        if self.pid != os.getpid():
+            return 0
+        now = time.monotonic()
+        with self._cond:
+            expired = [c for c in self._conns_available if self.is_expired(c, now)]
+            if expired:
+                self._conns_available = [
+                    c for c in self._conns_available if c not in expired
+                ]
+                self._conns_created -= len(expired)
+                self.stats.expired += len(expired)
+                self._cond.notify_all()
+        self._close(expired)
+        return len(expired)
+
     def release(self, conn) -> None:
         """Release the connection back to the pool."""
         self._check_pid()
         if conn.pid == self.pid:
-            self._conns_inuse.remove(conn)
-            self._conns_available.append(conn)
+            conn.last_used = now = time.monotonic()
+            with self._cond:
+                if conn not in self._conns_inuse:
+                    return
+                self._conns_inuse.remove(conn)
+                if self.max_lifetime is not None and (
+                    now - conn.created_at > self.max_lifetime
+                ):
+                    self._conns_created -= 1
+                    self.stats.expired += 1
+                else:
+                    self._conns_available.append(conn)
+                    conn = None
+                self._cond.notify()
+            if conn is not None:
+                self._close([conn])
             # print '[-] Release connection back to pool %s.' % self.pool_name
 
 
-def tcp_recv_response(conn, bytes_size, buffer_size=4096) -> tuple[bytes, int]:
+class _Reaper:
+    """A daemon thread that reaps expired connections of the registered pools."""
+
+    def __init__(self) -> None:
+        self._pools: weakref.WeakSet[ConnectionPool] = weakref.WeakSet()
+        self._reset()
+
+    def _reset(self) -> None:
+        # The thread is not copied by fork, it will be restarted by `register`
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self._wakeup = threading.Event()
+
+    def register(self, pool: ConnectionPool) -> None:
+        with self._lock:
+            self._pools.add(pool)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="fastdfs-pool-reaper", daemon=True
+                )
+                self._thread.start()
+            else:
+                self._wakeup.set()
+
+    def _run(self) -> None:
+        next_reap: weakref.WeakKeyDictionary[ConnectionPool, float] = (
+            weakref.WeakKeyDictionary()
+        )
+        while True:
+            wait = self._sweep(next_reap)
+            self._wakeup.wait(wait)
+            self._wakeup.clear()
+
+    def _sweep(
+        self, next_reap: "weakref.WeakKeyDictionary[ConnectionPool, float]"
+    ) -> float:
+        """Reap the pools that are due, return seconds to wait for the next one.
+        No pool is referenced after return, so that a dropped one is collected."""
+        now = time.monotonic()
+        wait = 60.0
+        for pool in list(self._pools):
+            interval = pool.reap_interval or 0
+            if not interval:
+                continue
+            due = next_reap.setdefault(pool, now + interval)
+            if due <= now:
+                try:
+                    pool.reap()
+                except Exception as e:
+                    logger.debug(f"Failed to reap {pool.pool_name}: {e}")
+                next_reap[pool] = due = now + interval
+            wait = min(wait, due - now)
+        return wait
+
+
+_reaper = _Reaper()
+_fork_aware_pools: weakref.WeakSet[ConnectionPool] = weakref.WeakSet()
+
+
+def _after_fork_in_child() -> None:
+    """Make sure that no socket is shared by the parent and child processes."""
+    _reaper._reset()
+    for pool in list(_fork_aware_pools):
+        try:
+            pool._reset_after_fork()
+        except Exception as e:
+            logger.debug(f"Failed to reset {pool.pool_name} after fork: {e}")
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class PoolRegistry:
+    """Connection pools keyed by (ip, port), live as long as the client.
+
+    At most `max_pools` pools are kept, the least recently used one will be
+    evicted when a new server comes.
+    """
+
+    def __init__(
+        self, max_pools=32, pool_class=ConnectionPool, name="Storage Pool", **kwargs
+    ) -> None:
+        self.max_pools = max_pools
+        self.pool_class = pool_class or ConnectionPool
+        self.pool_name = name
+        self.pool_kwargs = kwargs
+        self._lock = threading.Lock()
+        self._pools: OrderedDict[tuple[str, int], ConnectionPool] = OrderedDict()
+
+    @staticmethod
+    def _key(ip_addr: str | bytes, port: int) -> tuple[str, int]:
+        if isinstance(ip_addr, bytes):
+            ip_addr = ip_addr.decode()
+        return ip_addr, int(port)
+
+    def __len__(self) -> int:
+        return len(self._pools)
+
+    def __contains__(self, key: tuple[str, int]) -> bool:
+        return self._key(*key) in self._pools
+
+    def get(self, ip_addr: str | bytes, port: int) -> ConnectionPool:
+        """Get pool of the server, create it if not exists."""
+        key = self._key(ip_addr, port)
+        evicted: list[ConnectionPool] = []
+        with self._lock:
+            try:
+                pool = self._pools[key]
+            except KeyError:
+                pool = self.pool_class(
+                    name=self.pool_name,
+                    host_tuple=(key[0],),
+                    port=key[1],
+                    **self.pool_kwargs,
+                )
+                self._pools[key] = pool
+                while len(self._pools) > self.max_pools:
+                    evicted.append(self._pools.popitem(last=False)[1])
+            else:
+                self._pools.move_to_end(key)
+        for old in evicted:
+            # Connections in use will be closed when their pool is collected
+            old.clear_idle()
+        return pool
+
+    def discard(self, ip_addr: str | bytes, port: int) -> None:
+        """Drop the pool of a server which has gone away."""
+        with self._lock:
+            pool = self._pools.pop(self._key(ip_addr, port), None)
+        if pool is not None:
+            pool.clear_idle()
+
+    def stats(self) -> dict[tuple[str, int], PoolStats]:
+        return {key: pool.stats for key, pool in self._pools.items()}
+
+    def destroy(self) -> None:
+        """Disconnect all connections of all pools."""
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+        for pool in pools:
+            pool.destroy()
+
+
+class AsyncConnectionPool:
+    """Anyio streams to tracker and storage servers, reused by async calls.
+
+    At most `max_per_host` streams are opened to one server at the same time,
+    others wait for one of them. Idle streams are closed after `idle_timeout`.
+    A stream goes back to the pool only if the block exits without error, so the
+    one of a cancelled or failed request, which may be half-used, is closed.
+    Streams belong to one event loop, the pool is emptied if used by another one.
+    """
+
+    def __init__(
+        self,
+        max_per_host: int = 10,
+        idle_timeout: float | None = 30.0,
+        socket_options: SocketOptions | None = None,
+    ) -> None:
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.socket_options = socket_options
+        self.stats = PoolStats()
+        self._owner: tuple[int, object] | None = None
+        self._idle: dict[tuple[str, int], list[tuple[SocketStream, float]]] = {}
+        # Not CapacityLimiter, whose tokens belong to the borrowing task: a
+        # stream held by an async generator may be returned by another task.
+        self._limiters: dict[tuple[str, int], anyio.Semaphore] = {}
+        self._next_evict = 0.0
+
+    def _check_owner(self) -> None:
+        owner = (os.getpid(), anyio.lowlevel.current_token())
+        if owner != self._owner:
+            # Streams of another event loop or parent process can not be awaited
+            for streams in self._idle.values():
+                for stream, _ in streams:
+                    with contextlib.suppress(Exception):
+                        stream.extra(SocketAttribute.raw_socket).close()
+            self._owner = owner
+            self._idle.clear()
+            self._limiters.clear()
+
+    @staticmethod
+    def _is_clean(stream: SocketStream) -> bool:
+        """Whether the idle stream is still open and has nothing unread."""
+        if not hasattr(socket, "fromfd"):
+            return True  # cannot peek, a dead stream fails on the next request
+        sock = stream.extra(SocketAttribute.raw_socket)
+        try:
+            # asyncio only exposes a restricted socket, peek by a duplicated one
+            with socket.fromfd(sock.fileno(), sock.family, sock.type) as dup:
+                dup.setblocking(False)
+                dup.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            return True
+        except Exception as e:
+            logger.debug(f"Drop idle stream: {e}")
+            return False
+        return False  # closed by server, or unexpected data
+
+    async def _take(self, key: tuple[str, int]) -> SocketStream | None:
+        idle = self._idle.get(key)
+        while idle:
+            stream, _ = idle.pop()
+            if self._is_clean(stream):
+                return stream
+            self.stats.dead += 1
+            await anyio.aclose_forcefully(stream)
+        return None
+
+    async def _evict(self, now: float) -> None:
+        if self.idle_timeout is None or now < self._next_evict:
+            return
+        self._next_evict = now + self.idle_timeout / 2
+        expired: list[SocketStream] = []
+        for streams in self._idle.values():
+            alive = [(s, t) for s, t in streams if now - t <= self.idle_timeout]
+            expired.extend(s for s, t in streams if now - t > self.idle_timeout)
+            streams[:] = alive
+        self.stats.expired += len(expired)
+        for stream in expired:
+            await anyio.aclose_forcefully(stream)
+
+    @asynccontextmanager
+    async def connect(self, host: str, port: int) -> AsyncGenerator[SocketStream, None]:
+        """Borrow a stream to the server, open a new one if none is idle."""
+        self._check_owner()
+        key = (host, port)
+        if (limiter := self._limiters.get(key)) is None:
+            limiter = self._limiters[key] = anyio.Semaphore(self.max_per_host)
+        async with limiter:
+            await self._evict(time.monotonic())
+            self.stats.requests += 1
+            if (stream := await self._take(key)) is None:
+                stream = await connect_tcp(host, port, self.socket_options)
+                self.stats.connects += 1
+            reusable = False
+            try:
+                yield stream
+                reusable = True
+            finally:
+                if reusable:
+                    self._idle.setdefault(key, []).append((stream, time.monotonic()))
+                else:
+                    await anyio.aclose_forcefully(stream)
+
+    async def aclose(self) -> None:
+        """Close all idle streams."""
+        idle, self._idle = self._idle, {}
+        for streams in idle.values():
+            for stream, _ in streams:
+                await anyio.aclose_forcefully(stream)
+
+
+class DnsCache:
+    """Resolve domains to IPv4 by `anyio.getaddrinfo` without blocking the loop.
+
+    Answers are cached for `ttl` seconds. An expired answer is still returned
+    while it is refreshed by a background thread, so only the first lookup of
+    a domain waits for DNS, and a failed refresh keeps the old answer.
+    """
+
+    def __init__(self, ttl: float = 300.0) -> None:
+        self.ttl = ttl
+        self._answers: dict[str, tuple[str, float]] = {}
+        self._refreshing: set[str] = set()
+        self._lock = threading.Lock()
+
+    def _store(self, domain: str, ip_addr: str, ttl: float | None = None) -> None:
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._answers[domain] = (ip_addr, expires_at)
+
+    async def resolve(self, domain: str) -> str:
+        if (answer := self._answers.get(domain)) is None:
+            infos = await anyio.getaddrinfo(
+                domain, None, family=socket.AF_INET, type=socket.SOCK_STREAM
+            )
+            ip_addr = cast(str, infos[0][4][0])
+            self._store(domain, ip_addr)
+            return ip_addr
+        ip_addr, expires_at = answer
+        if expires_at <= time.monotonic():
+            self._refresh(domain)
+        return ip_addr
+
+    def _refresh(self, domain: str) -> None:
+        with self._lock:
+            if domain in self._refreshing:
+                return
+            self._refreshing.add(domain)
+        threading.Thread(
+            target=self._refresh_sync, args=(domain,), name="fastdfs-dns", daemon=True
+        ).start()
+
+    def _refresh_sync(self, domain: str) -> None:
+        try:
+            self._store(domain, socket.gethostbyname(domain))
+        except OSError as e:
+            logger.debug(f"Failed to refresh DNS of {domain}: {e}")
+            # Keep the old answer, and try again a little later
+            self._store(domain, self._answers[domain][0], min(self.ttl, 10))
+        finally:
+            with self._lock:
+                self._refreshing.discard(domain)
+
+
+def tcp_recv_response(
+    conn, bytes_size, buffer_size=4096, checksum: Crc32 | None = None
+) -> tuple[bytearray, int]:
     """Receive response from server.
     It is not include tracker header.
+    The buffer is allocated once by the known size and filled by `recv_into`.
     arguments:
     @conn: connection
     @bytes_size: int, will be received byte_stream size
-    @buffer_size: int, receive buffer size
+    @buffer_size: int, not used, kept for compatibility
+    @checksum: Crc32, updated by the received data if given
     @Return: tuple,(response, received_size)
     """
-    recv_buff = []
-    total_size = 0
-    try:
-        while bytes_size > 0:
-            resp = conn._sock.recv(buffer_size)
-            recv_buff.append(resp)
-            total_size += len(resp)
-            bytes_size -= len(resp)
-    except (socket.error, socket.timeout) as e:
-        msg = "[-] Error: while reading from socket: (%s)" % e.args
-        raise ConnectionError(msg) from e
-    return (b"".join(recv_buff), total_size)
+    recv_buff = bytearray(max(bytes_size, 0))
+    recv_into_exactly(conn._sock, memoryview(recv_buff), checksum)
+    return (recv_buff, len(recv_buff))
 
 
 async def tcp_receive(
@@ -198,23 +999,22 @@ async def tcp_receive(
     clsname="Tracker",
     *,
     buffer_size=4096,
-) -> bytes:
-    recv_bs = []
+) -> bytearray:
+    recv_buff = bytearray(max(bytes_size, 0))
     total_size = 0
-    while bytes_size > 0:
+    while total_size < bytes_size:
         try:
-            response = await client.receive(buffer_size)
-        except Exception as e:
-            logger.exception(e)
-        else:
-            recv_bs.append(response)
-            length = len(response)
-            total_size += length
-            bytes_size -= length
+            # Never read more than expected, the stream may be reused by the pool
+            response = await client.receive(min(buffer_size, bytes_size - total_size))
+        except (anyio.EndOfStream, anyio.BrokenResourceError, OSError) as e:
+            raise ConnectionError(f"[-] Error: while reading response: {e!r}") from e
+        length = len(response)
+        recv_buff[total_size : total_size + length] = response
+        total_size += length
     if expected_len is not None and not compare(total_size, expected_len):
         msg = f"[-] Error: {clsname} response length is not match, expect: {expected_len}, actual: {total_size}"
         raise ResponseError(msg)
-    return b"".join(recv_bs)
+    return recv_buff
 
 
 def tcp_send_data(conn, bytes_stream) -> None:
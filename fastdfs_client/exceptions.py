@@ -13,6 +13,10 @@ class ConnectionError(FDFSError):
     pass
 
 
+class PoolExhaustedError(ConnectionError):
+    """No connection of the pool is free, the server itself may be fine."""
+
+
 class ResponseError(FDFSError):
     pass
 
@@ -1,13 +1,20 @@
 import os
 import socket
 import struct
+import time
+import zlib
 from contextlib import asynccontextmanager
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, AsyncGenerator
 
 import anyio
+from anyio.abc import SocketAttribute, SocketStream
 
 from .exceptions import ConnectionError, DataError
 
+if TYPE_CHECKING:
+    from .connection import AsyncConnectionPool
+
 # define FDFS protol constans
 TRACKER_PROTO_CMD_STORAGE_JOIN = 81
 FDFS_PROTO_CMD_QUIT = 82
@@ -167,23 +174,164 @@ FDFS_STORAGE_STATUS_RECOVERY = 9
 FDFS_STORAGE_STATUS_NONE = 99
 
 
+@dataclass
+class SocketOptions:
+    """Options applied to every socket connected to tracker or storage server.
+
+    Nagle is disabled by default, as a request is written by several small
+    packets(header then body). None means to keep the system default.
+    Keepalive idle/interval/count are skipped if not supported by the platform.
+    """
+
+    tcp_nodelay: bool = True
+    sndbuf: int | None = None
+    rcvbuf: int | None = None
+    keepalive: bool = False
+    keepalive_idle: int | None = None
+    keepalive_interval: int | None = None
+    keepalive_count: int | None = None
+
+    def apply(self, sock: socket.socket) -> None:
+        if self.tcp_nodelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.sndbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        if self.rcvbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        if not self.keepalive:
+            return
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for name, value in (
+            # TCP_KEEPALIVE is the name of TCP_KEEPIDLE on macOS
+            (
+                "TCP_KEEPIDLE" if hasattr(socket, "TCP_KEEPIDLE") else "TCP_KEEPALIVE",
+                self.keepalive_idle,
+            ),
+            ("TCP_KEEPINTVL", self.keepalive_interval),
+            ("TCP_KEEPCNT", self.keepalive_count),
+        ):
+            if value is not None and (opt := getattr(socket, name, None)) is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, opt, value)
+
+
+async def connect_tcp(
+    host: str, port: int, socket_options: SocketOptions | None = None
+) -> SocketStream:
+    """Connect by anyio, then apply the socket options to the raw socket."""
+    client = await anyio.connect_tcp(host, port)
+    try:
+        (socket_options or SocketOptions()).apply(
+            client.extra(SocketAttribute.raw_socket)
+        )
+    except BaseException:
+        await client.aclose()
+        raise
+    return client
+
+
+@asynccontextmanager
+async def open_stream(
+    host: str,
+    port: int,
+    socket_options: SocketOptions | None = None,
+    pool: "AsyncConnectionPool | None" = None,
+) -> AsyncGenerator[SocketStream, None]:
+    """Borrow a stream from the pool if given, else open a new one."""
+    if pool is not None:
+        async with pool.connect(host, port) as client:
+            yield client
+    else:
+        async with await connect_tcp(host, port, socket_options) as client:
+            yield client
+
+
 @dataclass
 class StorageServer:
     """Class storage server for upload."""
 
     ip_addr: str = ""
     port: int = 0
-    group_name: str = ""
+    group_name: str | bytes = ""
     store_path_index: int = 0
+    socket_options: SocketOptions | None = field(
+        default=None, repr=False, compare=False
+    )
+    pool: "AsyncConnectionPool | None" = field(default=None, repr=False, compare=False)
 
     @asynccontextmanager
-    async def connect_tcp(self):
+    async def connect_tcp(self) -> AsyncGenerator[SocketStream, None]:
         if isinstance(ip_addr := self.ip_addr, bytes):
             ip_addr = ip_addr.decode()
-        async with await anyio.connect_tcp(ip_addr, self.port) as client:
+        async with open_stream(
+            ip_addr, self.port, self.socket_options, self.pool
+        ) as client:
             yield client
 
 
+# Bodies up to this size are joined with header by async send
+SMALL_BODY_SIZE = 64 * 1024
+
+
+def sendmsg_all(sock: socket.socket, buffers) -> None:
+    """Send all buffers by scatter-gather `sendmsg`, without joining them, so a
+    small request leaves in one system call. Partial sends are resumed.
+    """
+    views = [memoryview(b).cast("B") for b in buffers if len(b)]
+    if not hasattr(sock, "sendmsg"):  # Windows
+        for view in views:
+            sock.sendall(view)
+        return
+    while views:
+        sent = sock.sendmsg(views)
+        while sent and sent >= len(views[0]):
+            sent -= len(views.pop(0))
+        if sent:
+            views[0] = views[0][sent:]
+
+
+class Crc32:
+    """CRC32 of data that is sent or received by chunks, the same as FastDFS."""
+
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0
+
+    def update(self, data) -> None:
+        self.value = zlib.crc32(data, self.value)
+
+
+# Received data is added to checksum by windows, while it is still in CPU cache
+CHECKSUM_WINDOW = 256 * 1024
+
+
+def recv_into_exactly(
+    sock: socket.socket, view: memoryview, checksum: Crc32 | None = None
+) -> None:
+    """Fill the whole buffer from socket, without allocating for every chunk.
+    Slices of the buffer are released on error, so that a memory map under it
+    can be closed while the traceback is alive."""
+    if checksum is not None and len(view) > CHECKSUM_WINDOW:
+        for start in range(0, len(view), CHECKSUM_WINDOW):
+            with view[start : start + CHECKSUM_WINDOW] as window:
+                recv_into_exactly(sock, window, checksum)
+        return
+    received, size = 0, len(view)
+    while received < size:
+        try:
+            with view[received:] as rest:
+                n = sock.recv_into(rest)
+        except (socket.error, socket.timeout) as e:
+            msg = "[-] Error: while reading from socket: %s" % (e.args,)
+            raise ConnectionError(msg) from e
+        if n == 0:
+            msg = f"[-] Error: connection closed with {size - received} bytes unread"
+            raise ConnectionError(msg)
+        received += n
+    if checksum is not None:
+        checksum.update(view)
+
+
 class Struct(struct.Struct):
     def __repr__(self) -> str:
         return f"struct.Struct({self.format!r})"
@@ -205,6 +353,7 @@ class TrackerHeader:
     pkg_len: int = 0
     cmd: int = 0
     status: int = 0
+    sent_at: float = field(default=0.0, repr=False, compare=False)
 
     def _pack(self, pkg_len=0, cmd=0, status=0):
         return self.st.pack(pkg_len, cmd, status)
@@ -219,28 +368,50 @@ class TrackerHeader:
     def build_header(self) -> bytes:
         return self._pack(self.pkg_len, self.cmd, self.status)
 
-    def send_header(self, conn) -> None:
-        """Send Tracker header to server."""
+    def send_header(self, conn, *bodies) -> None:
+        """Send Tracker header to server, following by bodies(packed fields or
+        file content) in the same system call.
+        """
         header = self.build_header()
         try:
-            conn._sock.sendall(header)
+            sendmsg_all(conn._sock, (header, *bodies))
         except (socket.error, socket.timeout) as e:
             msg = "[-] Error: while writting to socket: %s" % (e.args,)
             raise ConnectionError(msg) from e
+        self.sent_at = time.monotonic()
+
+    async def send_header_async(self, client, *bodies) -> None:
+        """Send header and bodies by anyio stream, which has no `sendmsg`.
+        Small parts are joined to one send, large bodies are sent without copying.
+        """
+        parts: list = [self.build_header()]
+        for body in bodies:
+            if len(body) <= SMALL_BODY_SIZE:
+                parts.append(body)
+                continue
+            await client.send(b"".join(parts))
+            await client.send(body)
+            parts = []
+        if parts:
+            await client.send(b"".join(parts))
 
     def recv_header(self, conn) -> None:
         """Receive response from server.
         if sucess, class member (pkg_len, cmd, status) is response.
         """
-        try:
-            header = conn._sock.recv(self.header_len())
-        except (socket.error, socket.timeout) as e:
-            msg = "[-] Error: while reading from socket: %s" % (e.args,)
-            raise ConnectionError(msg) from e
+        header = bytearray(self.header_len())
+        recv_into_exactly(conn._sock, memoryview(header))
+        if self.sent_at and (observe := getattr(conn, "observe_latency", None)):
+            observe(time.monotonic() - self.sent_at)
         self._unpack(header)
 
     async def verify_header(self, client) -> None:
-        response = await client.receive(self.header_len())
+        response = b""
+        while (size := self.header_len() - len(response)) > 0:
+            try:
+                response += await client.receive(size)
+            except (anyio.EndOfStream, anyio.BrokenResourceError, OSError) as e:
+                raise ConnectionError(f"[-] Error: while reading header: {e!r}") from e
         self._unpack(response)
         if (status := self.status) != 0:
             raise DataError(f"[-] Error: {status}, {os.strerror(status)}")
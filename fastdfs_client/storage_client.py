@@ -1,12 +1,15 @@
-import errno
+import contextlib
+import mmap
 import operator
 import os
 import platform
+import socket
 import struct
-import sys
-from typing import cast
+from typing import AsyncGenerator, AsyncIterable, Generator, cast
 
-from .connection import ConnectionPool, tcp_receive, tcp_recv_response, tcp_send_data
+import anyio
+
+from .connection import ConnectionPool, tcp_receive, tcp_recv_response
 from .exceptions import (
     ConnectionError,
     DataError,
@@ -27,15 +30,18 @@ from .protols import (
     STORAGE_PROTO_CMD_DOWNLOAD_FILE,
     STORAGE_PROTO_CMD_GET_METADATA,
     STORAGE_PROTO_CMD_MODIFY_FILE,
+    STORAGE_PROTO_CMD_QUERY_FILE_INFO,
     STORAGE_PROTO_CMD_SET_METADATA,
     STORAGE_PROTO_CMD_TRUNCATE_FILE,
     STORAGE_PROTO_CMD_UPLOAD_APPENDER_FILE,
     STORAGE_PROTO_CMD_UPLOAD_FILE,
     STORAGE_PROTO_CMD_UPLOAD_SLAVE_FILE,
     STORAGE_SET_METADATA_FLAG_OVERWRITE,
+    Crc32,
     StorageServer,
     fdfs_pack_metadata,
     fdfs_unpack_metadata,
+    recv_into_exactly,
 )
 from .tracker_client import TrackerHeader
 from .utils import (
@@ -45,126 +51,271 @@ from .utils import (
 )
 
 __os_sep__ = "/" if platform.system() == "Windows" else os.sep
+MIN_BUFFER_SIZE = 256 * 1024
+MAX_BUFFER_SIZE = 1024 * 1024
+# Files from this size are received into memory map of them
+MMAP_MIN_SIZE = 1024 * 1024
 
 
-def _send_data(conn, fp, buffer_size) -> int:
+def adaptive_buffer_size(sock: socket.socket, optname: int) -> int:
+    """Buffer size for file I/O loop: the socket buffer size(SO_SNDBUF/SO_RCVBUF),
+    limited between 256 KiB and 1 MiB.
+    """
     try:
-        send_buffer = fp.read(buffer_size)
-        send_size = len(send_buffer)
-        if send_size != 0:
-            tcp_send_data(conn, send_buffer)
-        return send_size
-    except ConnectionError as e:
-        raise ConnectionError("[-] Error while uploading file(%s)." % e.args) from e
-    except IOError as e:
-        raise DataError("[-] Error while reading local file(%s)." % e.args) from e
+        size = sock.getsockopt(socket.SOL_SOCKET, optname)
+    except OSError:
+        size = 0
+    return min(max(size, MIN_BUFFER_SIZE), MAX_BUFFER_SIZE)
 
 
-def tcp_send_file(conn, filename, buffer_size=1024):
+def tcp_send_file(conn, filename, buffer_size=None, checksum=None):
     """
     Send file to server, and split into multiple pkgs while sending.
     arguments:
     @conn: connection
     @filename: string
-    @buffer_size: int ,send buffer size
+    @buffer_size: int ,send buffer size, adapt to SO_SNDBUF if None
+    @checksum: Crc32, updated by the sent data if given
     @Return int: file size if success else raise ConnectionError.
     """
+    sock = conn.get_sock()
+    if buffer_size is None:
+        buffer_size = adaptive_buffer_size(sock, socket.SO_SNDBUF)
     file_size = 0
     with open(filename, "rb") as fp:
+        view = memoryview(bytearray(min(buffer_size, os.fstat(fp.fileno()).st_size)))
         while 1:
-            if send_size := _send_data(conn, fp, buffer_size):
-                file_size += send_size
-            else:
+            try:
+                send_size = fp.readinto(view)
+            except IOError as e:
+                msg = "[-] Error while reading local file(%s)." % (e,)
+                raise DataError(msg) from e
+            if not send_size:
                 break
+            if checksum is not None:
+                checksum.update(view[:send_size])
+            try:
+                sock.sendall(view[:send_size])
+            except (socket.error, socket.timeout) as e:
+                msg = "[-] Error while uploading file(%s)." % (e,)
+                raise ConnectionError(msg) from e
+            file_size += send_size
     return file_size
 
 
 def tcp_send_file_ex(conn, filename, buffer_size=4096):
     """
-    Send file to server. Using linux system call 'sendfile'.
+    Send file to server. Using system call 'sendfile', the file is copied by kernel.
+    `socket.sendfile` resumes partial sends, waits for the socket when EAGAIN
+    (the socket has timeout), and falls back to `send` if `os.sendfile` is not
+    available, e.g.: on Windows.
     arguments:
     @conn: connection
     @filename: string
+    @buffer_size: int, not used, kept for compatibility
     @return long, sended size
     """
-    if sys.platform.lower().startswith("win"):
-        raise DataError("[-] Error: 'sendfile' system call only available on linux.")
-    nbytes = offset = 0
-    sock_fd = conn.get_sock().fileno()
-    with open(filename, "rb") as f:
-        in_fd = f.fileno()
-        while 1:
-            try:
-                logger.debug(f"{nbytes = };{offset = };{sock_fd = };{in_fd = }")
-                raise NotImplementedError("sendfile not ready yet.")
-                # sent = sendfile(sock_fd, in_fd, offset, buffer_size)
-                # if 0 == sent:
-                #     break
-                # nbytes += sent
-                # offset += sent
-            except OSError as e:
-                if e.errno == errno.EAGAIN:
-                    continue
-                raise
+    try:
+        f = open(filename, "rb")
+    except IOError as e:
+        raise DataError("[-] Error while reading local file(%s)." % (e,)) from e
+    with f:
+        file_size = os.fstat(f.fileno()).st_size
+        try:
+            nbytes = conn.get_sock().sendfile(f, 0, file_size)
+        except OSError as e:
+            raise ConnectionError("[-] Error while uploading file(%s)." % (e,)) from e
+    if nbytes != file_size:
+        # The header promised more bytes, the connection can not be used any more
+        msg = f"[-] Error: {filename} is changed while uploading, {nbytes = }"
+        raise ConnectionError(msg)
+    return nbytes
+
+
+def tcp_send_file_range(conn, filename, offset, count):
+    """
+    Send `count` bytes of file from `offset` to server by 'sendfile', so that
+    ranges of one file can be sent by several connections concurrently.
+    arguments:
+    @conn: connection
+    @filename: string
+    @offset: int, position of the first byte to send in file
+    @count: int, bytes to send
+    @return long, sended size
+    """
+    try:
+        f = open(filename, "rb")
+    except IOError as e:
+        raise DataError("[-] Error while reading local file(%s)." % (e,)) from e
+    with f:
+        try:
+            nbytes = conn.get_sock().sendfile(f, offset, count)
+        except OSError as e:
+            raise ConnectionError("[-] Error while uploading file(%s)." % (e,)) from e
+    if nbytes != count:
+        # The header promised more bytes, the connection can not be used any more
+        msg = f"[-] Error: {filename} is changed while uploading, {nbytes = }"
+        raise ConnectionError(msg)
     return nbytes
 
 
-def tcp_recv_file(conn, local_filename, file_size, buffer_size=1024):
+def tcp_recv_file(conn, local_filename, file_size, buffer_size=None, checksum=None):
     """
     Receive file from server, fragmented it while receiving and write to disk.
+    A large file is received into memory map of it where supported, without
+    copying data through a user space buffer.
     arguments:
     @conn: connection
     @local_filename: string
     @file_size: int, remote file size
-    @buffer_size: int, receive buffer size
+    @buffer_size: int, receive buffer size, adapt to SO_RCVBUF if None
+    @checksum: Crc32, updated by the received data if given
     @Return int: file size if success else raise ConnectionError.
     """
+    if file_size >= MMAP_MIN_SIZE and (mm := map_file(local_filename, file_size)):
+        # Received by kernel into page cache of the file, without a buffer
+        received = False
+        try:
+            with memoryview(mm) as view:
+                recv_into_exactly(conn._sock, view, checksum)
+            received = True
+        except ConnectionError as e:
+            msg = "[-] Error: while downloading file(%s)." % e.args
+            raise ConnectionError(msg) from e
+        finally:
+            # Never hide the error above, the map is closed when collected then
+            with contextlib.suppress(BufferError):
+                mm.close()
+            if not received:
+                # Not to leave a file of full size, which looks like downloaded
+                with contextlib.suppress(OSError):
+                    os.truncate(local_filename, 0)
+        return file_size
+    if buffer_size is None:
+        buffer_size = adaptive_buffer_size(conn.get_sock(), socket.SO_RCVBUF)
     total_file_size = 0
-    flush_size = 0
     remain_bytes = file_size
+    # One buffer is reused by all chunks, instead of allocating for each of them
+    view = memoryview(bytearray(min(buffer_size, max(file_size, 0))))
     with open(local_filename, "wb+") as f:
         while remain_bytes > 0:
+            chunk = view[:remain_bytes]
             try:
-                if remain_bytes >= buffer_size:
-                    file_buffer, recv_size = tcp_recv_response(
-                        conn, buffer_size, buffer_size
-                    )
-                else:
-                    file_buffer, recv_size = tcp_recv_response(
-                        conn, remain_bytes, buffer_size
-                    )
-                f.write(file_buffer)
-                remain_bytes -= buffer_size
-                total_file_size += recv_size
-                flush_size += recv_size
-                if flush_size >= 4096:
-                    f.flush()
-                    flush_size = 0
+                recv_into_exactly(conn._sock, chunk, checksum)
             except ConnectionError as e:
                 msg = "[-] Error: while downloading file(%s)." % e.args
                 raise ConnectionError(msg) from e
+            try:
+                f.write(chunk)
             except IOError as e:
                 msg = "[-] Error: while writting local file(%s)." % e.args
                 raise DataError(msg) from e
+            remain_bytes -= len(chunk)
+            total_file_size += len(chunk)
     return total_file_size
 
 
+def tcp_recv_to_fd(conn, fd, position, size, buffer_size=None):
+    """
+    Receive data from server and write it to file descriptor at position by
+    pwrite, the file offset is not used, so ranges of one file can be received
+    by several connections concurrently.
+    arguments:
+    @conn: connection
+    @fd: int, file descriptor opened for writing
+    @position: int, where to write the first byte in file
+    @size: int, bytes to receive
+    @buffer_size: int, receive buffer size, adapt to SO_RCVBUF if None
+    @Return int: size if success else raise ConnectionError.
+    """
+    if buffer_size is None:
+        buffer_size = adaptive_buffer_size(conn.get_sock(), socket.SO_RCVBUF)
+    view = memoryview(bytearray(min(buffer_size, max(size, 0))))
+    remain_bytes = size
+    while remain_bytes > 0:
+        chunk = view[:remain_bytes]
+        try:
+            recv_into_exactly(conn._sock, chunk)
+        except ConnectionError as e:
+            msg = "[-] Error: while downloading file(%s)." % (e,)
+            raise ConnectionError(msg) from e
+        remain_bytes -= len(chunk)
+        try:
+            while chunk:
+                written = os.pwrite(fd, chunk, position)
+                position += written
+                chunk = chunk[written:]
+        except OSError as e:
+            msg = "[-] Error: while writting local file(%s)." % (e,)
+            raise DataError(msg) from e
+    return size
+
+
+def map_file(filename, size) -> mmap.mmap | None:
+    """
+    Create file of size with disk blocks reserved, and map it into memory for
+    writing. Return None if it can not be mapped, e.g.: on Windows, or by some
+    network file systems.
+    """
+    if os.name != "posix":
+        return None
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        preallocate(fd, size)
+        return mmap.mmap(fd, size)
+    except (OSError, ValueError) as e:
+        logger.debug(f"Failed to map {filename}: {e}")
+        return None
+    finally:
+        os.close(fd)  # the map keeps a reference of file
+
+
+def preallocate(fd, size):
+    """Resize file to size, and reserve disk blocks for it where supported,
+    so that writing ranges of it does not fail for no space halfway."""
+    os.ftruncate(fd, size)
+    if size > 0 and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError as e:
+            logger.debug(f"posix_fallocate is not supported: {e}")
+
+
 class StorageClient:
     """
     The Class Storage_client for storage server.
     Note: argument host_tuple of storage server ip address, that should be a single element.
     """
 
-    def __init__(self, host: str, port: int, timeout: int, *args) -> None:
-        conn_kwargs = {
-            "name": "Storage Pool",
-            "host_tuple": (host,),
-            "port": port,
-            "timeout": timeout,
-        }
-        self.pool = ConnectionPool(**conn_kwargs)
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        timeout: int,
+        *args,
+        pool: ConnectionPool | None = None,
+        buffer_size: int | None = None,
+        verify_crc32: bool = False,
+    ) -> None:
+        # Buffer size of file I/O loop, None means to adapt to the socket buffer
+        self.buffer_size = buffer_size
+        # Compare CRC32 of uploaded or downloaded content with the storage server
+        self.verify_crc32 = verify_crc32
+        # A pool passed in is shared with others, so it will not be destroyed here
+        self._own_pool = pool is None
+        if pool is None:
+            conn_kwargs: dict = {
+                "name": "Storage Pool",
+                "host_tuple": (host,),
+                "port": port,
+                "timeout": timeout,
+            }
+            pool = ConnectionPool(**conn_kwargs)
+        self.pool = pool
 
     def __del__(self):
+        if not getattr(self, "_own_pool", False):
+            return
         try:
             self.pool.destroy()  # type:ignore
             del self.pool
@@ -179,14 +330,16 @@ class StorageClient:
         """
         if old_store_serv.ip_addr == new_store_serv.ip_addr:
             return None
-        self.pool.destroy()
-        conn_kwargs = {
+        if self._own_pool:
+            self.pool.destroy()
+        conn_kwargs: dict = {
             "name": "Storage_pool",
             "host_tuple": (new_store_serv.ip_addr,),
             "port": new_store_serv.port,
             "timeout": timeout,
         }
         self.pool = ConnectionPool(**conn_kwargs)
+        self._own_pool = True
         return True
 
     def _storage_do_upload_file(
@@ -250,8 +403,11 @@ class StorageClient:
         )
         th.pkg_len += file_size
         th.cmd = cmd
+        # Content of appender file is to be changed, so there is nothing to verify
+        checksum = None
+        if self.verify_crc32 and cmd != STORAGE_PROTO_CMD_UPLOAD_APPENDER_FILE:
+            checksum = Crc32()
         with self.pool.open_connection() as store_conn:
-            th.send_header(store_conn)
             if upload_slave:
                 send_buffer = struct.pack(
                     slave_fmt,
@@ -268,11 +424,19 @@ class StorageClient:
                     file_size,
                     file_ext_name.encode(),
                 )
-            tcp_send_data(store_conn, send_buffer)
-            if upload_type == FDFS_UPLOAD_BY_FILENAME:
-                send_file_size = tcp_send_file(store_conn, file_buffer)
-            elif upload_type == FDFS_UPLOAD_BY_BUFFER:
-                tcp_send_data(store_conn, file_buffer)
+            if upload_type == FDFS_UPLOAD_BY_BUFFER:
+                if checksum is not None:
+                    checksum.update(file_buffer)
+                th.send_header(store_conn, send_buffer, file_buffer)
+            else:
+                th.send_header(store_conn, send_buffer)
+            # sendfile does not pass content by user space, to compute checksum
+            if upload_type == FDFS_UPLOAD_BY_FILENAME or (
+                upload_type == FDFS_UPLOAD_BY_FILE and checksum is not None
+            ):
+                send_file_size = tcp_send_file(
+                    store_conn, file_buffer, self.buffer_size, checksum
+                )
             elif upload_type == FDFS_UPLOAD_BY_FILE:
                 send_file_size = tcp_send_file_ex(store_conn, file_buffer)
             th.recv_header(store_conn)
@@ -291,16 +455,22 @@ class StorageClient:
             )
             (group_name, remote_name) = struct.unpack(recv_fmt, recv_buffer)
             remote_filename = remote_name.strip(b"\x00")
-            if meta_dict and len(meta_dict) > 0:
-                status = self.storage_set_metadata(
-                    tracker_client, store_serv, remote_filename, meta_dict
-                )
-                if status != 0:
-                    # rollback
-                    self.storage_delete_file(
-                        tracker_client, store_serv, remote_filename
-                    )
-                    raise DataError("[-] Error: %d, %s" % (status, os.strerror(status)))
+        # Connection of upload is released, before queries to the same pool
+        if checksum is not None:
+            try:
+                self._check_crc32(store_serv, remote_filename, checksum)
+            except DataError:
+                # rollback
+                self.storage_delete_file(tracker_client, store_serv, remote_filename)
+                raise
+        if meta_dict and len(meta_dict) > 0:
+            status = self.storage_set_metadata(
+                tracker_client, store_serv, remote_filename, meta_dict
+            )
+            if status != 0:
+                # rollback
+                self.storage_delete_file(tracker_client, store_serv, remote_filename)
+                raise DataError("[-] Error: %d, %s" % (status, os.strerror(status)))
         ret_dic = {
             "Group name": group_name.strip(b"\x00"),
             "Remote file_id": group_name.strip(b"\x00")
@@ -318,6 +488,18 @@ class StorageClient:
         self._auto_decode_bytes(ret_dic)
         return ret_dic
 
+    def _check_crc32(self, store_serv, remote_filename, checksum: Crc32) -> None:
+        """Raise DataError if CRC32 on storage server is not the checksum."""
+        info = self.storage_query_file_info(store_serv, remote_filename)
+        # It may be sign extended to 8 bytes by server
+        if (crc32 := info["CRC32"] & 0xFFFFFFFF) != checksum.value:
+            msg = "[-] Error: CRC32 of %r is %08X, but %08X on server." % (
+                remote_filename,
+                checksum.value,
+                crc32,
+            )
+            raise DataError(msg)
+
     def _auto_decode_bytes(self, dic: dict) -> None:
         for k, v in dic.items():
             if isinstance(v, bytes):
@@ -366,21 +548,58 @@ class StorageClient:
         file_buffer: bytes,
         file_ext_name: str,
     ) -> dict:
-        file_size = len(file_buffer)
+        return await self._upload_async(
+            store_serv, len(file_buffer), file_ext_name, file_buffer
+        )
+
+    async def upload_stream(
+        self,
+        store_serv: StorageServer,
+        chunks: AsyncIterable[bytes],
+        file_size: int,
+        file_ext_name: str,
+    ) -> dict:
+        """
+        Upload content from an async iterable of chunks, each chunk is sent when
+        it comes, so the memory usage does not depend on file size.
+        @file_size: int, total size of chunks, which is sent before the content
+        """
+        return await self._upload_async(
+            store_serv, file_size, file_ext_name, b"", chunks
+        )
+
+    async def _upload_async(
+        self,
+        store_serv: StorageServer,
+        file_size: int,
+        file_ext_name: str,
+        file_buffer: bytes,
+        chunks: AsyncIterable[bytes] | None = None,
+    ) -> dict:
         # non_slave_fmt |-store_path_index(1)-file_size(8)-file_ext_name(6)-|
         non_slave_fmt = "!B Q %ds" % FDFS_FILE_EXT_NAME_MAX_LEN
         th = TrackerHeader(cmd=STORAGE_PROTO_CMD_UPLOAD_FILE)
         th.pkg_len = struct.calcsize(non_slave_fmt) + file_size
         async with store_serv.connect_tcp() as client:
-            await client.send(th.build_header())
             send_buffer = struct.pack(
                 non_slave_fmt,
                 store_serv.store_path_index,
                 file_size,
                 file_ext_name.encode(),
             )
-            await client.send(send_buffer)
-            await client.send(file_buffer)
+            await th.send_header_async(client, send_buffer, file_buffer)
+            if chunks is not None:
+                sent_size = 0
+                async for chunk in chunks:
+                    sent_size += len(chunk)
+                    if sent_size > file_size:
+                        break
+                    await client.send(chunk)
+                if sent_size != file_size:
+                    msg = (
+                        f"[-] Error: size of chunks is not {file_size}, {sent_size = }"
+                    )
+                    raise DataError(msg)
             await th.verify_header(client)
             recv_buffer = await tcp_receive(
                 client, th.pkg_len, FDFS_GROUP_NAME_MAX_LEN, operator.gt, "Storage"
@@ -405,6 +624,35 @@ class StorageClient:
         self._auto_decode_bytes(ret_dic)
         return ret_dic
 
+    async def download_stream(
+        self,
+        store_serv: StorageServer,
+        remote_filename: str | bytes,
+        offset: int = 0,
+        download_size: int = 0,
+        chunk_size: int = 64 * 1024,
+    ) -> AsyncGenerator[bytes, None]:
+        """
+        Yield file content by chunks, the next chunk is not received until the
+        previous one is consumed. The stream is closed if abandoned halfway.
+        @download_size: int, 0 means to the end of file
+        """
+        th, send_buffer = self._pack_download(
+            store_serv, remote_filename, offset, download_size
+        )
+        async with store_serv.connect_tcp() as client:
+            await th.send_header_async(client, send_buffer)
+            await th.verify_header(client)
+            remain_bytes = th.pkg_len
+            while remain_bytes > 0:
+                try:
+                    chunk = await client.receive(min(chunk_size, remain_bytes))
+                except (anyio.EndOfStream, anyio.BrokenResourceError, OSError) as e:
+                    msg = f"[-] Error: while downloading file: {e!r}"
+                    raise ConnectionError(msg) from e
+                remain_bytes -= len(chunk)
+                yield chunk
+
     def storage_upload_by_buffer(
         self,
         tracker_client,
@@ -564,11 +812,10 @@ class StorageClient:
         if isinstance(remote_filename, str):
             remote_filename = remote_filename.encode()
         async with store_serv.connect_tcp() as client:
-            await client.send(th.build_header())
             # del_fmt: |-group_name(16)-filename(len)-|
             del_fmt = "!%ds %ds" % (FDFS_GROUP_NAME_MAX_LEN, file_name_len)
             send_buffer = struct.pack(del_fmt, store_serv.group_name, remote_filename)
-            await client.send(send_buffer)
+            await th.send_header_async(client, send_buffer)
             await th.verify_header(client)
         if isinstance(store_serv.group_name, str):
             group = store_serv.group_name.encode()
@@ -589,11 +836,10 @@ class StorageClient:
         if isinstance(remote_filename, str):
             remote_filename = remote_filename.encode()
         try:
-            th.send_header(store_conn)
             # del_fmt: |-group_name(16)-filename(len)-|
             del_fmt = "!%ds %ds" % (FDFS_GROUP_NAME_MAX_LEN, file_name_len)
             send_buffer = struct.pack(del_fmt, store_serv.group_name, remote_filename)
-            tcp_send_data(store_conn, send_buffer)
+            th.send_header(store_conn, send_buffer)
             th.recv_header(store_conn)
             # if th.status == 2:
             #    raise DataError('[-] Error: remote file %s is not exist.'
@@ -601,7 +847,10 @@ class StorageClient:
             if th.status != 0:
                 raise DataError("Error: %d, %s" % (th.status, os.strerror(th.status)))
                 # recv_buffer, recv_size = tcp_recv_response(store_conn, th.pkg_len)
-        finally:
+        except BaseException:
+            self.pool.discard(store_conn)  # request may be half done
+            raise
+        else:
             self.pool.release(store_conn)
         remote_filename = store_serv.group_name + __os_sep__.encode() + remote_filename
         return ("Delete file successed.", remote_filename, store_serv.ip_addr)
@@ -626,6 +875,10 @@ class StorageClient:
             'Download size'   : download_size,
             'Storage IP'      : storage_ip
         """
+        # Only the whole file can be compared with CRC32 on server
+        checksum = None
+        if self.verify_crc32 and not offset and not download_size:
+            checksum = Crc32()
         store_conn = self.pool.get_connection()
         th = TrackerHeader()
         remote_filename_len = len(remote_filename)
@@ -636,13 +889,12 @@ class StorageClient:
         if isinstance(remote_filename, str):
             remote_filename = remote_filename.encode()
         try:
-            th.send_header(store_conn)
             # down_fmt: |-offset(8)-download_bytes(8)-group_name(16)-remote_filename(len)-|
             down_fmt = "!Q Q %ds %ds" % (FDFS_GROUP_NAME_MAX_LEN, remote_filename_len)
             send_buffer = struct.pack(
                 down_fmt, offset, download_size, store_serv.group_name, remote_filename
             )
-            tcp_send_data(store_conn, send_buffer)
+            th.send_header(store_conn, send_buffer)
             th.recv_header(store_conn)
             # if th.status == 2:
             #    raise DataError('[-] Error: remote file %s is not exist.' %
@@ -650,11 +902,20 @@ class StorageClient:
             if th.status != 0:
                 raise DataError("Error: %d %s" % (th.status, os.strerror(th.status)))
             if download_type == FDFS_DOWNLOAD_TO_FILE:
-                total_recv_size = tcp_recv_file(store_conn, file_buffer, th.pkg_len)
+                total_recv_size = tcp_recv_file(
+                    store_conn, file_buffer, th.pkg_len, self.buffer_size, checksum
+                )
             elif download_type == FDFS_DOWNLOAD_TO_BUFFER:
-                recv_buffer, total_recv_size = tcp_recv_response(store_conn, th.pkg_len)
-        finally:
+                recv_buffer, total_recv_size = tcp_recv_response(
+                    store_conn, th.pkg_len, checksum=checksum
+                )
+        except BaseException:
+            self.pool.discard(store_conn)  # request may be half done
+            raise
+        else:
             self.pool.release(store_conn)
+        if checksum is not None:
+            self._check_crc32(store_serv, remote_filename, checksum)
         ret_dic = {
             "Remote file_id": store_serv.group_name
             + __os_sep__.encode()
@@ -705,6 +966,150 @@ class StorageClient:
             remote_filename,
         )
 
+    def storage_iter_download(
+        self,
+        store_serv,
+        remote_filename,
+        offset=0,
+        download_size=0,
+        chunk_size=None,
+    ) -> Generator[bytes, None, None]:
+        """
+        Yield file content by chunks as they come off the socket.
+        The connection goes back to pool only after all chunks are consumed,
+        it is closed if the generator is abandoned or fails halfway.
+        @download_size: int, 0 means to the end of file
+        @chunk_size: int, max size of chunk, adapt to SO_RCVBUF if None
+        """
+        th, send_buffer = self._pack_download(
+            store_serv, remote_filename, offset, download_size
+        )
+        store_conn = self.pool.get_connection()
+        reusable = False
+        try:
+            th.send_header(store_conn, send_buffer)
+            th.recv_header(store_conn)
+            if th.status != 0:
+                reusable = th.pkg_len == 0
+                raise DataError("Error: %d %s" % (th.status, os.strerror(th.status)))
+            sock = store_conn.get_sock()
+            if chunk_size is None:
+                chunk_size = adaptive_buffer_size(sock, socket.SO_RCVBUF)
+            remain_bytes = th.pkg_len
+            while remain_bytes > 0:
+                try:
+                    chunk = sock.recv(min(chunk_size, remain_bytes))
+                except (socket.error, socket.timeout) as e:
+                    msg = "[-] Error: while downloading file(%s)." % (e,)
+                    raise ConnectionError(msg) from e
+                if not chunk:
+                    msg = (
+                        f"[-] Error: connection closed with {remain_bytes} bytes unread"
+                    )
+                    raise ConnectionError(msg)
+                remain_bytes -= len(chunk)
+                yield chunk
+            reusable = True
+        finally:
+            if reusable:
+                self.pool.release(store_conn)
+            else:
+                self.pool.remove(store_conn)
+                store_conn.disconnect()
+
+    def storage_download_range(
+        self, store_serv, remote_filename, fd, position, offset, download_size
+    ) -> int:
+        """
+        Download `download_size` bytes of file from `offset`, and write them to
+        file descriptor `fd` at `position` without moving its file offset.
+        The connection is closed if the range is not received completely.
+        @Return int: received size
+        """
+        th, send_buffer = self._pack_download(
+            store_serv, remote_filename, offset, download_size
+        )
+        store_conn = self.pool.get_connection()
+        reusable = False
+        try:
+            th.send_header(store_conn, send_buffer)
+            th.recv_header(store_conn)
+            if th.status != 0:
+                reusable = th.pkg_len == 0
+                raise DataError("Error: %d %s" % (th.status, os.strerror(th.status)))
+            if th.pkg_len != download_size:
+                msg = f"[-] Error: expect {download_size} bytes, got {th.pkg_len}"
+                raise DataError(msg)
+            tcp_recv_to_fd(store_conn, fd, position, th.pkg_len, self.buffer_size)
+            reusable = True
+        finally:
+            if reusable:
+                self.pool.release(store_conn)
+            else:
+                self.pool.remove(store_conn)
+                store_conn.disconnect()
+        return th.pkg_len
+
+    @staticmethod
+    def _pack_download(
+        store_serv, remote_filename, offset, download_size
+    ) -> tuple[TrackerHeader, bytes]:
+        if isinstance(remote_filename, str):
+            remote_filename = remote_filename.encode()
+        group_name = store_serv.group_name
+        if isinstance(group_name, str):
+            group_name = group_name.encode()
+        remote_filename_len = len(remote_filename)
+        th = TrackerHeader(cmd=STORAGE_PROTO_CMD_DOWNLOAD_FILE)
+        th.pkg_len = (
+            FDFS_PROTO_PKG_LEN_SIZE * 2 + FDFS_GROUP_NAME_MAX_LEN + remote_filename_len
+        )
+        # down_fmt: |-offset(8)-download_bytes(8)-group_name(16)-remote_filename(len)-|
+        down_fmt = "!Q Q %ds %ds" % (FDFS_GROUP_NAME_MAX_LEN, remote_filename_len)
+        send_buffer = struct.pack(
+            down_fmt, offset, download_size, group_name, remote_filename
+        )
+        return th, send_buffer
+
+    def storage_query_file_info(self, store_serv, remote_filename) -> dict:
+        """
+        Query file information from storage server.
+        @Return dict {
+            'File size'        : int,
+            'Create timestamp' : int,
+            'CRC32'            : int,
+            'Source IP'        : bytes, ip address of the storage that created it
+        }
+        """
+        if isinstance(remote_filename, str):
+            remote_filename = remote_filename.encode()
+        group_name = store_serv.group_name
+        if isinstance(group_name, str):
+            group_name = group_name.encode()
+        th = TrackerHeader(cmd=STORAGE_PROTO_CMD_QUERY_FILE_INFO)
+        th.pkg_len = FDFS_GROUP_NAME_MAX_LEN + len(remote_filename)
+        # query_fmt: |-group_name(16)-filename(len)-|
+        query_fmt = "!%ds %ds" % (FDFS_GROUP_NAME_MAX_LEN, len(remote_filename))
+        send_buffer = struct.pack(query_fmt, group_name, remote_filename)
+        with self.pool.open_connection() as store_conn:
+            th.send_header(store_conn, send_buffer)
+            th.recv_header(store_conn)
+            if th.status != 0:
+                raise DataError("Error: %d %s" % (th.status, os.strerror(th.status)))
+            recv_buffer, recv_size = tcp_recv_response(store_conn, th.pkg_len)
+        # recv_fmt: |-file_size(8)-create_timestamp(8)-crc32(8)-source_ip(rest)-|
+        info_fmt = "!Q Q Q"
+        if recv_size <= struct.calcsize(info_fmt):
+            raise ResponseError(f"[-] Error: Storage response length {recv_size}")
+        file_size, create_timestamp, crc32 = struct.unpack_from(info_fmt, recv_buffer)
+        source_ip = bytes(recv_buffer[struct.calcsize(info_fmt) :]).strip(b"\x00")
+        return {
+            "File size": file_size,
+            "Create timestamp": create_timestamp,
+            "CRC32": crc32,
+            "Source IP": source_ip,
+        }
+
     def storage_set_metadata(
         self,
         tracker_client,
@@ -728,7 +1133,6 @@ class StorageClient:
         )
         th.cmd = STORAGE_PROTO_CMD_SET_METADATA
         try:
-            th.send_header(conn)
             # meta_fmt: |-filename_len(8)-meta_len(8)-op_flag(1)-group_name(16)
             #           -filename(remote_filename_len)-meta(meta_len)|
             meta_fmt = "!Q Q c %ds %ds %ds" % (
@@ -745,11 +1149,14 @@ class StorageClient:
                 remote_filename,
                 meta_buffer,
             )
-            tcp_send_data(conn, send_buffer)
+            th.send_header(conn, send_buffer)
             th.recv_header(conn)
             if th.status != 0:
                 ret = th.status
-        finally:
+        except BaseException:
+            self.pool.discard(conn)  # request may be half done
+            raise
+        else:
             self.pool.release(conn)
         return ret
 
@@ -760,13 +1167,12 @@ class StorageClient:
         th.pkg_len = FDFS_GROUP_NAME_MAX_LEN + remote_filename_len
         th.cmd = STORAGE_PROTO_CMD_GET_METADATA
         try:
-            th.send_header(store_conn)
             # meta_fmt: |-group_name(16)-filename(remote_filename_len)-|
             meta_fmt = "!%ds %ds" % (FDFS_GROUP_NAME_MAX_LEN, remote_filename_len)
             send_buffer = struct.pack(
                 meta_fmt, store_serv.group_name, remote_file_name.encode()
             )
-            tcp_send_data(store_conn, send_buffer)
+            th.send_header(store_conn, send_buffer)
             th.recv_header(store_conn)
             # if th.status == 2:
             #    raise DataError('[-] Error: Remote file %s has no meta data.'
@@ -778,7 +1184,10 @@ class StorageClient:
             if th.pkg_len == 0:
                 ret_dict = {}
             meta_buffer, recv_size = tcp_recv_response(store_conn, th.pkg_len)
-        finally:
+        except BaseException:
+            self.pool.discard(store_conn)  # request may be half done
+            raise
+        else:
             self.pool.release(store_conn)
         ret_dict = fdfs_unpack_metadata(meta_buffer)
         return ret_dict
@@ -791,25 +1200,34 @@ class StorageClient:
         file_size,
         upload_type,
         appended_filename,
+        file_offset=None,
     ):
+        """
+        @file_offset: int, send `file_size` bytes of local file from this position
+            instead of the whole file, only for FDFS_UPLOAD_BY_FILE
+        """
+        if isinstance(appended_filename, str):
+            appended_filename = appended_filename.encode()
         store_conn = self.pool.get_connection()
         th = TrackerHeader()
         appended_filename_len = len(appended_filename)
         th.pkg_len = FDFS_PROTO_PKG_LEN_SIZE * 2 + appended_filename_len + file_size
         th.cmd = STORAGE_PROTO_CMD_APPEND_FILE
         try:
-            th.send_header(store_conn)
             # append_fmt: |-appended_filename_len(8)-file_size(8)-appended_filename(len)
             #             -filecontent(filesize)-|
             append_fmt = "!Q Q %ds" % appended_filename_len
             send_buffer = struct.pack(
                 append_fmt, appended_filename_len, file_size, appended_filename
             )
-            tcp_send_data(store_conn, send_buffer)
+            if upload_type == FDFS_UPLOAD_BY_BUFFER:
+                th.send_header(store_conn, send_buffer, file_buffer)
+            else:
+                th.send_header(store_conn, send_buffer)
             if upload_type == FDFS_UPLOAD_BY_FILENAME:
-                tcp_send_file(store_conn, file_buffer)
-            elif upload_type == FDFS_UPLOAD_BY_BUFFER:
-                tcp_send_data(store_conn, file_buffer)
+                tcp_send_file(store_conn, file_buffer, self.buffer_size)
+            elif upload_type == FDFS_UPLOAD_BY_FILE and file_offset is not None:
+                tcp_send_file_range(store_conn, file_buffer, file_offset, file_size)
             elif upload_type == FDFS_UPLOAD_BY_FILE:
                 tcp_send_file_ex(store_conn, file_buffer)
             th.recv_header(store_conn)
@@ -817,7 +1235,10 @@ class StorageClient:
                 raise DataError(
                     "[-] Error: %d, %s" % (th.status, os.strerror(th.status))
                 )
-        finally:
+        except BaseException:
+            self.pool.discard(store_conn)  # request may be half done
+            raise
+        else:
             self.pool.release(store_conn)
         ret_dict = {}
         ret_dict["Status"] = "Append file successed."
@@ -854,6 +1275,28 @@ class StorageClient:
             appended_filename,
         )
 
+    def storage_append_by_range(
+        self,
+        tracker_client,
+        store_serv,
+        local_filename,
+        offset,
+        file_size,
+        appended_filename,
+    ):
+        """
+        Append `file_size` bytes of local file from `offset` to appender file.
+        """
+        return self._storage_do_append_file(
+            tracker_client,
+            store_serv,
+            local_filename,
+            file_size,
+            FDFS_UPLOAD_BY_FILE,
+            appended_filename,
+            file_offset=offset,
+        )
+
     def storage_append_by_buffer(
         self, tracker_client, store_serv, file_buffer, appended_filename
     ):
@@ -870,13 +1313,14 @@ class StorageClient:
     def _storage_do_truncate_file(
         self, tracker_client, store_serv, truncated_filesize, appender_filename
     ):
+        if isinstance(appender_filename, str):
+            appender_filename = appender_filename.encode()
         store_conn = self.pool.get_connection()
         th = TrackerHeader()
         th.cmd = STORAGE_PROTO_CMD_TRUNCATE_FILE
         appender_filename_len = len(appender_filename)
         th.pkg_len = FDFS_PROTO_PKG_LEN_SIZE * 2 + appender_filename_len
         try:
-            th.send_header(store_conn)
             # truncate_fmt:|-appender_filename_len(8)-truncate_filesize(8)
             #              -appender_filename(len)-|
             truncate_fmt = "!Q Q %ds" % appender_filename_len
@@ -886,13 +1330,16 @@ class StorageClient:
                 truncated_filesize,
                 appender_filename,
             )
-            tcp_send_data(store_conn, send_buffer)
+            th.send_header(store_conn, send_buffer)
             th.recv_header(store_conn)
             if th.status != 0:
                 raise DataError(
                     "[-] Error: %d, %s" % (th.status, os.strerror(th.status))
                 )
-        finally:
+        except BaseException:
+            self.pool.discard(store_conn)  # request may be half done
+            raise
+        else:
             self.pool.release(store_conn)
         ret_dict = {}
         ret_dict["Status"] = "Truncate successed."
@@ -915,24 +1362,33 @@ class StorageClient:
         offset,
         filesize,
         appender_filename,
+        file_offset=None,
     ):
+        """
+        @file_offset: int, send `filesize` bytes of local file from this position
+            instead of the whole file, only for FDFS_UPLOAD_BY_FILE
+        """
+        if isinstance(appender_filename, str):
+            appender_filename = appender_filename.encode()
         store_conn = self.pool.get_connection()
         th = TrackerHeader()
         th.cmd = STORAGE_PROTO_CMD_MODIFY_FILE
         appender_filename_len = len(appender_filename)
         th.pkg_len = FDFS_PROTO_PKG_LEN_SIZE * 3 + appender_filename_len + filesize
         try:
-            th.send_header(store_conn)
             # modify_fmt: |-filename_len(8)-offset(8)-filesize(8)-filename(len)-|
             modify_fmt = "!Q Q Q %ds" % appender_filename_len
             send_buffer = struct.pack(
                 modify_fmt, appender_filename_len, offset, filesize, appender_filename
             )
-            tcp_send_data(store_conn, send_buffer)
+            if upload_type == FDFS_UPLOAD_BY_BUFFER:
+                th.send_header(store_conn, send_buffer, filebuffer)
+            else:
+                th.send_header(store_conn, send_buffer)
             if upload_type == FDFS_UPLOAD_BY_FILENAME:
-                upload_size = tcp_send_file(store_conn, filebuffer)
-            elif upload_type == FDFS_UPLOAD_BY_BUFFER:
-                tcp_send_data(store_conn, filebuffer)
+                upload_size = tcp_send_file(store_conn, filebuffer, self.buffer_size)
+            elif upload_type == FDFS_UPLOAD_BY_FILE and file_offset is not None:
+                tcp_send_file_range(store_conn, filebuffer, file_offset, filesize)
             elif upload_type == FDFS_UPLOAD_BY_FILE:
                 upload_size = tcp_send_file_ex(store_conn, filebuffer)
                 logger.debug(f"{upload_size = }")
@@ -941,7 +1397,10 @@ class StorageClient:
                 raise DataError(
                     "[-] Error: %d, %s" % (th.status, os.strerror(th.status))
                 )
-        finally:
+        except BaseException:
+            self.pool.discard(store_conn)  # request may be half done
+            raise
+        else:
             self.pool.release(store_conn)
         ret_dict = {}
         ret_dict["Status"] = "Modify successed."
@@ -974,6 +1433,24 @@ class StorageClient:
             appender_filename,
         )
 
+    def storage_modify_by_range(
+        self, tracker_client, store_serv, filename, offset, filesize, appender_filename
+    ):
+        """
+        Overwrite `filesize` bytes of appender file from `offset` with the bytes
+        at the same position of local file.
+        """
+        return self._storage_do_modify_file(
+            tracker_client,
+            store_serv,
+            FDFS_UPLOAD_BY_FILE,
+            filename,
+            offset,
+            filesize,
+            appender_filename,
+            file_offset=offset,
+        )
+
     def storage_modify_by_buffer(
         self,
         tracker_client,
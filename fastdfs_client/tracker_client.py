@@ -3,10 +3,12 @@ import struct
 from dataclasses import dataclass
 from datetime import datetime
 
-import anyio
-
-from .connection import tcp_receive, tcp_recv_response, tcp_send_data
-from .exceptions import ConnectionError, DataError, ResponseError
+from .connection import (
+    AsyncConnectionPool,
+    tcp_receive,
+    tcp_recv_response,
+)
+from .exceptions import DataError, ResponseError
 from .protols import (
     FDFS_GROUP_NAME_MAX_LEN,
     FDFS_SPACE_SIZE_BASE_INDEX,
@@ -23,14 +25,17 @@ from .protols import (
     TRACKER_PROTO_CMD_SERVER_LIST_ALL_GROUPS,
     TRACKER_PROTO_CMD_SERVER_LIST_ONE_GROUP,
     TRACKER_PROTO_CMD_SERVER_LIST_STORAGE,
+    TRACKER_PROTO_CMD_SERVICE_QUERY_FETCH_ALL,
     TRACKER_PROTO_CMD_SERVICE_QUERY_FETCH_ONE,
     TRACKER_PROTO_CMD_SERVICE_QUERY_STORE_WITH_GROUP_ONE,
     TRACKER_PROTO_CMD_SERVICE_QUERY_STORE_WITHOUT_GROUP_ONE,
     TRACKER_PROTO_CMD_SERVICE_QUERY_UPDATE,
     TRACKER_QUERY_STORAGE_FETCH_BODY_LEN,
     TRACKER_QUERY_STORAGE_STORE_BODY_LEN,
+    SocketOptions,
     StorageServer,
     TrackerHeader,
+    open_stream,
 )
 from .utils import appromix
 
@@ -349,14 +354,15 @@ class TrackerClient:
         th.pkg_len = FDFS_GROUP_NAME_MAX_LEN + ip_len
         th.cmd = TRACKER_PROTO_CMD_SERVER_LIST_STORAGE
         group_fmt = "!%ds" % FDFS_GROUP_NAME_MAX_LEN
-        store_ip_addr = storage_ip or ""
+        store_ip_addr = storage_ip or b""
+        if isinstance(store_ip_addr, str):
+            store_ip_addr = store_ip_addr.encode()
         storage_ip_fmt = "!%ds" % ip_len
         try:
-            th.send_header(conn)
             send_buffer = struct.pack(group_fmt, group_name) + struct.pack(
                 storage_ip_fmt, store_ip_addr
             )
-            tcp_send_data(conn, send_buffer)
+            th.send_header(conn, send_buffer)
             th.recv_header(conn)
             if th.status != 0:
                 raise DataError(
@@ -372,9 +378,10 @@ class TrackerClient:
                     % (th.pkg_len, recv_size)
                 )
                 raise ResponseError(errinfo)
-        except ConnectionError:
+        except BaseException:
+            self.pool.discard(conn)  # request may be half done
             raise
-        finally:
+        else:
             self.pool.release(conn)
         num_storage = recv_size / si_fmt_size
         si_list = []
@@ -398,9 +405,8 @@ class TrackerClient:
         # group_fmt: |-group_name(16)-|
         group_fmt = "!%ds" % FDFS_GROUP_NAME_MAX_LEN
         try:
-            th.send_header(conn)
             send_buffer = struct.pack(group_fmt, group_name)
-            tcp_send_data(conn, send_buffer)
+            th.send_header(conn, send_buffer)
             th.recv_header(conn)
             if th.status != 0:
                 raise DataError(
@@ -409,9 +415,10 @@ class TrackerClient:
             recv_buffer, recv_size = tcp_recv_response(conn, th.pkg_len)
             group_info = GroupInfo()
             group_info.set_info(recv_buffer)
-        except ConnectionError:
+        except BaseException:
+            self.pool.discard(conn)  # request may be half done
             raise
-        finally:
+        else:
             self.pool.release(conn)
         return group_info
 
@@ -427,9 +434,10 @@ class TrackerClient:
                     "[-] Error: %d, %s" % (th.status, os.strerror(th.status))
                 )
             recv_buffer, recv_size = tcp_recv_response(conn, th.pkg_len)
-        except:
+        except BaseException:
+            self.pool.discard(conn)  # request may be half done
             raise
-        finally:
+        else:
             self.pool.release(conn)
         gi = GroupInfo()
         gi_fmt_size = gi.get_fmt_size()
@@ -492,11 +500,10 @@ class TrackerClient:
         th = TrackerHeader()
         th.cmd = TRACKER_PROTO_CMD_SERVICE_QUERY_STORE_WITH_GROUP_ONE
         th.pkg_len = FDFS_GROUP_NAME_MAX_LEN
-        th.send_header(conn)
         group_fmt = "!%ds" % FDFS_GROUP_NAME_MAX_LEN
         send_buffer = struct.pack(group_fmt, group_name)
         try:
-            tcp_send_data(conn, send_buffer)
+            th.send_header(conn, send_buffer)
             th.recv_header(conn)
             if th.status != 0:
                 raise DataError("Error: %d, %s" % (th.status, os.strerror(th.status)))
@@ -508,9 +515,10 @@ class TrackerClient:
                     recv_size,
                 )
                 raise ResponseError(errmsg)
-        except ConnectionError:
+        except BaseException:
+            self.pool.discard(conn)  # request may be half done
             raise
-        finally:
+        else:
             self.pool.release(conn)
         # recv_fmt: |-group_name(16)-ipaddr(16-1)-port(8)-store_path_index(1)-|
         recv_fmt = "!%ds %ds Q B" % (FDFS_GROUP_NAME_MAX_LEN, IP_ADDRESS_SIZE - 1)
@@ -531,36 +539,51 @@ class TrackerClient:
         @filename: string. remote file_id
         @Return: StorageServer object
         """
+        return self._tracker_do_query_storages(group_name, filename, cmd)[0]
+
+    def _tracker_do_query_storages(self, group_name, filename, cmd):
+        """
+        Query storage servers of file, the response of FETCH_ALL has ip address
+        of the other servers in group after the first one.
+        @Return: list of StorageServer objects
+        """
         conn = self.pool.get_connection()
         th = TrackerHeader()
         file_name_len = len(filename)
         th.pkg_len = FDFS_GROUP_NAME_MAX_LEN + file_name_len
         th.cmd = cmd
-        th.send_header(conn)
         # query_fmt: |-group_name(16)-filename(file_name_len)-|
         query_fmt = "!%ds %ds" % (FDFS_GROUP_NAME_MAX_LEN, file_name_len)
         send_buffer = struct.pack(query_fmt, group_name.encode(), filename.encode())
         try:
-            tcp_send_data(conn, send_buffer)
+            th.send_header(conn, send_buffer)
             th.recv_header(conn)
             if th.status != 0:
                 raise DataError("Error: %d, %s" % (th.status, os.strerror(th.status)))
             recv_buffer, recv_size = tcp_recv_response(conn, th.pkg_len)
-            if recv_size != TRACKER_QUERY_STORAGE_FETCH_BODY_LEN:
+            extra_size = recv_size - TRACKER_QUERY_STORAGE_FETCH_BODY_LEN
+            if extra_size < 0 or extra_size % (IP_ADDRESS_SIZE - 1):
                 errmsg = "[-] Error: Tracker response length is invaild, "
                 errmsg += "expect: %d, actual: %d" % (th.pkg_len, recv_size)
                 raise ResponseError(errmsg)
-        except ConnectionError:
+        except BaseException:
+            self.pool.discard(conn)  # request may be half done
             raise
-        finally:
+        else:
             self.pool.release(conn)
-        # recv_fmt: |-group_name(16)-ip_addr(16)-port(8)-|
-        recv_fmt = "!%ds %ds Q" % (FDFS_GROUP_NAME_MAX_LEN, IP_ADDRESS_SIZE - 1)
-        store_serv = StorageServer()
-        (group_name, ipaddr, store_serv.port) = struct.unpack(recv_fmt, recv_buffer)
-        store_serv.group_name = group_name.strip(b"\x00")
-        store_serv.ip_addr = ipaddr.strip(b"\x00")
-        return store_serv
+        # recv_fmt: |-group_name(16)-ip_addr(16)-port(8)-ip_addr(16)*n-|
+        ip_fmt = "%ds" % (IP_ADDRESS_SIZE - 1)
+        recv_fmt = "!%ds %s Q" % (FDFS_GROUP_NAME_MAX_LEN, ip_fmt)
+        recv_fmt += " " + ip_fmt * (extra_size // (IP_ADDRESS_SIZE - 1))
+        group_name, main_ip, port, *other_ips = struct.unpack(recv_fmt, recv_buffer)
+        servers = []
+        for ipaddr in (main_ip, *other_ips):
+            store_serv = StorageServer()
+            store_serv.group_name = group_name.strip(b"\x00")
+            store_serv.ip_addr = ipaddr.strip(b"\x00")
+            store_serv.port = port
+            servers.append(store_serv)
+        return servers
 
     def tracker_query_storage_update(self, group_name, filename):
         """
@@ -578,30 +601,48 @@ class TrackerClient:
             group_name, filename, TRACKER_PROTO_CMD_SERVICE_QUERY_FETCH_ONE
         )
 
+    def tracker_query_storage_fetch_all(self, group_name, filename):
+        """
+        Query all storage servers that keep the file, to download from any of them.
+        @Return: list of StorageServer objects
+        """
+        return self._tracker_do_query_storages(
+            group_name, filename, TRACKER_PROTO_CMD_SERVICE_QUERY_FETCH_ALL
+        )
+
     @staticmethod
     async def get_storage_server(
-        host_info: tuple[str, int], group_name="", filename=""
+        host_info: tuple[str, int],
+        group_name="",
+        filename="",
+        socket_options: SocketOptions | None = None,
+        pool: AsyncConnectionPool | None = None,
+        fetch: bool = False,
     ) -> StorageServer:
         """Query storage server for upload, without group name.
+        If filename is given, query the one to update it, or to download it when
+        `fetch` is True.
         Return: StorageServer object"""
         pkg_len = file_name_len = len(filename)
         if is_delete := bool(file_name_len):
             cmd = TRACKER_PROTO_CMD_SERVICE_QUERY_UPDATE
+            if fetch:
+                cmd = TRACKER_PROTO_CMD_SERVICE_QUERY_FETCH_ONE
             pkg_len += FDFS_GROUP_NAME_MAX_LEN
         else:
             cmd = TRACKER_PROTO_CMD_SERVICE_QUERY_STORE_WITHOUT_GROUP_ONE
         th = TrackerHeader(cmd=cmd, pkg_len=pkg_len)
-        async with await anyio.connect_tcp(*host_info) as client:
-            await client.send(th.build_header())
-            expected_len = TRACKER_QUERY_STORAGE_STORE_BODY_LEN
-            if is_delete:
-                expected_len = TRACKER_QUERY_STORAGE_FETCH_BODY_LEN
-                # query_fmt: |-group_name(16)-filename(file_name_len)-|
-                query_fmt = "!%ds %ds" % (FDFS_GROUP_NAME_MAX_LEN, file_name_len)
-                send_buffer = struct.pack(
-                    query_fmt, group_name.encode(), filename.encode()
-                )
-                await client.send(send_buffer)
+        bodies = []
+        expected_len = TRACKER_QUERY_STORAGE_STORE_BODY_LEN
+        if is_delete:
+            expected_len = TRACKER_QUERY_STORAGE_FETCH_BODY_LEN
+            # query_fmt: |-group_name(16)-filename(file_name_len)-|
+            query_fmt = "!%ds %ds" % (FDFS_GROUP_NAME_MAX_LEN, file_name_len)
+            bodies.append(
+                struct.pack(query_fmt, group_name.encode(), filename.encode())
+            )
+        async with open_stream(*host_info, socket_options, pool) as client:
+            await th.send_header_async(client, *bodies)
             await th.verify_header(client)
             recv_buffer = await tcp_receive(client, th.pkg_len, expected_len)
         if is_delete:
@@ -618,4 +659,6 @@ class TrackerClient:
             ip_addr=ip.strip(b"\x00"),
             port=port,
             store_path_index=path_index,
+            socket_options=socket_options,
+            pool=pool,
         )
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""Throughput of file upload/download loops by buffer size, over a local socket.
+
+Usage: python scripts/bench_io.py [size_in_MiB]
+"""
+
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from fastdfs_client.connection import Connection
+from fastdfs_client.storage_client import tcp_recv_file, tcp_send_file
+
+
+def drain(sock: socket.socket, size: int) -> None:
+    buf = bytearray(1 << 20)
+    while size > 0:
+        size -= sock.recv_into(buf)
+
+
+def feed(sock: socket.socket, size: int) -> None:
+    chunk = bytes(1 << 20)
+    while size > 0:
+        size -= sock.send(chunk[:size])
+
+
+def bench(filename: str, size: int, buffer_size: int | None) -> tuple[float, float]:
+    left, right = socket.socketpair()
+    conn = Connection.from_socket(left, 30)
+    t = threading.Thread(target=drain, args=(right, size))
+    t.start()
+    start = time.perf_counter()
+    tcp_send_file(conn, filename, buffer_size)
+    t.join()
+    upload = time.perf_counter() - start
+    t = threading.Thread(target=feed, args=(right, size))
+    t.start()
+    start = time.perf_counter()
+    tcp_recv_file(conn, filename + ".down", size, buffer_size)
+    t.join()
+    download = time.perf_counter() - start
+    left.close()
+    right.close()
+    return upload, download
+
+
+def main() -> None:
+    size = int(sys.argv[1] if len(sys.argv) > 1 else 128) << 20
+    with tempfile.TemporaryDirectory() as d:
+        filename = os.path.join(d, "bench.bin")
+        with open(filename, "wb") as f:
+            f.write(os.urandom(size))
+        for buffer_size in (1024, 64 * 1024, None):
+            upload, download = bench(filename, size, buffer_size)
+            print(
+                f"buffer_size={buffer_size or 'adaptive'}: "
+                f"upload {size / upload / 2**20:.0f} MiB/s, "
+                f"download {size / download / 2**20:.0f} MiB/s"
+            )
+
+
+if __name__ == "__main__":
+    main()
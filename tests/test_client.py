@@ -1,3 +1,5 @@
+import socket
+import time
 from contextlib import contextmanager
 from pathlib import Path
 from typing import Generator
@@ -5,6 +7,7 @@ from typing import Generator
 import pytest
 
 from fastdfs_client.client import Config, FastdfsClient, get_tracker_conf, is_IPv4
+from fastdfs_client.connection import RetryPolicy
 from fastdfs_client.exceptions import ConfigError, DataError
 
 
@@ -24,6 +27,13 @@ def test_config_create():
         "timeout": Config.timeout,
         "name": Config.name,
     }
+    retry = RetryPolicy(attempts=3, deadline=5)
+    conf = Config.create((ip,), retry=retry)
+    assert conf["retry"] == retry
+    assert FastdfsClient(conf).tracker_pool.retry == retry
+    client = FastdfsClient([ip], retry=retry)
+    assert client.tracker_pool.retry == retry
+    assert client.storage_pools.get(ip, 23000).retry == retry
 
 
 def test_conf_file():
@@ -61,9 +71,16 @@ def test_conf_string_and_dict():
         FastdfsClient({})
 
 
-def test_build_host():
+def test_build_host(monkeypatch):
     domain = "dfs.waketzheng.top"
     ip = "120.77.47.33"
+
+    def get_domain_ip(host: str) -> str:
+        if host != domain:
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        return ip
+
+    monkeypatch.setattr(FastdfsClient, "get_domain_ip", staticmethod(get_domain_ip))
     client = FastdfsClient([domain])
     assert client._build_host(ip) == f"https://{domain}/"
     client2 = FastdfsClient([domain], ssl=False)
@@ -76,6 +93,59 @@ def test_build_host():
     assert client5._build_host(ip) == f"https://{domain}/"
     client6 = FastdfsClient([domain], ip_mapping={ip: domain})
     assert client6._build_host(ip) == f"https://{domain}/"
+    # the domain can not be resolved, fall back to the ip
+    client7 = FastdfsClient(["unknown.example.com"])
+    assert client7._build_host(ip) == f"http://{ip}/"
+    client8 = FastdfsClient(["unknown.example.com", domain])
+    assert client8._build_host(ip) == f"https://{domain}/"
+
+
+def test_url_prefix_cache(monkeypatch):
+    domain, ip = "example.com", "10.0.0.1"
+    lookups: list[str] = []
+
+    def get_domain_ip(host: str) -> str:
+        lookups.append(host)
+        return ip
+
+    monkeypatch.setattr(FastdfsClient, "get_domain_ip", staticmethod(get_domain_ip))
+    client = FastdfsClient([domain], ip_mapping={"10.0.0.2": "http://cdn.com"})
+    client.url_prefix_ttl = 0.1
+    assert lookups == []  # no DNS lookup in constructor
+    assert client._build_host(ip) == f"https://{domain}/"
+    assert lookups == [domain]  # built on first use
+    for _ in range(3):
+        assert client._build_host(ip) == f"https://{domain}/"
+        assert client._build_host("10.0.0.2") == "http://cdn.com/"
+        assert client._build_host("10.0.0.3") == "http://10.0.0.3/"
+    assert lookups == [domain]
+    ip = "10.0.0.4"  # domain points to another ip
+    time.sleep(0.1)  # url_prefix_ttl expires
+    client._build_host(ip)  # expired table is used, and reloaded in background
+    for _ in range(100):
+        if ip in (client._url_prefixes or {}):
+            break
+        time.sleep(0.01)
+    assert client._build_host(ip) == f"https://{domain}/"
+    assert lookups == [domain, domain]
+
+
+@pytest.mark.anyio
+async def test_url_prefix_async(monkeypatch):
+    domain, ip = "example.com", "10.0.0.1"
+    lookups: list[str] = []
+
+    def get_domain_ip(host: str) -> str:
+        lookups.append(host)
+        return ip
+
+    monkeypatch.setattr(FastdfsClient, "get_domain_ip", staticmethod(get_domain_ip))
+    client = FastdfsClient([domain])
+    async_client = client.async_client
+    async_client.dns._store(domain, ip)
+    assert await async_client._build_host_async(ip) == f"https://{domain}/"
+    assert await async_client._build_host_async("10.0.0.3") == "http://10.0.0.3/"
+    assert lookups == []  # resolved by the async DNS cache only
 
 
 def test_upload_url():
@@ -108,8 +178,13 @@ def test_upload_filename():
 def test_upload_file():
     domain = "dfs.waketzheng.top"
     client = FastdfsClient([domain])
-    with pytest.raises(NotImplementedError):
-        client.upload_by_file(__file__)
+    ret = client.upload_by_file(__file__)
+    remote_file_id = ret["Remote file_id"]
+    assert client.download_to_buffer(remote_file_id)["Content"] == (
+        Path(__file__).read_bytes()
+    )
+    r = client.delete_file(remote_file_id)
+    assert remote_file_id in str(r)
 
 
 @contextmanager
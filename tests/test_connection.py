@@ -0,0 +1,690 @@
+import contextlib
+import gc
+import os
+import socket
+import threading
+import time
+import tracemalloc
+import weakref
+import zlib
+from typing import Generator
+
+import anyio
+import pytest
+from anyio.abc import SocketAttribute
+
+from fastdfs_client import storage_client
+from fastdfs_client.connection import (
+    AsyncConnectionPool,
+    Connection,
+    ConnectionPool,
+    DnsCache,
+    HostSelector,
+    PoolRegistry,
+    RetryPolicy,
+    _reaper,
+    tcp_recv_response,
+)
+from fastdfs_client.exceptions import ConnectionError, DataError
+from fastdfs_client.protols import (
+    FDFS_PROTO_CMD_ACTIVE_TEST,
+    SMALL_BODY_SIZE,
+    Crc32,
+    SocketOptions,
+    TrackerHeader,
+    connect_tcp,
+    sendmsg_all,
+)
+from fastdfs_client.storage_client import (
+    MAX_BUFFER_SIZE,
+    MIN_BUFFER_SIZE,
+    MMAP_MIN_SIZE,
+    adaptive_buffer_size,
+    tcp_recv_file,
+    tcp_send_file,
+    tcp_send_file_ex,
+)
+
+
+@pytest.fixture
+def server() -> Generator[tuple[str, int], None, None]:
+    with socket.create_server(("127.0.0.1", 0), backlog=64) as sock:
+        yield sock.getsockname()
+
+
+@pytest.fixture
+def socketpair_conn() -> Generator[tuple[Connection, socket.socket], None, None]:
+    """A connection and the socket at the other end, which plays the server."""
+    left, right = socket.socketpair()
+    conn = Connection.from_socket(left, 3)
+    yield conn, right
+    conn.disconnect()
+    right.close()
+
+
+class ActiveTestServer:
+    """Answer FDFS_PROTO_CMD_ACTIVE_TEST, the accepted sockets can be killed."""
+
+    def __init__(self) -> None:
+        self.sock = socket.create_server(("127.0.0.1", 0))
+        self.clients: list[socket.socket] = []
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    @property
+    def address(self) -> tuple[str, int]:
+        return self.sock.getsockname()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            self.clients.append(client)
+            threading.Thread(target=self._serve, args=(client,), daemon=True).start()
+
+    def _serve(self, client: socket.socket) -> None:
+        th = TrackerHeader()
+        with contextlib.suppress(OSError):
+            while header := client.recv(th.header_len()):
+                th._unpack(header)
+                assert th.cmd == FDFS_PROTO_CMD_ACTIVE_TEST
+                client.sendall(TrackerHeader(cmd=100).build_header())
+
+    def kill_clients(self) -> None:
+        while self.clients:
+            client = self.clients.pop()
+            with contextlib.suppress(OSError):  # closed by client already
+                client.shutdown(socket.SHUT_RDWR)
+            client.close()
+
+    def close(self) -> None:
+        self.kill_clients()
+        self.sock.close()
+
+
+@pytest.fixture
+def fdfs_server() -> Generator[ActiveTestServer, None, None]:
+    server = ActiveTestServer()
+    yield server
+    server.close()
+
+
+def test_pool_reuse_connection(server):
+    ip, port = server
+    pool = ConnectionPool(host_tuple=(ip,), port=port, timeout=3)
+    for _ in range(5):
+        with pool.open_connection() as conn:
+            assert conn.get_sock() is not None
+    assert pool.stats.requests == 5
+    assert pool.stats.connects == 1
+    assert pool.stats.connects_per_request == 0.2
+    pool.destroy()
+
+
+def test_pool_registry(server):
+    ip, port = server
+    registry = PoolRegistry(max_pools=2, timeout=3)
+    pool = registry.get(ip, port)
+    assert registry.get(ip.encode(), port) is pool
+    assert (ip, port) in registry
+    with pool.open_connection():
+        pass
+    registry.get(ip, port + 1)
+    registry.get(ip, port + 2)  # the least recently used one is evicted
+    assert len(registry) == 2
+    assert (ip, port) not in registry
+    assert not pool._conns_available
+    registry.discard(ip, port + 1)
+    assert len(registry) == 1
+    registry.destroy()
+    assert len(registry) == 0
+
+
+def test_pool_block_until_released(server):
+    ip, port = server
+    pool = ConnectionPool(
+        host_tuple=(ip,), port=port, timeout=3, max_conn=1, block=True
+    )
+    conn = pool.get_connection()
+    timer = threading.Timer(0.1, pool.release, (conn,))
+    timer.start()
+    assert pool.get_connection() is conn
+    timer.join()
+    assert pool.stats.waits == 1
+    assert pool.stats.wait_time >= 0.05
+    assert pool.stats.max_wait == pool.stats.avg_wait == pool.stats.wait_time
+    pool.destroy()
+
+
+def test_pool_wait_timeout(server):
+    ip, port = server
+    kw = dict(host_tuple=(ip,), port=port, timeout=3, max_conn=1)
+    pool = ConnectionPool(block=True, wait_timeout=0.05, **kw)
+    pool.get_connection()
+    with pytest.raises(ConnectionError):
+        pool.get_connection()
+    assert pool.stats.wait_timeouts == 1
+    pool.destroy()
+    nonblock_pool = ConnectionPool(**kw)
+    nonblock_pool.get_connection()
+    with pytest.raises(ConnectionError):
+        nonblock_pool.get_connection()
+    assert nonblock_pool.stats.waits == 0
+    nonblock_pool.destroy()
+
+
+def test_pool_shared_by_threads(server):
+    ip, port = server
+    pool = ConnectionPool(
+        host_tuple=(ip,), port=port, timeout=3, max_conn=4, block=True
+    )
+
+    def worker() -> None:
+        for _ in range(50):
+            with pool.open_connection():
+                time.sleep(0.0001)
+
+    threads = [threading.Thread(target=worker) for _ in range(16)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert pool.stats.requests == 800
+    assert pool.stats.connects <= 4
+    assert len(pool._conns_available) == pool._conns_created <= 4
+    assert not pool._conns_inuse
+    pool.destroy()
+
+
+def test_pool_idle_timeout_and_max_lifetime(server):
+    ip, port = server
+    kw = dict(host_tuple=(ip,), port=port, timeout=3, reap_interval=0)
+    pool = ConnectionPool(idle_timeout=0.05, **kw)
+    with pool.open_connection() as conn:
+        pass
+    assert pool.get_connection() is conn
+    pool.release(conn)
+    time.sleep(0.1)
+    assert pool.get_connection() is not conn  # idle too long
+    assert conn.get_sock() is None
+    assert pool.stats.expired == 1
+    assert pool.stats.connects == 2
+    pool.destroy()
+
+    pool = ConnectionPool(max_lifetime=0.05, **kw)
+    with pool.open_connection() as conn:
+        time.sleep(0.1)
+    assert conn.get_sock() is None  # closed on release
+    assert pool.stats.expired == 1
+    assert not pool._conns_available
+    assert pool._conns_created == 0
+
+
+def test_pool_reaper(server):
+    ip, port = server
+    pool = ConnectionPool(host_tuple=(ip,), port=port, timeout=3, idle_timeout=0.05)
+    assert pool.reap_interval == 0.025
+    with pool.open_connection() as conn:
+        pass
+    for _ in range(40):
+        if conn.get_sock() is None:
+            break
+        time.sleep(0.025)
+    assert conn.get_sock() is None
+    assert pool.stats.expired == 1
+    assert pool._conns_created == 0
+
+
+def test_pool_reaper_drops_pool(server):
+    ip, port = server
+    pool = ConnectionPool(host_tuple=(ip,), port=port, timeout=3, idle_timeout=600)
+    assert pool in _reaper._pools
+    time.sleep(0.05)  # swept by reaper, which waits for a long time then
+    ref = weakref.ref(pool)
+    del pool
+    gc.collect()
+    assert ref() is None  # and so it leaves the weak registry of reaper
+
+
+def test_pool_ping_before_reuse(fdfs_server):
+    ip, port = fdfs_server.address
+    pool = ConnectionPool(host_tuple=(ip,), port=port, timeout=3, ping_idle=0)
+    with pool.open_connection() as conn:
+        pass
+    with pool.open_connection() as conn2:
+        assert conn2 is conn
+    assert pool.stats.pings == 1
+    fdfs_server.kill_clients()
+    with pool.open_connection() as conn3:
+        assert conn3 is not conn  # dead one is replaced silently
+    assert conn.get_sock() is None
+    assert pool.stats.dead == 1
+    assert pool.stats.connects == 2
+    assert pool._conns_created == 1
+    pool.destroy()
+
+    hot_pool = ConnectionPool(host_tuple=(ip,), port=port, timeout=3, ping_idle=60)
+    for _ in range(3):
+        with hot_pool.open_connection():
+            pass
+    assert hot_pool.stats.pings == 0
+    hot_pool.destroy()
+
+
+def test_host_selector():
+    selector = HostSelector(max_failures=2, cooldown=0.05)
+    hosts = ("a", "b")
+    selector.failure("a", 1)
+    assert selector.health("a", 1).failures == 1
+    assert "a" in {selector.choose(hosts, 1) for _ in range(50)}
+    selector.failure("a", 1)  # circuit open
+    assert {selector.choose(hosts, 1) for _ in range(50)} == {"b"}
+    time.sleep(0.06)
+    assert selector.choose(hosts, 1) == "a"  # half-open probe
+    assert selector.choose(hosts, 1) == "b"  # only one probe at a time
+    selector.success("a", 1)
+    assert selector.health("a", 1).failures == 0
+    selector.failure("a", 2)
+    selector.failure("a", 2)
+    selector.failure("b", 2)
+    selector.failure("b", 2)
+    assert selector.choose(hosts, 2) == "a"  # all down, recover soonest
+
+
+def test_host_selector_probe_interrupted(server, monkeypatch):
+    ip, port = server
+    selector = HostSelector(cooldown=0)
+    selector.failure(ip, port)  # circuit open, half-open at once
+    conn = Connection((ip,), port, 3, selector=selector)
+
+    def apply(sock):
+        raise ValueError("unexpected")
+
+    monkeypatch.setattr(conn.socket_options, "apply", apply)
+    with pytest.raises(ValueError):
+        conn.connect()  # the probe ends without a result
+    assert not selector.health(ip, port).probing
+    monkeypatch.undo()
+    conn.connect()  # probed again
+    assert selector.health(ip, port).failures == 0
+    conn.disconnect()
+
+
+def test_pool_skip_dead_host(server):
+    ip, port = server
+    dead_ip = "127.0.0.2"  # nothing listen on it
+    pool = ConnectionPool(host_tuple=(dead_ip, ip), port=port, timeout=3)
+    conns = [pool.make_conn() for _ in range(20)]
+    assert {c.remote_addr for c in conns} == {ip}
+    assert pool.selector.health(dead_ip, port).failures <= 1
+    for c in conns:
+        c.disconnect()
+
+
+def test_host_selector_prefer_faster():
+    selector = HostSelector(alpha=0.5)
+    hosts: tuple[str, ...] = ("fast", "slow")
+    selector.success("fast", 1, 0.01)
+    selector.success("slow", 1, 0.2)
+    assert {selector.choose(hosts, 1) for _ in range(20)} == {"fast"}
+    for _ in range(10):
+        selector.observe("fast", 1, 0.5)
+    assert 0.2 < selector.health("fast", 1).latency < 0.5  # type:ignore
+    assert selector.choose(hosts, 1) == "slow"
+    hosts = ("a", "b", "c")
+    for host, latency in zip(hosts, (0.1, 0.2, 0.3)):
+        selector.success(host, 1, latency)
+    chosen = [selector.choose(hosts, 1) for _ in range(300)]
+    assert chosen.count("a") > chosen.count("b") > chosen.count("c") == 0
+
+
+def test_retry_policy(server):
+    retry = RetryPolicy(base_delay=0.1, max_delay=0.3)
+    assert all(0 <= retry.backoff(0) <= 0.1 for _ in range(20))
+    assert all(0 <= retry.backoff(5) <= 0.3 for _ in range(20))
+    ip, port = server
+    with socket.create_server(("127.0.0.1", 0)) as sock:
+        closed_port = sock.getsockname()[1]
+    retry = RetryPolicy(attempts=100, base_delay=0.02, max_delay=0.05, deadline=0.2)
+    pool = ConnectionPool(host_tuple=(ip,), port=closed_port, timeout=3, retry=retry)
+    started_at = time.monotonic()
+    with pytest.raises(ConnectionError):
+        pool.get_connection()
+    assert 0.15 < time.monotonic() - started_at < 1
+    assert pool._conns_created == 0
+    pool = ConnectionPool(
+        host_tuple=(ip,), port=closed_port, timeout=3, retry=RetryPolicy(attempts=3)
+    )
+    with pytest.raises(ConnectionError, match="3 times"):
+        pool.get_connection()
+
+
+def test_pool_warm_up(server):
+    ip, port = server
+    pool = ConnectionPool(host_tuple=(ip,), port=port, timeout=3, max_conn=6)
+    assert pool.warm_up(4) == 4
+    assert len(pool._conns_available) == pool._conns_created == 4
+    assert pool.warm_up(4) == 0  # already warm
+    assert pool.warm_up(10) == 2  # limited by max_conn
+    conns = [pool.get_connection() for _ in range(6)]
+    assert pool.stats.connects == 6
+    for conn in conns:
+        pool.release(conn)
+    pool.destroy()
+    with socket.create_server(("127.0.0.1", 0)) as sock:
+        closed_port = sock.getsockname()[1]
+    pool = ConnectionPool(
+        host_tuple=(ip,), port=closed_port, timeout=3, retry=RetryPolicy(attempts=1)
+    )
+    assert pool.warm_up(2) == 0
+    assert pool._conns_created == 0
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="fork is not supported")
+def test_pool_after_fork(fdfs_server):
+    ip, port = fdfs_server.address
+    pool = ConnectionPool(host_tuple=(ip,), port=port, timeout=3, fork_warm_up=2)
+    with pool.open_connection() as conn:
+        pass
+    pid = os.fork()
+    if pid == 0:  # child
+        code = 1
+        try:
+            if conn.get_sock() is None and conn not in pool._conns_available:
+                code = 2
+                for _ in range(100):
+                    if len(pool._conns_available) == 2:
+                        break
+                    time.sleep(0.02)
+                with pool.open_connection() as new_conn:
+                    if new_conn.active_test() and pool.stats.connects == 2:
+                        code = 0
+        finally:
+            os._exit(code)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+    assert conn.active_test()  # the connection of parent is not affected
+    assert pool.pid == os.getpid()
+    assert pool._conns_available == [conn]
+    pool.destroy()
+
+
+def _getsockopt(sock: socket.socket, level: int, name: str) -> int:
+    return sock.getsockopt(level, getattr(socket, name))
+
+
+def test_socket_options(server):
+    ip, port = server
+    conn = Connection((ip,), port, 3)
+    conn.connect()
+    assert _getsockopt(conn.get_sock(), socket.IPPROTO_TCP, "TCP_NODELAY")
+    conn.disconnect()
+    options = SocketOptions(
+        tcp_nodelay=False,
+        sndbuf=65536,
+        keepalive=True,
+        keepalive_interval=7,
+    )
+    conn = Connection((ip,), port, 3, socket_options=options)
+    conn.connect()
+    sock = conn.get_sock()
+    assert not _getsockopt(sock, socket.IPPROTO_TCP, "TCP_NODELAY")
+    assert _getsockopt(sock, socket.SOL_SOCKET, "SO_SNDBUF") >= 65536
+    assert _getsockopt(sock, socket.SOL_SOCKET, "SO_KEEPALIVE")
+    if hasattr(socket, "TCP_KEEPINTVL"):
+        assert _getsockopt(sock, socket.IPPROTO_TCP, "TCP_KEEPINTVL") == 7
+    conn.disconnect()
+
+
+@pytest.mark.anyio
+async def test_socket_options_async(server):
+    ip, port = server
+    options = SocketOptions(keepalive=True)
+    async with await connect_tcp(ip, port, options) as client:
+        sock = client.extra(SocketAttribute.raw_socket)
+        assert _getsockopt(sock, socket.IPPROTO_TCP, "TCP_NODELAY")
+        assert _getsockopt(sock, socket.SOL_SOCKET, "SO_KEEPALIVE")
+
+
+async def _active_test(client) -> None:
+    th = TrackerHeader(cmd=FDFS_PROTO_CMD_ACTIVE_TEST)
+    await client.send(th.build_header())
+    await th.verify_header(client)
+
+
+@pytest.mark.anyio
+async def test_async_pool(fdfs_server):
+    ip, port = fdfs_server.address
+    pool = AsyncConnectionPool(max_per_host=2)
+    for _ in range(5):
+        async with pool.connect(ip, port) as client:
+            await _active_test(client)
+    assert pool.stats.requests == 5
+    assert pool.stats.connects == 1
+
+    async def worker() -> None:
+        async with pool.connect(ip, port) as client:
+            await _active_test(client)
+            await anyio.sleep(0.01)
+
+    async with anyio.create_task_group() as tg:
+        for _ in range(6):
+            tg.start_soon(worker)
+    assert pool.stats.connects == 2  # limited by max_per_host
+
+    fdfs_server.kill_clients()
+    await anyio.sleep(0.05)
+    async with pool.connect(ip, port) as client:
+        await _active_test(client)
+    assert pool.stats.dead == 2
+    assert pool.stats.connects == 3
+    await pool.aclose()
+
+
+@pytest.mark.anyio
+async def test_async_pool_without_fromfd(fdfs_server, monkeypatch):
+    monkeypatch.delattr(socket, "fromfd")
+    ip, port = fdfs_server.address
+    pool = AsyncConnectionPool()
+    for _ in range(3):
+        async with pool.connect(ip, port) as client:
+            await _active_test(client)
+    assert pool.stats.connects == 1  # reused without peeking
+    assert pool.stats.dead == 0
+    await pool.aclose()
+
+
+@pytest.mark.anyio
+async def test_async_pool_cancelled_and_idle(fdfs_server):
+    ip, port = fdfs_server.address
+    pool = AsyncConnectionPool(idle_timeout=0.05)
+    with anyio.move_on_after(0.05):
+        async with pool.connect(ip, port) as client:
+            await client.send(
+                TrackerHeader(cmd=FDFS_PROTO_CMD_ACTIVE_TEST).build_header()
+            )
+            await anyio.sleep(1)  # cancelled before reading the response
+    async with pool.connect(ip, port) as client2:
+        assert client2 is not client  # the half-used stream is not reused
+        await _active_test(client2)
+    assert pool.stats.connects == 2
+    await anyio.sleep(0.1)
+    async with pool.connect(ip, port) as client3:
+        assert client3 is not client2
+    assert pool.stats.expired == 1
+    await pool.aclose()
+
+
+@pytest.mark.anyio
+async def test_dns_cache():
+    dns = DnsCache(ttl=60)
+    assert await dns.resolve("localhost") == "127.0.0.1"
+    dns._answers["localhost"] = ("127.0.0.9", time.monotonic())  # expired
+    assert await dns.resolve("localhost") == "127.0.0.9"  # stale one, no waiting
+    for _ in range(100):
+        if dns._answers["localhost"][0] == "127.0.0.1":
+            break
+        await anyio.sleep(0.01)
+    assert await dns.resolve("localhost") == "127.0.0.1"  # refreshed in background
+    assert not dns._refreshing
+
+
+def test_recv_exact_length(socketpair_conn):
+    conn, right = socketpair_conn
+    header = TrackerHeader(pkg_len=8 << 20, cmd=100).build_header()
+    payload = os.urandom(8 << 20)
+
+    def send() -> None:
+        right.sendall(header[:3])
+        time.sleep(0.01)
+        right.sendall(header[3:])  # a header may arrive in pieces
+        right.sendall(payload)
+
+    sender = threading.Thread(target=send)
+    sender.start()
+    th = TrackerHeader()
+    th.recv_header(conn)
+    assert th.pkg_len == len(payload)
+    tracemalloc.start()
+    body, size = tcp_recv_response(conn, th.pkg_len)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    sender.join()
+    assert size == len(payload) and body == payload
+    assert peak < len(payload) * 1.1  # no chunks to be joined
+    right.sendall(b"abc")
+    right.close()
+    with pytest.raises(ConnectionError, match="closed"):
+        tcp_recv_response(conn, 10)
+
+
+def test_send_file_ex(tmp_path, socketpair_conn):
+    conn, right = socketpair_conn
+    conn.get_sock().settimeout(3)  # non-blocking fd, sendfile may get EAGAIN
+    path = tmp_path / "a.bin"
+    content = os.urandom(4 << 20)
+    path.write_bytes(content)
+    received = bytearray()
+
+    def recv() -> None:
+        while len(received) < len(content):
+            time.sleep(0.001)  # slow reader, to make partial sends
+            received.extend(right.recv(1 << 16))
+
+    receiver = threading.Thread(target=recv)
+    receiver.start()
+    assert tcp_send_file_ex(conn, str(path)) == len(content)
+    receiver.join()
+    assert received == content
+    with pytest.raises(DataError):
+        tcp_send_file_ex(conn, str(tmp_path / "missing"))
+
+
+@pytest.mark.parametrize("buffer_size", [1000, None])
+def test_send_and_recv_file(tmp_path, buffer_size, socketpair_conn):
+    conn, right = socketpair_conn
+    content = os.urandom(3 << 20)
+    path = tmp_path / "a.bin"
+    path.write_bytes(content)
+    threading.Thread(target=right.sendall, args=(content,)).start()
+    down = tmp_path / "b.bin"
+    assert tcp_recv_file(conn, down, len(content), buffer_size) == len(content)
+    assert down.read_bytes() == content
+    received = bytearray()
+
+    def recv() -> None:
+        while len(received) < len(content):
+            received.extend(right.recv(1 << 16))
+
+    receiver = threading.Thread(target=recv)
+    receiver.start()
+    assert tcp_send_file(conn, path, buffer_size) == len(content)
+    receiver.join()
+    assert received == content
+    size = adaptive_buffer_size(conn.get_sock(), socket.SO_RCVBUF)
+    assert MIN_BUFFER_SIZE <= size <= MAX_BUFFER_SIZE
+
+
+@pytest.mark.parametrize("mapped", [True, False])
+def test_recv_file_mmap(tmp_path, monkeypatch, mapped, socketpair_conn):
+    if not mapped:  # e.g.: the file system does not support mmap
+        monkeypatch.setattr(storage_client, "map_file", lambda *args: None)
+    conn, right = socketpair_conn
+    content = os.urandom(MMAP_MIN_SIZE + 1)
+    threading.Thread(target=right.sendall, args=(content,)).start()
+    down = tmp_path / "b.bin"
+    down.write_bytes(content * 2)
+    assert tcp_recv_file(conn, down, len(content)) == len(content)
+    assert down.read_bytes() == content
+    right.sendall(content[:1000])
+    right.close()
+    with pytest.raises(ConnectionError):
+        tcp_recv_file(conn, down, len(content), checksum=Crc32())
+    assert down.stat().st_size <= 1000  # not mistaken for a complete one
+
+
+@pytest.mark.parametrize("size", [1000, MMAP_MIN_SIZE + 1])
+def test_checksum_while_transfer(tmp_path, size, socketpair_conn):
+    conn, right = socketpair_conn
+    content = os.urandom(size)
+    path = tmp_path / "a.bin"
+    path.write_bytes(content)
+    checksum = Crc32()
+    threading.Thread(target=right.sendall, args=(content * 2,)).start()
+    tcp_recv_file(conn, tmp_path / "b.bin", size, 100, checksum)
+    assert checksum.value == zlib.crc32(content)
+    checksum = Crc32()
+    tcp_recv_response(conn, size, checksum=checksum)
+    assert checksum.value == zlib.crc32(content)
+
+    def recv() -> None:
+        received = 0
+        while received < size:
+            received += len(right.recv(1 << 16))
+
+    checksum = Crc32()
+    receiver = threading.Thread(target=recv)
+    receiver.start()
+    tcp_send_file(conn, path, 100, checksum)
+    receiver.join()
+    assert checksum.value == zlib.crc32(content)
+
+
+def test_send_header_with_bodies(socketpair_conn):
+    conn, right = socketpair_conn
+    th = TrackerHeader(pkg_len=7, cmd=11)
+    th.send_header(conn, b"abc", b"", bytearray(b"defg"))
+    assert right.recv(4096) == th.build_header() + b"abcdefg"  # in one packet
+    bodies = [os.urandom(1 << 20) for _ in range(3)]
+    received = bytearray()
+
+    def recv() -> None:
+        while len(received) < 3 << 20:
+            received.extend(right.recv(1 << 16))
+
+    receiver = threading.Thread(target=recv)
+    receiver.start()
+    sendmsg_all(conn.get_sock(), bodies)  # resume partial sends
+    receiver.join()
+    assert received == b"".join(bodies)
+
+
+@pytest.mark.anyio
+async def test_send_header_async():
+    class Client:
+        def __init__(self) -> None:
+            self.sent: list[bytes] = []
+
+        async def send(self, data: bytes) -> None:
+            self.sent.append(data)
+
+    th = TrackerHeader(cmd=11)
+    client = Client()
+    await th.send_header_async(client, b"abc", b"def")
+    assert client.sent == [th.build_header() + b"abcdef"]
+    large = os.urandom(SMALL_BODY_SIZE + 1)
+    client = Client()
+    await th.send_header_async(client, b"abc", large)
+    assert client.sent == [th.build_header() + b"abc", large]
+    assert client.sent[1] is large
@@ -0,0 +1,603 @@
+import socket
+import struct
+import threading
+import time
+import zlib
+from typing import Generator
+
+import anyio
+import pytest
+
+from fastdfs_client import storage_client
+from fastdfs_client.client import AsyncDfsClient, Config, FastdfsClient
+from fastdfs_client.connection import ConnectionPool, RetryPolicy
+from fastdfs_client.exceptions import ConnectionError, DataError, PoolExhaustedError
+from fastdfs_client.protols import (
+    FDFS_FILE_EXT_NAME_MAX_LEN,
+    FDFS_GROUP_NAME_MAX_LEN,
+    IP_ADDRESS_SIZE,
+    STORAGE_PROTO_CMD_APPEND_FILE,
+    STORAGE_PROTO_CMD_DELETE_FILE,
+    STORAGE_PROTO_CMD_DOWNLOAD_FILE,
+    STORAGE_PROTO_CMD_MODIFY_FILE,
+    STORAGE_PROTO_CMD_QUERY_FILE_INFO,
+    STORAGE_PROTO_CMD_TRUNCATE_FILE,
+    STORAGE_PROTO_CMD_UPLOAD_APPENDER_FILE,
+    STORAGE_PROTO_CMD_UPLOAD_FILE,
+    TRACKER_PROTO_CMD_SERVICE_QUERY_FETCH_ALL,
+    TRACKER_PROTO_CMD_SERVICE_QUERY_FETCH_ONE,
+    TRACKER_PROTO_CMD_SERVICE_QUERY_STORE_WITHOUT_GROUP_ONE,
+    TRACKER_PROTO_CMD_SERVICE_QUERY_UPDATE,
+    StorageServer,
+    TrackerHeader,
+)
+from fastdfs_client.storage_client import MMAP_MIN_SIZE, StorageClient
+
+GROUP = b"group1"
+
+
+def recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        if not (chunk := sock.recv(size - len(data))):
+            raise EOFError
+        data += chunk
+    return data
+
+
+class FakeStorage:
+    """Storage server keeps files in memory, for the commands under test.
+    It is also the tracker that sends clients to `replicas`.
+    """
+
+    def __init__(self) -> None:
+        self.files: dict[bytes, bytes] = {}
+        self.replicas = [b"127.0.0.1"]
+        self.downloads: list[tuple[int, int]] = []
+        # Close the connection after sending this many bytes of next download
+        self.drop_after: int | None = None
+        # Flip the first byte of uploaded or downloaded content
+        self.corrupt = False
+        self.lock = threading.Lock()
+        self.handlers = {
+            STORAGE_PROTO_CMD_DOWNLOAD_FILE: self._download,
+            STORAGE_PROTO_CMD_UPLOAD_FILE: self._upload,
+            STORAGE_PROTO_CMD_UPLOAD_APPENDER_FILE: self._upload,
+            STORAGE_PROTO_CMD_QUERY_FILE_INFO: self._query_file_info,
+            STORAGE_PROTO_CMD_TRUNCATE_FILE: self._truncate,
+            STORAGE_PROTO_CMD_MODIFY_FILE: self._modify,
+            STORAGE_PROTO_CMD_APPEND_FILE: self._append,
+            STORAGE_PROTO_CMD_DELETE_FILE: self._delete,
+        }
+        self.sock = socket.create_server(("127.0.0.1", 0))
+        self.accepted = 0
+        self.uploads = 0
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    @property
+    def address(self) -> tuple[str, int]:
+        return self.sock.getsockname()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            self.accepted += 1
+            threading.Thread(target=self._serve, args=(client,), daemon=True).start()
+
+    def _serve(self, client: socket.socket) -> None:
+        th = TrackerHeader()
+        with client:
+            try:
+                while True:
+                    th._unpack(recv_exactly(client, th.header_len()))
+                    body = recv_exactly(client, th.pkg_len)
+                    if th.cmd in (
+                        TRACKER_PROTO_CMD_SERVICE_QUERY_FETCH_ONE,
+                        TRACKER_PROTO_CMD_SERVICE_QUERY_FETCH_ALL,
+                        TRACKER_PROTO_CMD_SERVICE_QUERY_UPDATE,
+                    ):
+                        status, content = 0, self._fetch(th.cmd)
+                    elif (
+                        th.cmd
+                        == TRACKER_PROTO_CMD_SERVICE_QUERY_STORE_WITHOUT_GROUP_ONE
+                    ):
+                        status, content = 0, self._fetch(th.cmd) + b"\x00"
+                    else:
+                        with self.lock:
+                            status, content = self.handlers[th.cmd](body)
+                    resp = TrackerHeader(pkg_len=len(content), cmd=100, status=status)
+                    data = resp.build_header() + content
+                    is_download = th.cmd == STORAGE_PROTO_CMD_DOWNLOAD_FILE
+                    if is_download and self.drop_after is not None:
+                        client.sendall(data[: self.drop_after])
+                        self.drop_after = None
+                        return
+                    client.sendall(data)
+            except (EOFError, OSError):
+                return
+
+    def _download(self, body: bytes) -> tuple[int, bytes]:
+        offset, size = struct.unpack_from("!Q Q", body)
+        filename = body[16 + FDFS_GROUP_NAME_MAX_LEN :]
+        self.downloads.append((offset, size))
+        if (content := self.files.get(filename)) is None:
+            return 2, b""
+        return 0, self._flip(content[offset : offset + size if size else None])
+
+    def _flip(self, content: bytes) -> bytes:
+        if not self.corrupt or not content:
+            return content
+        return bytes([content[0] ^ 1]) + content[1:]
+
+    def _upload(self, body: bytes) -> tuple[int, bytes]:
+        fmt = "!B Q %ds" % FDFS_FILE_EXT_NAME_MAX_LEN
+        _, size, ext = struct.unpack_from(fmt, body)
+        content = body[struct.calcsize(fmt) :]
+        if len(content) != size:
+            return 22, b""
+        filename = b"M00/00/00/%d.%s" % (self.uploads, ext.strip(b"\x00"))
+        self.uploads += 1
+        self.files[filename] = self._flip(content)
+        return 0, GROUP.ljust(FDFS_GROUP_NAME_MAX_LEN, b"\x00") + filename
+
+    def _truncate(self, body: bytes) -> tuple[int, bytes]:
+        _, size = struct.unpack_from("!Q Q", body)
+        filename = body[16:]
+        if (content := self.files.get(filename)) is None:
+            return 2, b""
+        self.files[filename] = content[:size].ljust(size, b"\x00")
+        return 0, b""
+
+    def _modify(self, body: bytes) -> tuple[int, bytes]:
+        name_len, offset, size = struct.unpack_from("!Q Q Q", body)
+        filename = body[24 : 24 + name_len]
+        if (content := self.files.get(filename)) is None:
+            return 2, b""
+        if offset > len(content):
+            return 22, b""
+        data = body[24 + name_len :]
+        self.files[filename] = content[:offset] + data + content[offset + size :]
+        return 0, b""
+
+    def _append(self, body: bytes) -> tuple[int, bytes]:
+        name_len, size = struct.unpack_from("!Q Q", body)
+        filename = body[16 : 16 + name_len]
+        if (content := self.files.get(filename)) is None:
+            return 2, b""
+        self.files[filename] = content + body[16 + name_len :]
+        return 0, b""
+
+    def _delete(self, body: bytes) -> tuple[int, bytes]:
+        if self.files.pop(body[FDFS_GROUP_NAME_MAX_LEN:], None) is None:
+            return 2, b""
+        return 0, b""
+
+    def _query_file_info(self, body: bytes) -> tuple[int, bytes]:
+        if (content := self.files.get(body[FDFS_GROUP_NAME_MAX_LEN:])) is None:
+            return 2, b""
+        info = struct.pack(
+            "!Q Q Q", len(content), int(time.time()), zlib.crc32(content)
+        )
+        return 0, info + b"127.0.0.1".ljust(IP_ADDRESS_SIZE, b"\x00")
+
+    def _fetch(self, cmd: int) -> bytes:
+        ip_size = IP_ADDRESS_SIZE - 1
+        first, *others = self.replicas
+        if cmd != TRACKER_PROTO_CMD_SERVICE_QUERY_FETCH_ALL:
+            others = []
+        resp = GROUP.ljust(FDFS_GROUP_NAME_MAX_LEN, b"\x00") + first.ljust(
+            ip_size, b"\x00"
+        )
+        resp += struct.pack("!Q", self.address[1])
+        return resp + b"".join(ip.ljust(ip_size, b"\x00") for ip in others)
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+@pytest.fixture
+def storage() -> Generator[FakeStorage, None, None]:
+    server = FakeStorage()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def store(storage) -> Generator[tuple[StorageClient, StorageServer], None, None]:
+    ip, port = storage.address
+    pool = ConnectionPool(host_tuple=(ip,), port=port, timeout=3)
+    yield (
+        StorageClient(ip, port, 3, pool=pool),
+        StorageServer(ip, port, group_name=GROUP),
+    )
+    pool.destroy()
+
+
+def test_iter_download(storage, store):
+    client, store_serv = store
+    content = bytes(range(256)) * 4096
+    storage.files[b"M00/00/00/a.bin"] = content
+    chunks = list(
+        client.storage_iter_download(store_serv, "M00/00/00/a.bin", chunk_size=10000)
+    )
+    assert b"".join(chunks) == content
+    assert max(map(len, chunks)) <= 10000
+    assert len(client.pool._conns_available) == 1  # returned when consumed
+    part = b"".join(client.storage_iter_download(store_serv, "M00/00/00/a.bin", 5, 7))
+    assert part == content[5:12]
+    assert storage.accepted == 1
+
+    it = client.storage_iter_download(store_serv, "M00/00/00/a.bin", chunk_size=100)
+    next(it)
+    it.close()  # abandoned halfway, the connection can not be reused
+    assert client.pool._conns_created == 0
+    assert not client.pool._conns_available
+
+    with pytest.raises(DataError):
+        next(client.storage_iter_download(store_serv, "M00/00/00/missing"))
+    assert len(client.pool._conns_available) == 1  # nothing unread, reusable
+
+
+def test_failed_download_discards_connection(storage, store, tmp_path):
+    client, store_serv = store
+    storage.files[b"M00/00/00/a.bin"] = bytes(range(256)) * 100
+    with pytest.raises(FileNotFoundError):
+        client.storage_download_to_file(
+            None,
+            store_serv,
+            str(tmp_path / "missing" / "a.bin"),
+            0,
+            0,
+            "M00/00/00/a.bin",
+        )
+    assert client.pool._conns_created == 0  # the body is unread
+    # the next command of the pool is not confused by the unread body
+    client.storage_delete_file(None, store_serv, b"M00/00/00/a.bin")
+    assert not storage.files
+    assert len(client.pool._conns_available) == 1
+
+
+def test_failed_mmap_download_discards_connection(storage, store, tmp_path):
+    client, store_serv = store
+    content = bytes(range(256)) * (MMAP_MIN_SIZE // 128)
+    storage.files[b"M00/00/00/a.bin"] = content
+    target = tmp_path / "a.bin"
+    storage.drop_after = MMAP_MIN_SIZE
+    with pytest.raises(ConnectionError):
+        client.storage_download_to_file(
+            None, store_serv, str(target), 0, 0, "M00/00/00/a.bin"
+        )
+    assert target.stat().st_size == 0  # not mistaken for a complete one
+    assert client.pool._conns_created == 0
+    assert client.pool.stats.dead == 1
+    client.storage_download_to_file(
+        None, store_serv, str(target), 0, 0, "M00/00/00/a.bin"
+    )
+    assert target.read_bytes() == content
+
+
+def test_short_send_discards_connection(storage, store, tmp_path):
+    client, store_serv = store
+    storage.files[b"M00/00/00/a.bin"] = bytes(100)
+    source = tmp_path / "a.bin"
+    source.write_bytes(b"0123456789")  # shorter than the ranges promised
+    with pytest.raises(ConnectionError, match="changed"):
+        client.storage_modify_by_range(
+            None, store_serv, str(source), 0, 50, "M00/00/00/a.bin"
+        )
+    with pytest.raises(ConnectionError, match="changed"):
+        client.storage_append_by_range(
+            None, store_serv, str(source), 5, 50, "M00/00/00/a.bin"
+        )
+    assert client.pool._conns_created == 0
+    assert client.pool.stats.dead == 2
+    assert storage.files[b"M00/00/00/a.bin"] == bytes(100)
+
+
+def test_failed_send_discards_connection(storage, store, tmp_path, monkeypatch):
+    client, store_serv = store
+    storage.files[b"M00/00/00/a.bin"] = bytes(100)
+    source = tmp_path / "a.bin"
+    source.write_bytes(bytes(50))
+
+    def unreadable(*args):
+        raise DataError("[-] Error while reading local file.")
+
+    monkeypatch.setattr(storage_client, "tcp_send_file_range", unreadable)
+    with pytest.raises(DataError):
+        client.storage_modify_by_range(
+            None, store_serv, str(source), 0, 50, "M00/00/00/a.bin"
+        )
+    with pytest.raises(DataError):
+        client.storage_append_by_range(
+            None, store_serv, str(source), 0, 50, "M00/00/00/a.bin"
+        )
+    # the server is still waiting for the body, the connections are not reused
+    assert client.pool._conns_created == 0
+    assert client.pool.stats.dead == 2
+    client.storage_delete_file(None, store_serv, b"M00/00/00/a.bin")
+    assert not storage.files
+
+
+@pytest.mark.anyio
+async def test_stream_upload_and_download(storage):
+    ip, port = storage.address
+    client = StorageClient(ip, port, 3)
+    store_serv = StorageServer(ip, port, group_name=GROUP)
+    content = bytes(range(256)) * 4096
+
+    async def chunks(data: bytes, size: int):
+        for i in range(0, len(data), size):
+            await anyio.sleep(0)
+            yield data[i : i + size]
+
+    ret = await client.upload_stream(
+        store_serv, chunks(content, 9999), len(content), "bin"
+    )
+    assert ret["Remote file_id"] == "group1/M00/00/00/0.bin"
+    assert storage.files[b"M00/00/00/0.bin"] == content
+    with pytest.raises(DataError):
+        await client.upload_stream(store_serv, chunks(content, 9999), 100, "bin")
+    assert len(storage.files) == 1
+
+    received = [
+        chunk
+        async for chunk in client.download_stream(
+            store_serv, "M00/00/00/0.bin", chunk_size=10000
+        )
+    ]
+    assert b"".join(received) == content
+    assert max(map(len, received)) <= 10000
+    stream = client.download_stream(store_serv, "M00/00/00/0.bin", 5, 7)
+    assert b"".join([chunk async for chunk in stream]) == content[5:12]
+    with pytest.raises(DataError):
+        async for _ in client.download_stream(store_serv, "M00/00/00/missing"):
+            pass
+
+
+@pytest.mark.anyio
+async def test_async_client_download_stream(storage):
+    ip, port = storage.address
+    content = bytes(range(256)) * 1000
+    storage.files[b"M00/00/00/a.bin"] = content
+    client = AsyncDfsClient(Config.create((ip,), port=port, timeout=3), ssl=False)
+    stream = client.download_stream("group1/M00/00/00/a.bin", chunk_size=10000)
+    assert b"".join([chunk async for chunk in stream]) == content
+    stream = client.download_stream("group1/M00/00/00/a.bin", offset=3, length=5)
+    assert b"".join([chunk async for chunk in stream]) == content[3:8]
+    await client.aclose()
+
+
+@pytest.mark.anyio
+async def test_async_client_download_stream_abandoned(storage):
+    ip, port = storage.address
+    content = bytes(range(256)) * 1000
+    storage.files[b"M00/00/00/a.bin"] = content
+    client = AsyncDfsClient(Config.create((ip,), port=port, timeout=3), ssl=False)
+    # Leaving the loop early closes the stream from another task
+    async for _ in client.download_stream("group1/M00/00/00/a.bin", chunk_size=100):
+        break
+    await anyio.sleep(0.05)
+    received = client.download_stream("group1/M00/00/00/a.bin")
+    assert b"".join([chunk async for chunk in received]) == content
+    # Nested requests to the same server while the stream is held
+    async for _ in client.download_stream("group1/M00/00/00/a.bin", chunk_size=100):
+        url = await client.upload(b"nested", suffix="txt")
+        assert url.endswith(".txt")
+        break
+    await anyio.sleep(0.05)
+    assert client.pool._limiters[(ip, port)].value == client.pool.max_per_host
+    await client.aclose()
+
+
+@pytest.fixture
+def client(storage) -> Generator[FastdfsClient, None, None]:
+    ip, port = storage.address
+    retry = RetryPolicy(attempts=2, base_delay=0.01)
+    client = FastdfsClient(Config.create((ip,), port=port, timeout=3), retry=retry)
+    yield client
+    client.tracker_pool.destroy()
+    client.storage_pools.destroy()
+
+
+def test_download_parallel(storage, client, tmp_path, monkeypatch):
+    content = bytes(range(256)) * 4099
+    storage.files[b"M00/00/00/a.bin"] = content
+    storage.replicas = [b"127.0.0.1", b"localhost"]
+    monkeypatch.setattr(client, "parallel_min_range", 1000)
+    info = client.query_file_info("group1/M00/00/00/a.bin")
+    assert info["File size"] == len(content)
+    assert info["CRC32"] == zlib.crc32(content)
+
+    target = tmp_path / "a.bin"
+    target.write_bytes(b"x" * (len(content) * 2))  # truncated before writing
+    ret = client.download_to_file(target, "group1/M00/00/00/a.bin", parallel=4)
+    assert target.read_bytes() == content
+    assert ret["Content"] == target
+    # ranges are spread across replicas
+    port = storage.address[1]
+    assert client.storage_pools.get(b"localhost", port).stats.requests == 2
+    # and the two queries of file info
+    assert client.storage_pools.get(b"127.0.0.1", port).stats.requests == 2 + 2
+
+    client.download_to_file(target, "group1/M00/00/00/a.bin", 1000, 3001, parallel=3)
+    assert target.read_bytes() == content[1000:4001]
+
+    storage.replicas = [b"127.0.0.2", b"127.0.0.1"]  # one of them is down
+    client.download_to_file(target, "group1/M00/00/00/a.bin", parallel=3)
+    assert target.read_bytes() == content
+
+    storage.replicas = [b"127.0.0.1"]
+    storage.drop_after = 100  # one of the ranges fails
+    with pytest.raises(ConnectionError):
+        client.download_to_file(target, "group1/M00/00/00/a.bin", parallel=3)
+    assert not target.exists()  # not mistaken for a complete one
+    with pytest.raises(ConnectionError, match="no storage replicas"):
+        client._on_replicas([], 0, lambda store, serv: None)
+
+    monkeypatch.setattr(client, "verify_crc32", True)
+    client.download_to_file(target, "group1/M00/00/00/a.bin", parallel=3)
+    assert target.read_bytes() == content
+    storage.corrupt = True
+    with pytest.raises(DataError, match="CRC32"):
+        client.download_to_file(target, "group1/M00/00/00/a.bin", parallel=3)
+    assert not target.exists()
+
+
+def test_upload_parallel(storage, client, tmp_path, monkeypatch):
+    monkeypatch.setattr(client, "parallel_min_range", 1000)
+    content = bytes(range(256)) * 4099
+    source = tmp_path / "a.bin"
+    source.write_bytes(content)
+    ret = client.upload_appender_by_filename(source, parallel=4)
+    assert ret["Remote file_id"] == "group1/M00/00/00/0.bin"
+    assert ret["Throughput"].endswith("/s")
+    assert storage.files[b"M00/00/00/0.bin"] == content
+    port = storage.address[1]
+    # create, truncate and 4 ranges
+    assert client.storage_pools.get(b"127.0.0.1", port).stats.requests == 6
+
+    def fail(*args):
+        raise DataError("[-] Error: disk is full")
+
+    monkeypatch.setattr(StorageClient, "storage_modify_by_range", fail)
+    with pytest.raises(DataError):
+        client.upload_appender_by_filename(source, parallel=4)
+    assert list(storage.files) == [b"M00/00/00/0.bin"]  # the partial one is deleted
+
+
+def test_download_resume(storage, client, tmp_path, monkeypatch):
+    content = bytes(range(256)) * 4099
+    storage.files[b"M00/00/00/a.bin"] = content
+    monkeypatch.setattr(client, "buffer_size", 1000)
+    target = tmp_path / "a.bin"
+    journal = tmp_path / ("a.bin" + client.journal_suffix)
+    storage.drop_after = 50_000
+    with pytest.raises(ConnectionError):
+        client.download_to_file(target, "group1/M00/00/00/a.bin", resume=True)
+    received = target.stat().st_size
+    assert 0 < received < 50_000
+    assert journal.exists()
+
+    ret = client.download_to_file(target, "group1/M00/00/00/a.bin", resume=True)
+    assert ret["Resumed from"] == received
+    assert storage.downloads[-1] == (received, len(content) - received)
+    assert target.read_bytes() == content
+    assert not journal.exists()
+
+    # a local file that is not recorded in journal is downloaded again
+    ret = client.download_to_file(target, "group1/M00/00/00/a.bin", 10, 20, resume=True)
+    assert ret["Resumed from"] == 0
+    assert target.read_bytes() == content[10:30]
+
+
+def test_upload_resume(storage, client, tmp_path, monkeypatch):
+    monkeypatch.setattr(client, "resume_chunk_size", 1000)
+    content = bytes(range(256)) * 20
+    source = tmp_path / "a.bin"
+    source.write_bytes(content)
+    journal = tmp_path / ("a.bin" + client.journal_suffix)
+    append = StorageClient.storage_append_by_range
+    calls: list[tuple] = []
+
+    def append_twice(self, *args):
+        if len(calls) == 2:
+            raise ConnectionError("[-] Error: connection reset")
+        calls.append(args)
+        return append(self, *args)
+
+    monkeypatch.setattr(StorageClient, "storage_append_by_range", append_twice)
+    with pytest.raises(ConnectionError):
+        client.upload_appender_by_filename(source, resume=True)
+    assert storage.files[b"M00/00/00/0.bin"] == content[:2000]
+    assert journal.exists()
+
+    monkeypatch.setattr(StorageClient, "storage_append_by_range", append)
+    ret = client.upload_appender_by_filename(source, resume=True)
+    assert ret["Remote file_id"] == "group1/M00/00/00/0.bin"
+    assert ret["Resumed from"] == 2000
+    assert storage.files[b"M00/00/00/0.bin"] == content
+    assert not journal.exists()
+
+    # the uploaded part of a changed file is deleted
+    calls.clear()
+    monkeypatch.setattr(StorageClient, "storage_append_by_range", append_twice)
+    with pytest.raises(ConnectionError):
+        client.upload_appender_by_filename(source, resume=True)
+    assert b"M00/00/00/1.bin" in storage.files
+    source.write_bytes(content[::-1])
+    monkeypatch.setattr(StorageClient, "storage_append_by_range", append)
+    ret = client.upload_appender_by_filename(source, resume=True)
+    assert ret["Resumed from"] == 0
+    assert list(storage.files) == [b"M00/00/00/0.bin", b"M00/00/00/2.bin"]
+    assert storage.files[b"M00/00/00/2.bin"] == content[::-1]
+
+    # the appender file larger than local file is deleted
+    calls.clear()
+    monkeypatch.setattr(StorageClient, "storage_append_by_range", append_twice)
+    with pytest.raises(ConnectionError):
+        client.upload_appender_by_filename(source, resume=True)
+    storage.files[b"M00/00/00/3.bin"] = bytes(len(content) + 1)
+    monkeypatch.setattr(StorageClient, "storage_append_by_range", append)
+    ret = client.upload_appender_by_filename(source, resume=True)
+    assert ret["Resumed from"] == 0
+    assert b"M00/00/00/3.bin" not in storage.files
+    assert storage.files[b"M00/00/00/4.bin"] == content[::-1]
+
+
+def test_verify_crc32(storage, client, tmp_path, monkeypatch):
+    monkeypatch.setattr(client, "verify_crc32", True)
+    content = bytes(range(256)) * 4099
+    source = tmp_path / "a.bin"
+    source.write_bytes(content)
+    remote_file_id = client.upload_by_filename(source)["Remote file_id"]
+    ret = client.download_to_buffer(remote_file_id)
+    assert ret["Content"] == content
+    client.download_to_file(tmp_path / "b.bin", remote_file_id)
+    assert client.upload_by_buffer(content[:1000], "bin")
+
+    storage.corrupt = True
+    with pytest.raises(DataError, match="CRC32"):
+        client.download_to_buffer(remote_file_id)
+    with pytest.raises(DataError, match="CRC32"):
+        client.download_to_file(tmp_path / "b.bin", remote_file_id)
+    # a range can not be compared with CRC32 of the file
+    assert len(client.download_to_buffer(remote_file_id, 1, 10)["Content"]) == 10
+    with pytest.raises(DataError, match="CRC32"):
+        client.upload_by_buffer(content[:1000], "bin")
+    assert len(storage.files) == 2  # the corrupted one is deleted
+    # appender file is not verified, as it is to be changed
+    client.upload_appender_by_buffer(content[:1000], "bin")
+
+
+def test_verify_crc32_by_one_connection(storage):
+    ip, port = storage.address
+    pool = ConnectionPool(host_tuple=(ip,), port=port, timeout=3, max_conn=1)
+    client = StorageClient(ip, port, 3, pool=pool, verify_crc32=True)
+    store_serv = StorageServer(ip, port, group_name=GROUP)
+    # the upload connection is released before querying CRC32 by the pool
+    ret = client.storage_upload_by_buffer(None, store_serv, b"content", "txt")
+    assert storage.files[ret["Remote file_id"].split("/", 1)[1].encode()]
+    assert pool.stats.connects == 1
+    pool.destroy()
+
+
+def test_storage_pool_kept_when_busy(storage):
+    ip, port = storage.address
+    storage.files[b"M00/00/00/a.bin"] = b"content"
+    conf = Config.create((ip,), port=port, timeout=3)
+    client = FastdfsClient(conf, max_conn=1, wait_timeout=0.05)
+    assert client.query_file_info("group1/M00/00/00/a.bin")["File size"] == 7
+    pool = client.storage_pools.get(ip.encode(), port)
+    conn = pool.get_connection()
+    with pytest.raises(PoolExhaustedError):
+        client.query_file_info("group1/M00/00/00/a.bin")
+    assert client.storage_pools.get(ip.encode(), port) is pool
+    pool.release(conn)
+    assert client.query_file_info("group1/M00/00/00/a.bin")["File size"] == 7
+    assert pool.stats.connects == 1
+    client.tracker_pool.destroy()
+    client.storage_pools.destroy()